@@ -3,6 +3,7 @@ import tomlkit
 
 from sagelib import get_user_config_path, _set_flag, _get_flag, VERSION
 from .utils import format_dark_name, format_flat_name
+from .library import CalibrationLibrary, CalibEntry
 
 
 CALIB_CONFIG = get_user_config_path("calib.toml")
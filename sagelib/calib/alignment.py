@@ -0,0 +1,523 @@
+import os
+from itertools import combinations
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+from scipy import fft, ndimage
+from scipy.signal.windows import tukey
+from scipy.spatial import cKDTree
+
+from sagelib.image_utils import image_hdu
+from sagelib.writer import write_atomic, Compression
+from sagelib.calib.resample import Resampler
+
+
+class AlignmentError(Exception):
+    """Raised when a frame's stars can't be matched to the reference's"""
+
+
+def detect_stars(img, nsigma:float=5.0, max_stars:int=60, box:int=5, centroid_box:int=9, border:int=8):
+    """
+    Find the brightest point sources in `img`: peaks of the (lightly smoothed) background-subtracted image that are local maxima within `box` pixels and more than `nsigma` times the background noise, centroided by first moments in a `centroid_box` window. The background and noise come from the median and MAD of a subsample, so this doesn't depend on sigma-clipping the whole image
+
+    :return: (N, 2) array of (x, y) centroids and (N,) array of fluxes, brightest first
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    img = np.asarray(img, dtype=np.float32)
+    sample = img[::4, ::4]
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return np.empty((0, 2)), np.empty(0)
+    background = np.median(sample)
+    sub = np.nan_to_num(img - background, nan=0.0)
+    smooth = ndimage.gaussian_filter(sub, 1.0)
+    s = smooth[::4, ::4]
+    noise = 1.4826*np.median(np.abs(s - np.median(s))) or np.std(s)
+    peaks = (smooth == ndimage.maximum_filter(smooth, size=box)) & (smooth > nsigma*noise)
+    border = max(border, centroid_box//2)
+    peaks[:border] = peaks[-border:] = False
+    peaks[:, :border] = peaks[:, -border:] = False
+    ys, xs = np.nonzero(peaks)
+    if ys.size == 0:
+        return np.empty((0, 2)), np.empty(0)
+    brightest = np.argsort(smooth[ys, xs])[::-1][:4*max_stars]
+    ys, xs = ys[brightest], xs[brightest]
+
+    # first-moment centroids in a (2r+1)^2 window around every peak at once
+    r = centroid_box//2
+    dy, dx = np.mgrid[-r:r+1, -r:r+1]
+    windows = sub[ys[:, None, None] + dy, xs[:, None, None] + dx]
+    weights = np.clip(windows, 0, None)
+    total = weights.sum(axis=(1, 2))
+    good = total > 0
+    cx = xs[good] + (weights[good]*dx).sum(axis=(1, 2))/total[good]
+    cy = ys[good] + (weights[good]*dy).sum(axis=(1, 2))/total[good]
+    flux = windows[good].sum(axis=(1, 2))
+    order = np.argsort(flux)[::-1][:max_stars]
+    return np.column_stack([cx[order], cy[order]]), flux[order]
+
+
+def _triangles(stars, n_neighbors=5):
+    # triangles from each star and its nearest neighbors, with vertices in a canonical order (by the length of the opposite side), and their
+    # scale-, rotation-, and flip-invariant shape: the ratios of their sides
+    n = len(stars)
+    if n < 3:
+        return np.empty((0, 3), dtype=int), np.empty((0, 2))
+    _, neighbors = cKDTree(stars).query(stars, k=min(n_neighbors, n))
+    tris = {tuple(sorted(c)) for row in neighbors for c in combinations(row, 3)}
+    tris = np.array(sorted(tris), dtype=int)
+    p = stars[tris]  # (T, 3, 2)
+    opposite = np.stack([np.linalg.norm(p[:, 1] - p[:, 2], axis=1),
+                         np.linalg.norm(p[:, 0] - p[:, 2], axis=1),
+                         np.linalg.norm(p[:, 0] - p[:, 1], axis=1)], axis=1)
+    order = np.argsort(opposite, axis=1)
+    tris = np.take_along_axis(tris, order, axis=1)
+    sides = np.take_along_axis(opposite, order, axis=1)
+    keep = sides[:, 0] > 0
+    return tris[keep], np.column_stack([sides[keep, 2]/sides[keep, 1], sides[keep, 1]/sides[keep, 0]])
+
+
+class AffineTransform:
+    def __init__(self, params):
+        """An affine map of (x, y) pixel coordinates: ``[x', y'] = params @ [x, y, 1]``, with `params` a 2x3 array"""
+        self.params = np.asarray(params, dtype=np.float64)
+
+    @classmethod
+    def fit(cls, src, dst):
+        """The least-squares transform taking the (N, 2) points `src` to `dst` (exact for N=3)"""
+        src_h = np.column_stack([src, np.ones(len(src))])
+        solution, *_ = np.linalg.lstsq(src_h, dst, rcond=None)
+        return cls(solution.T)
+
+    def __call__(self, xy):
+        return np.asarray(xy) @ self.params[:, :2].T + self.params[:, 2]
+
+    def inverse(self):
+        m = np.linalg.inv(self.params[:, :2])
+        return AffineTransform(np.column_stack([m, -m @ self.params[:, 2]]))
+
+    @property
+    def scale(self):
+        return float(np.sqrt(abs(np.linalg.det(self.params[:, :2]))))
+
+    @property
+    def rotation(self):
+        """Rotation in degrees"""
+        return float(np.degrees(np.arctan2(self.params[1, 0], self.params[0, 0])))
+
+    @property
+    def translation(self):
+        return tuple(self.params[:, 2])
+
+    def __repr__(self):
+        return f"AffineTransform(shift=({self.translation[0]:.2f}, {self.translation[1]:.2f}), rotation={self.rotation:.3f} deg, scale={self.scale:.4f})"
+
+
+class ReferenceFeatures:
+    def __init__(self, img, nsigma:float=5.0, max_stars:int=60, translation:bool=False):
+        """The stars in a reference image and the invariants of the triangles they form, indexed in KD-trees. Computed once and reused (and sent once to each worker process) for every frame that's aligned to this reference. If `translation`, the reference's correlation spectrum is kept too, for :func:`register_translation`"""
+        img = np.asarray(img)
+        self.shape = img.shape
+        self.window = self.spectrum = None
+        if translation:
+            self.window = _taper(img.shape)
+            self.spectrum = _correlation_spectra(img, self.window)[0]
+        self.nsigma, self.max_stars = nsigma, max_stars
+        self.stars, self.flux = detect_stars(img, nsigma, max_stars)
+        if len(self.stars) < 3:
+            raise AlignmentError(f"Found only {len(self.stars)} stars in the reference image - need at least 3")
+        self.star_tree = cKDTree(self.stars)
+        self.triangles, self.invariants = _triangles(self.stars)
+        self.invariant_tree = cKDTree(self.invariants)
+
+    @classmethod
+    def from_fits(cls, path, **kwargs):
+        with fits.open(path) as f:
+            return cls(image_hdu(f).data, **kwargs)
+
+
+def find_transform(ref:ReferenceFeatures, img=None, stars=None, tolerance:float=2.0, invariant_radius:float=0.02, max_trials:int=500, min_matches:int=5):
+    """
+    Find the affine transform that takes pixel coordinates in `img` (or of its already-detected `stars`) to coordinates in the reference. Triangles of neighboring stars in the frame are matched to reference triangles with similar shape invariants (with a KD-tree), and each match proposes a transform. The proposal that brings the most of the frame's stars within `tolerance` pixels of a reference star wins (RANSAC), and is refined by least squares on those matches
+
+    :return: the transform, and the (M, 2, 2) matched (frame, reference) star positions it was fit to
+    :rtype: tuple[AffineTransform, np.ndarray]
+    :raises AlignmentError: if fewer than `min_matches` stars (or all of the stars, if there are fewer) could be matched
+    """
+    if stars is None:
+        stars, _ = detect_stars(img, ref.nsigma, ref.max_stars)
+    if len(stars) < 3:
+        raise AlignmentError(f"Found only {len(stars)} stars - need at least 3")
+    tris, invariants = _triangles(stars)
+    dists, ref_idx = ref.invariant_tree.query(invariants, k=3, distance_upper_bound=invariant_radius)
+    cand_tri, cand_k = np.nonzero(np.isfinite(dists))
+    if cand_tri.size == 0:
+        raise AlignmentError("No star patterns matched the reference")
+    by_similarity = np.argsort(dists[cand_tri, cand_k])[:max_trials]
+    needed = min(min_matches, len(stars), len(ref.stars))
+
+    def matches(transform):
+        d, i = ref.star_tree.query(transform(stars), distance_upper_bound=tolerance)
+        good = np.isfinite(d)
+        return np.nonzero(good)[0], i[good]
+
+    best, best_n = None, 0
+    for c in by_similarity:
+        src = stars[tris[cand_tri[c]]]
+        dst = ref.stars[ref.triangles[ref_idx[cand_tri[c], cand_k[c]]]]
+        try:
+            transform = AffineTransform.fit(src, dst)
+        except np.linalg.LinAlgError:
+            continue
+        if not 0.5 < transform.scale < 2:  # frames of the same field with the same instrument don't change scale much
+            continue
+        n = len(matches(transform)[0])
+        if n > best_n:
+            best, best_n = transform, n
+            if n >= 0.8*min(len(stars), len(ref.stars)):
+                break
+    if best is None or best_n < needed:
+        raise AlignmentError(f"Matched only {best_n} stars to the reference - need {needed}")
+    for _ in range(2):
+        src_i, ref_i = matches(best)
+        best = AffineTransform.fit(stars[src_i], ref.stars[ref_i])
+    src_i, ref_i = matches(best)
+    return best, np.stack([stars[src_i], ref.stars[ref_i]], axis=1)
+
+
+def apply_transform(img, transform:AffineTransform, shape=None, order:int=1, cval=np.nan, out=None):
+    """
+    Resample `img` onto the reference's pixel grid, given the `transform` from :func:`find_transform` (image -> reference). Pixels that fall outside `img` are `cval` (NaN, which stacking ignores)
+
+    :param shape: output shape, defaults to None (the shape of `img`)
+    :param order: spline interpolation order: 1 (bilinear) or 3 (cubic), defaults to 1
+    :param out: float32 array (not `img` itself) to resample into, defaults to None (a new array)
+    """
+    inverse = transform.inverse()  # reference (x, y) -> image (x, y)
+    # scipy works in (row, col) = (y, x)
+    matrix = inverse.params[::-1, 1::-1]
+    offset = inverse.params[::-1, 2]
+    if out is not None:
+        ndimage.affine_transform(np.asarray(img, dtype=np.float32), matrix, offset, order=order, cval=cval, output=out)
+        return out
+    return ndimage.affine_transform(np.asarray(img, dtype=np.float32), matrix, offset, output_shape=shape or np.shape(img), order=order, cval=cval, output=np.float32)
+
+
+def _taper(shape, fraction=0.1):
+    # a window that tapers the outer `fraction` of each edge to 0, so that the edges of frames don't correlate with each other
+    return np.outer(tukey(shape[0], fraction), tukey(shape[1], fraction)).astype(np.float32)
+
+
+def _correlation_spectra(frames, window):
+    # 2D real FFTs of frames (a 2D image or an (n, rows, cols) stack) prepared for correlation: background-subtracted, with NaNs and everything
+    # below the background set to 0 (so that sources correlate, not noise), and tapered by `window`. all frames are transformed in one call
+    x = np.array(frames, dtype=np.float32, ndmin=3)
+    background = np.nanmedian(x[:, ::4, ::4], axis=(1, 2))
+    x -= background[:, None, None]
+    np.nan_to_num(x, copy=False, nan=0.0)
+    np.clip(x, 0, None, out=x)
+    x *= window
+    return fft.rfft2(x, workers=-1)
+
+
+def _find_peak(surface, exclude=5):
+    # sub-pixel (x, y) position of the highest peak of a correlation surface (wrapped, so that shifts past half the frame are negative) from a
+    # parabola through it and its neighbors along each axis, and the ratio of its height to the highest point more than `exclude` pixels away
+    ny, nx = surface.shape
+    iy, ix = np.unravel_index(np.argmax(surface), surface.shape)
+    peak = surface[iy, ix]
+
+    def vertex(before, after):
+        curvature = before - 2*peak + after
+        return 0.0 if curvature == 0 else 0.5*(before - after)/curvature
+    x = ix + vertex(surface[iy, (ix-1) % nx], surface[iy, (ix+1) % nx])
+    y = iy + vertex(surface[(iy-1) % ny, ix], surface[(iy+1) % ny, ix])
+
+    around = np.ix_(np.arange(iy-exclude, iy+exclude+1) % ny, np.arange(ix-exclude, ix+exclude+1) % nx)
+    saved = surface[around]
+    surface[around] = -np.inf
+    runner_up = surface.max()
+    surface[around] = saved
+    ratio = peak/runner_up if runner_up > 0 else np.inf
+    return (x - nx if x > nx/2 else x), (y - ny if y > ny/2 else y), float(ratio)
+
+
+def register_translation(ref:ReferenceFeatures, frames, whiten:float=0.5, min_peak_ratio:float=5.0):
+    """
+    Find the shift that takes each frame's pixel coordinates to the reference's, for frames that only differ from it by a translation (like sidereally tracked sequences), by phase correlation: the peak of the inverse FFT of the frames' normalized cross-power spectra with the reference, refined to sub-pixel precision by fitting a parabola. The FFTs of every frame in `frames` are computed in one batched call, and the reference's only once (see :class:`ReferenceFeatures`). This takes one FFT per frame, instead of detecting and matching its stars.
+
+    A correlation peak that isn't at least `min_peak_ratio` times higher than any other is weak, and its shift shouldn't be trusted: the frame is of a different field, has too few stars, or is rotated (a rotation that moves stars at the edges by a few pixels roughly halves the ratio of a good frame, which is typically 10-20).
+
+    :param ref: the reference, made with `translation=True`
+    :type ref: ReferenceFeatures
+    :param frames: a 2D frame, or an (n, rows, cols) stack of frames, with the reference's shape
+    :param whiten: the cross-power spectrum is divided by its magnitude to this power: 1 is classic phase correlation, and 0 is plain cross-correlation. the default of 0.5 makes the sharpest peaks for star fields, defaults to 0.5
+    :type whiten: float, optional
+    :return: an (n, 2) array of (dx, dy) shifts, and an (n,) boolean array of whether each frame's correlation peak was strong enough
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    if ref.spectrum is None:
+        raise ValueError("The reference's correlation spectrum wasn't kept - make it with ReferenceFeatures(..., translation=True)")
+    frames = np.asarray(frames)
+    frames = frames[None] if frames.ndim == 2 else frames
+    if frames.shape[1:] != tuple(ref.shape):
+        raise ValueError(f"Can't register frames of shape {frames.shape[1:]} to a reference of shape {tuple(ref.shape)}")
+    cross = _correlation_spectra(frames, ref.window)
+    np.conjugate(cross, out=cross)
+    cross *= ref.spectrum
+    if whiten:
+        cross /= np.abs(cross)**whiten + np.finfo(np.float32).tiny
+    surfaces = fft.irfft2(cross, s=ref.shape, workers=-1)
+    peaks = np.array([_find_peak(surface) for surface in surfaces])
+    return peaks[:, :2], peaks[:, 2] >= min_peak_ratio
+
+
+def shift_image(img, shift, method:str="bilinear", out=None, cval=np.nan):
+    """
+    :func:`apply_transform` for a pure translation, faster: shift `img` by `shift` = (dx, dy), so that ``out[y, x] = img[y-dy, x-dx]``. Pixels shifted in from outside `img` are `cval`
+
+    :param method: 'bilinear': an integer shift (array slicing) plus a bilinear interpolation of the fractional part, which matches :func:`apply_transform` with order=1 (to rounding), or 'fourier': a phase ramp applied to the image's FFT, which doesn't smooth the image but rings around NaNs and sharp edges, defaults to 'bilinear'
+    :type method: str, optional
+    :param out: float32 array (not `img` itself) to shift into, defaults to None (a new array)
+    """
+    img = np.asarray(img, dtype=np.float32)
+    out = np.empty_like(img) if out is None else out
+    ny, nx = img.shape
+    dx, dy = float(shift[0]), float(shift[1])
+    if method == "fourier":
+        ky, kx = fft.fftfreq(ny)[:, None], fft.rfftfreq(nx)[None, :]
+        spectrum = fft.rfft2(np.nan_to_num(img, nan=0.0), workers=-1)
+        spectrum *= np.exp(-2j*np.pi*(ky*dy + kx*dx)).astype(np.complex64)
+        out[:] = fft.irfft2(spectrum, s=img.shape, workers=-1)
+        # the shift wraps around: blank what came in from the other side
+        x0, x1 = int(np.ceil(dx)), nx + int(np.floor(dx))
+        y0, y1 = int(np.ceil(dy)), ny + int(np.floor(dy))
+        out[:max(y0, 0)] = cval
+        out[min(y1, ny):] = cval
+        out[:, :max(x0, 0)] = cval
+        out[:, min(x1, nx):] = cval
+        return out
+    if method != "bilinear":
+        raise ValueError(f"Unknown shift method '{method}' - must be 'bilinear' or 'fourier'")
+    # out[y, x] = img[y+iy+fy, x+ix+fx], interpolated between the four pixels around that point
+    ix, iy = int(np.floor(-dx)), int(np.floor(-dy))
+    fx, fy = -dx - ix, -dy - iy
+    out[:] = cval
+    x0, x1 = max(0, -ix), min(nx, nx - ix - (fx > 0))
+    y0, y1 = max(0, -iy), min(ny, ny - iy - (fy > 0))
+    if x1 <= x0 or y1 <= y0:
+        return out
+    dest = out[y0:y1, x0:x1]
+    src = lambda oy, ox: img[y0+iy+oy:y1+iy+oy, x0+ix+ox:x1+ix+ox]
+    np.multiply(src(0, 0), (1-fx)*(1-fy), out=dest)
+    for oy, ox, weight in ((0, 1, fx*(1-fy)), (1, 0, (1-fx)*fy), (1, 1, fx*fy)):
+        if weight:
+            dest += weight*src(oy, ox)
+    return out
+
+
+def aligned_name(path):
+    """Name of the aligned version of the frame at `path`: its name with '_affineremap' appended, as alipy named them"""
+    root, ext = os.path.splitext(os.path.basename(path))
+    return f"{root}_affineremap{ext or '.fits'}"
+
+
+_align_state = {}
+
+def _init_align(ref, out_dir, order, overwrite, compression, translation=False, shift_method="bilinear", min_peak_ratio=5.0, threads=1):
+    # frames are resampled by `threads` threads each: all of the cores in the main process, or one per worker process. star-matched transforms
+    # are all different, so no coordinate maps are cached: building a full-frame map per frame that's never reused is slower than resampling directly
+    _align_state.update(ref=ref, out_dir=out_dir, order=order, overwrite=overwrite, compression=compression, translation=translation, shift_method=shift_method, min_peak_ratio=min_peak_ratio,
+                        resampler=Resampler(ref.shape, order, cache_mb=0, workers=threads))
+
+
+def _align_image(img, out, shift=None):
+    # resample img into out with the settings from _init_align(_cube): shifted by `shift` (from register_translation) if given, otherwise by the
+    # transform found by matching its stars. returns the transform and a description of how it was found, or None and why it couldn't be
+    state = _align_state
+    if shift is not None:
+        shift_image(img, shift, state["shift_method"], out=out)
+        return AffineTransform([[1, 0, shift[0]], [0, 1, shift[1]]]), "by phase correlation"
+    try:
+        transform, matched = find_transform(state["ref"], img)
+    except AlignmentError as e:
+        return None, str(e)
+    state["resampler"].resample(img, transform, out=out)
+    how = f"with {len(matched)} stars"
+    return transform, how if not state["translation"] else how + " (weak correlation peak)"
+
+
+def _registered_shifts(imgs):
+    # with translation, the shift of each of imgs from one batched phase correlation (None where the peak was weak). otherwise all None
+    state = _align_state
+    if not state["translation"] or imgs.shape[1:] != tuple(state["ref"].shape):
+        return [None]*len(imgs)
+    shifts, strong = register_translation(state["ref"], imgs, min_peak_ratio=state["min_peak_ratio"])
+    return [shift if ok else None for shift, ok in zip(shifts, strong)]
+
+
+def _align_one(path):
+    # align one file with the reference features set up by _init_align. returns (path, output path or None, transform or None, description)
+    state = _align_state
+    try:
+        with fits.open(path) as f:
+            hdu = image_hdu(f)
+            img, header = hdu.data.astype(np.float32), hdu.header.copy()
+        aligned = np.empty(state["ref"].shape, dtype=np.float32)
+        transform, how = _align_image(img, aligned, *_registered_shifts(img[None]))
+    except (OSError, ValueError) as e:
+        return path, None, None, str(e)
+    if transform is None:
+        return path, None, None, how
+    header["HISTORY"] = f"Aligned to reference {how}: {transform}"
+    out = os.path.join(state["out_dir"], aligned_name(path))
+    write_atomic(out, aligned, header, overwrite=state["overwrite"], compression=state["compression"])
+    return path, out, transform, how
+
+
+def align_files(ref, paths, out_dir, workers:int=1, order:int=1, overwrite:bool=True, compression:Compression|None=None, translation:bool=False, verbose:bool=True):
+    """
+    Align fits files to a reference and write them to `out_dir` (named by :func:`aligned_name`), using `workers` processes. The reference's stars and triangles are found once and sent to each worker
+
+    :param ref: path to the reference image, or its :class:`ReferenceFeatures` (made with `translation=True`, if `translation`)
+    :type ref: str | ReferenceFeatures
+    :param compression: tile-compress the aligned files this way, defaults to None (uncompressed)
+    :type compression: Compression | None, optional
+    :param translation: register frames by translation only, with :func:`register_translation`, and only match stars for frames whose correlation peak is weak, defaults to False
+    :type translation: bool, optional
+    :return: paths of the aligned files (in the order of `paths`), and the paths that couldn't be aligned
+    :rtype: tuple[list[str], list[str]]
+    """
+    if not isinstance(ref, ReferenceFeatures):
+        ref = ReferenceFeatures.from_fits(ref, translation=translation)
+    os.makedirs(out_dir, exist_ok=True)
+    initargs = (ref, out_dir, order, overwrite, compression, translation)
+    if workers > 1:
+        with Pool(workers, initializer=_init_align, initargs=initargs) as pool:
+            results = pool.map(_align_one, paths)
+    else:
+        _init_align(*initargs, threads=None)
+        results = [_align_one(p) for p in paths]
+        _align_state.clear()
+    aligned, failed = [], []
+    for path, out, transform, how in results:
+        if out is None:
+            failed.append(path)
+            if verbose:
+                print(f"Couldn't align {path}: {how}")
+        else:
+            aligned.append(out)
+            if verbose:
+                print(f"Aligned {os.path.basename(path)} {how}: {transform}")
+    return aligned, failed
+
+
+def _init_align_cube(ref, cube, order, translation, shift_method, min_peak_ratio, threads=1):
+    if isinstance(cube, str):
+        cube = np.load(cube, mmap_mode="r+")
+    _init_align(ref, None, order, False, None, translation, shift_method, min_peak_ratio, threads)
+    _align_state["cube"] = cube
+
+
+def _align_planes(indices):
+    # align planes of the cube set up by _init_align_cube in place, registering them together if by translation. returns (i, transform or None, description) for each
+    cube = _align_state["cube"]
+    imgs = np.array(cube[indices], dtype=np.float32)
+    results = []
+    for i, img, shift in zip(indices, imgs, _registered_shifts(imgs)):
+        transform, how = _align_image(img, cube[i], shift)
+        if transform is None:
+            cube[i] = np.nan  # ignored by stacking
+        results.append((i, transform, how))
+    return results
+
+
+def align_cube(ref, cube, workers:int=1, order:int=1, names=None, translation:bool=False, shift_method:str="bilinear", min_peak_ratio:float=5.0, batch:int=8, verbose:bool=True):
+    """
+    Align the planes of a (frames, rows, cols) float32 cube to a reference in place, without reading or writing any fits files. Planes that can't be aligned are set to NaN, which stacking ignores
+
+    :param ref: the reference's :class:`ReferenceFeatures` (made with `translation=True`, if `translation`). the cube's planes must have the reference's shape
+    :type ref: ReferenceFeatures
+    :param cube: the frames to align, or the path of a .npy file holding them, which is memory-mapped (by each of `workers` processes, if more than 1 - an in-memory cube is always aligned by this process)
+    :type cube: np.ndarray | str
+    :param names: names of the planes, for messages, defaults to None
+    :param translation: register planes by translation only, `batch` at a time, with :func:`register_translation`, and shift them with :func:`shift_image` (by `shift_method`). only planes whose correlation peak is weaker than `min_peak_ratio` are aligned by matching stars, defaults to False
+    :type translation: bool, optional
+    :return: the transform that aligned each plane (from the plane to the reference), or None for planes that couldn't be aligned
+    :rtype: list[AffineTransform | None]
+    """
+    shape = np.load(cube, mmap_mode="r").shape if isinstance(cube, str) else cube.shape
+    if tuple(shape[1:]) != tuple(ref.shape):
+        raise ValueError(f"Can't align frames of shape {tuple(shape[1:])} to a reference of shape {tuple(ref.shape)}")
+    step = max(1, batch) if translation else 1
+    batches = [list(range(i, min(i+step, shape[0]))) for i in range(0, shape[0], step)]
+    initargs = (ref, cube, order, translation, shift_method, min_peak_ratio)
+    if workers > 1 and isinstance(cube, str):
+        with Pool(workers, initializer=_init_align_cube, initargs=initargs) as pool:
+            results = [r for rs in pool.map(_align_planes, batches) for r in rs]
+    else:
+        _init_align_cube(*initargs, threads=None)
+        results = [r for b in batches for r in _align_planes(b)]
+        _align_state.clear()
+    transforms = []
+    for i, transform, how in results:
+        transforms.append(transform)
+        if verbose:
+            name = names[i] if names is not None else f"frame {i}"
+            print(f"Couldn't align {name}: {how}" if transform is None else f"Aligned {name} {how}: {transform}")
+    return transforms
+
+
+if __name__ == "__main__":
+    # accuracy and speed check on synthetic star fields with known transforms
+    import time
+    rng = np.random.default_rng(0)
+    size, n_stars = 1024, 200
+    xy = rng.uniform(20, size-20, (n_stars, 2))
+    flux = rng.lognormal(8, 1, n_stars)
+
+    def render(points):
+        img = rng.normal(1000, 10, (size, size)).astype(np.float32)
+        y, x = np.mgrid[-6:7, -6:7]
+        for (px, py), f in zip(points, flux):
+            ix, iy = int(round(px)), int(round(py))
+            if 6 <= ix < size-6 and 6 <= iy < size-6:
+                img[iy-6:iy+7, ix-6:ix+7] += f/(2*np.pi*2.5**2)*np.exp(-((x+ix-px)**2 + (y+iy-py)**2)/(2*2.5**2))
+        return img
+
+    start = time.perf_counter()
+    ref = ReferenceFeatures(render(xy))
+    print(f"reference: {len(ref.stars)} stars, {len(ref.triangles)} triangles in {time.perf_counter()-start:.2f} s")
+    errors, times = [], []
+    for trial in range(10):
+        angle, shift = np.radians(rng.uniform(-3, 3)), rng.uniform(-40, 40, 2)
+        rot = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        truth = AffineTransform(np.column_stack([rot, shift]))  # reference -> frame
+        frame = render(truth(xy))
+        start = time.perf_counter()
+        transform, matched = find_transform(ref, frame)
+        times.append(time.perf_counter() - start)
+        errors.append(np.max(np.linalg.norm(transform(truth(xy)) - xy, axis=1)))
+    print(f"find_transform: {np.mean(times)*1000:.0f} ms per frame, max error {max(errors):.3f} px")
+
+    # translation only: star matching vs. batched phase correlation
+    ref = ReferenceFeatures(render(xy), translation=True)
+    shifts = rng.uniform(-30, 30, (16, 2))
+    frames = np.stack([render(xy - shift) for shift in shifts])
+    start = time.perf_counter()
+    matched = np.array([find_transform(ref, frame)[0].translation for frame in frames])
+    print(f"find_transform (translation): {(time.perf_counter()-start)/len(frames)*1000:.0f} ms per frame, max error {np.max(np.abs(matched - shifts)):.3f} px")
+    start = time.perf_counter()
+    registered, strong = register_translation(ref, frames)
+    print(f"register_translation: {(time.perf_counter()-start)/len(frames)*1000:.0f} ms per frame, max error {np.max(np.abs(registered - shifts)):.3f} px, {strong.sum()}/{len(frames)} strong peaks")
+    rotation = AffineTransform([[np.cos(0.02), -np.sin(0.02), 0], [np.sin(0.02), np.cos(0.02), 0]])
+    _, strong = register_translation(ref, render(rotation(xy - size/2) + size/2))
+    print(f"frame rotated by {np.degrees(0.02):.1f} deg: {'strong' if strong[0] else 'weak'} peak")
+    for method in ("bilinear", "fourier"):
+        start = time.perf_counter()
+        shifted = [shift_image(frame, shift, method) for frame, shift in zip(frames, registered)]
+        print(f"shift_image ({method}): {(time.perf_counter()-start)/len(frames)*1000:.0f} ms per frame")
+    start = time.perf_counter()
+    resampled = [apply_transform(frame, AffineTransform([[1, 0, shift[0]], [0, 1, shift[1]]])) for frame, shift in zip(frames, registered)]
+    print(f"apply_transform: {(time.perf_counter()-start)/len(frames)*1000:.0f} ms per frame")
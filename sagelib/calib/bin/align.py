@@ -2,7 +2,10 @@
 
 from sagelib.frame import Frame
 from sagelib.utils import findAllIn
-from sagelib.image_utils import read_ccddata_ls
+from sagelib.discovery import find_files
+from sagelib.calib.combine import stack_files, write_stack
+from sagelib.calib.alignment import align_files
+from sagelib.image_utils import get_image_header
 import sys
 import warnings
 from astropy import wcs, utils
@@ -18,8 +21,6 @@ from astropy.nddata import CCDData
 import sys
 import six
 sys.modules['astropy.extern.six'] = six
-import ccdproc
-import alipy
 # displaying imports
 import matplotlib.pyplot as plt
 from astropy.visualization import ZScaleInterval
@@ -35,9 +36,9 @@ warnings.filterwarnings("ignore", category=wcs.FITSFixedWarning)
 warnings.filterwarnings("ignore", category=utils.exceptions.AstropyDeprecationWarning)
 
 
-def align(img_dir, pattern,ref_image_path,aligned_out,target_name, also_make_combined_aligned=False):
+def align(img_dir, pattern,ref_image_path,aligned_out,target_name, also_make_combined_aligned=False, workers=1, translation=False):
     # print(os.listdir(img_dir))
-    images_to_align = sorted(glob.glob(os.path.join(img_dir,pattern)))
+    images_to_align = find_files(img_dir,pattern,include_hidden=False)
     if not len(images_to_align):
         print(f"No images found in {img_dir} matching pattern {pattern}")
         exit()
@@ -46,36 +47,14 @@ def align(img_dir, pattern,ref_image_path,aligned_out,target_name, also_make_com
     if ref_image_path is None:
         ref_image_path = images_to_align[0]
         print(f"No reference image provided. Using {ref_image_path} as reference image.")
-    # for img in images_to_align:
-    #     print(img, Frame.from_fits(img).img.ndim)
-    identifications = alipy.ident.run(ref_image_path, images_to_align, visu=False,verbose=False,hdu=1)
-    print("ID'd")
-    outputshape = alipy.align.shape(ref_image_path)
-
-
-    if not os.path.exists(aligned_out):
-        os.mkdir(aligned_out)
-    unable_to_align = []
-    for id in identifications:
-        if id.ok == True:
-            alipy.align.affineremap(id.ukn.filepath, id.trans, shape=outputshape, makepng=True,outdir=aligned_out,verbose=False)
-        else:
-            unable_to_align.append(id.ukn.filepath)
+    aligned_paths, unable_to_align = align_files(ref_image_path, images_to_align, aligned_out, workers=workers, translation=translation, verbose=False)
 
     print(f"Was not able to align the following {len(unable_to_align)} files: {unable_to_align}")
 
-    if also_make_combined_aligned:
-        aligned_ls = findAllIn(data_dir = aligned_out, file_matching='fdb_*.fits')
-
-        # running ccdproc.combine() + saving resulting image
-        aligned_slices = read_ccddata_ls(aligned_ls, aligned_out)
-
-        result_img = ccdproc.combine(aligned_slices,
-                                method='average',
-                                sigma_clip=True, sigma_clip_low_thresh=3, sigma_clip_high_thresh=3,
-                                sigma_clip_func=np.ma.average)
-        result_img.meta['combined'] = True
-        result_img.write(aligned_out/Path(f'combined_{target_name}.fits'),overwrite=True)
+    if also_make_combined_aligned and aligned_paths:
+        # stack a block of rows at a time instead of loading every aligned frame
+        stack, count, rejected = stack_files(aligned_paths, workers=workers)
+        write_stack(aligned_out/Path(f'combined_{target_name}.fits'), stack, count, rejected, header=get_image_header(aligned_paths[0]), overwrite=True)
     print("Done aligning.")
 
 #"fdb_*.fits"
@@ -87,6 +66,8 @@ def main():
     parser.add_argument('out_dir', type=str, help='Output directory')
     parser.add_argument('target_name', type=str, help='Target name')
     parser.add_argument('--ref_img', type=str, default=None, help='Optional path to reference image to align to. If not provided, will use first image in input_dir')
+    parser.add_argument('--translation', action='store_true', help='Align by translation only, with FFT phase correlation, which is much faster than matching stars. For sidereally tracked sequences. Frames whose correlation peak is weak are aligned by matching stars instead')
+    parser.add_argument('-n', '--workers', type=int, default=1, help='Number of processes to align frames with. Default is 1')
 
     args = parser.parse_args()
 
@@ -96,7 +77,7 @@ def main():
     out_dir = args.out_dir
     target_name = args.target_name
 
-    align(input_dir,pattern,ref_img,out_dir,target_name)
+    align(input_dir,pattern,ref_img,out_dir,target_name,workers=args.workers,translation=args.translation)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,170 @@
+#! python
+
+import sys
+import os
+import argparse
+from collections import defaultdict
+
+import numpy as np
+from astropy.io import fits
+
+from sagelib.utils import Config
+from sagelib.calib import CALIB_CONFIG
+from sagelib.calib.utils import format_flat_name, format_dark_name
+from sagelib.calib.library import _HEADER_TYPES
+from sagelib.calib.combine import combine_files, COMBINE_METHODS
+from sagelib.header_index import default_index
+from sagelib.frame import _memmap_cube
+from sagelib.writer import write_atomic
+from sagelib.image_utils import get_image_header
+
+
+def classify(paths):
+    """
+    Sort raw calibration frames into biases, darks by exposure time (whole seconds), and flats by filter using their IMAGETYP/OBSTYPE header keywords (from the header index). Masters and frames of other types are ignored. Returns (biases, darks, flats, headers)
+    """
+    biases, darks, flats = [], defaultdict(list), defaultdict(list)
+    headers = {}
+    for path, header in zip(paths, default_index().scan(paths)):
+        if header.get("NAXIS", 0) != 2:
+            continue
+        imtype = str(header.get("IMAGETYP", header.get("OBSTYPE", ""))).strip().lower()
+        if imtype.startswith("master"):
+            continue
+        if imtype in _HEADER_TYPES["bias"]:
+            biases.append(path)
+        elif imtype in _HEADER_TYPES["dark"]:
+            darks[int(header["EXPTIME"])].append(path)
+        elif imtype in _HEADER_TYPES["flat"]:
+            flats[str(header["FILTER"])].append(path)
+        else:
+            continue
+        headers[path] = header
+    return biases, darks, flats, headers
+
+
+def master_header(paths, headers, imtype, method):
+    # the header of the middle input (by DATE-OBS, so the master is dated to the middle of its run), annotated with how it was made
+    ordered = sorted(paths, key=lambda p: str(headers[p].get("DATE-OBS", "")))
+    header = get_image_header(ordered[len(ordered)//2])
+    for key in ("BZERO", "BSCALE", "BLANK"):
+        header.remove(key, ignore_missing=True)
+    header["IMAGETYP"] = imtype
+    header["NCOMBINE"] = (len(paths), "number of frames combined")
+    header["COMBMETH"] = (method, "combination method")
+    return header
+
+
+def flat_medians(paths, offset, sample_size=1_000_000):
+    # median of each flat after subtracting `offset`, from an evenly-spaced sample of about `sample_size` pixels in whole rows (like
+    # approx_median's 'sample' method). only the sampled rows of each memory-mapped flat are read and scaled, so a flat is never fully loaded
+    medians = []
+    for path in paths:
+        raw, bscale, bzero = _memmap_cube(path)  # the first HDU with data, so compressed flats work too
+        step = max(1, raw.shape[0] // max(1, sample_size // raw.shape[1]))
+        rows = raw[::step].astype(np.float32)
+        if bscale != 1 or bzero != 0:
+            rows *= bscale
+            rows += bzero
+        if offset is not None:
+            rows -= offset[::step]
+        medians.append(np.nanmedian(rows))
+    return np.array(medians, dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build master biases, darks (one per exposure time), and normalized flats (one per filter) from a directory of raw calibration frames. Frames are sorted by their IMAGETYP header keyword and combined a tile of rows at a time, so memory use doesn't depend on how many frames there are. Output is named with the patterns in the calib config so that reduce can find it. If no frame types are specified, all will be made.")
+    parser.add_argument("raw_calib_dir", action="store", type=str, help="the directory containing raw bias, dark, and flat frames")
+    parser.add_argument("output_dir", action="store", type=str, nargs="?", default=None, help="the directory to write masters to. defaults to calib_path from the config")
+
+    parser.add_argument("-b", "--bias", action="store_true", help="make a master bias")
+    parser.add_argument("-d", "--dark", action="store_true", help="make master darks. they are bias-subtracted if a master bias is made or found in the output directory")
+    parser.add_argument("-f", "--flat", action="store_true", help="make normalized master flats. they are bias- and dark-subtracted where matching masters are available")
+
+    parser.add_argument("--method", action="store", choices=COMBINE_METHODS, default="median", help="how to combine frames: 'median', or 'sigclip' for a sigma-clipped mean. default is 'median'")
+    parser.add_argument("--sigma", action="store", type=float, default=3.0, help="clipping threshold in standard deviations for --method sigclip. default is 3")
+    parser.add_argument("-n", "--workers", action="store", type=int, default=1, help="number of processes to combine tiles with")
+    parser.add_argument("--tile_mb", action="store", type=float, default=64, help="approximate memory, in MB, that each worker uses for the tile it's combining. default is 64")
+    parser.add_argument("-o", "--overwrite", action="store_true", default=False, help="overwrite existing masters with the same names")
+
+    parser.add_argument("-c", "--config", action="store", default=CALIB_CONFIG, help="optional configuration path. not necessary for most use-cases")
+    parser.add_argument("-p", "--profile", action="store", default=None, help="profile in configuration file to use")
+
+    args = parser.parse_args()
+
+    do_bias, do_dark, do_flat = args.bias, args.dark, args.flat
+    if not (do_bias or do_dark or do_flat):
+        do_bias = do_dark = do_flat = True
+
+    calib_config = Config(os.path.abspath(args.config), compiled=True)
+    if args.profile is not None:
+        try:
+            calib_config.choose_profile(args.profile)
+        except Exception as e:
+            print(f"ERROR: Couldn't select profile {args.profile} from the config file at {calib_config}: {e}")
+            sys.exit(1)
+
+    output_dir = os.path.abspath(args.output_dir or calib_config["calib_path"])
+    os.makedirs(output_dir, exist_ok=True)
+    for table in ("biases", "darks", "flats"):
+        if calib_config[table]["regex"]:
+            print(f"ERROR: can't name masters with the regex pattern for {table} in the config - use a unix wildcard-style pattern")
+            sys.exit(1)
+
+    raw_dir = os.path.abspath(args.raw_calib_dir)
+    paths = sorted(os.path.join(raw_dir, f) for f in os.listdir(raw_dir) if f.lower().endswith((".fits", ".fit", ".fts")) and not f.startswith("."))
+    biases, darks, flats, headers = classify(paths)
+    print(f"Found {len(biases)} biases, {sum(len(v) for v in darks.values())} darks ({len(darks)} exposure times), and {sum(len(v) for v in flats.values())} flats ({len(flats)} filters) in {raw_dir}")
+
+    combine = lambda frames, **kwargs: combine_files(frames, method=args.method, sigma=args.sigma, tile_mb=args.tile_mb, workers=max(1, args.workers), **kwargs)
+
+    def write(name, data, header):
+        path = os.path.join(output_dir, name)
+        write_atomic(path, data, header, overwrite=args.overwrite)
+        print(f"Wrote {path}")
+
+    def existing(name):
+        path = os.path.join(output_dir, name)
+        return fits.getdata(path).astype(np.float32) if os.path.exists(path) else None
+
+    bias_name = calib_config["biases"]["pattern"]
+    master_bias = None
+    if do_bias:
+        if not biases:
+            print("ERROR: no biases to combine")
+            sys.exit(1)
+        print(f"Combining {len(biases)} biases")
+        master_bias = combine(biases)
+        write(bias_name, master_bias, master_header(biases, headers, "Master Bias", args.method))
+    elif do_dark or do_flat:
+        master_bias = existing(bias_name)
+
+    master_darks = {}
+    for exptime, frames in sorted(darks.items()):
+        dark_name = format_dark_name(calib_config, exptime)
+        if do_dark:
+            print(f"Combining {len(frames)} {exptime}s darks" + (" (bias-subtracted)" if master_bias is not None else ""))
+            master_darks[exptime] = combine(frames, offset=master_bias)
+            write(dark_name, master_darks[exptime], master_header(frames, headers, "Master Dark", args.method))
+
+    if do_flat:
+        for filt, frames in sorted(flats.items()):
+            exptimes = sorted(set(int(headers[path]["EXPTIME"]) for path in frames))
+            if len(exptimes) > 1:
+                print(f"ERROR: {filt} flats have more than one exposure time ({', '.join(str(e) for e in exptimes)}s) - combine them separately")
+                sys.exit(1)
+            offset = master_bias
+            dark = master_darks[exptimes[0]] if exptimes[0] in master_darks else existing(format_dark_name(calib_config, exptimes[0]))
+            if dark is not None:
+                offset = dark if offset is None else offset + dark
+            else:
+                print(f"Warning: no {exptimes[0]}s master dark for {filt} flats - they will not be dark-subtracted")
+            print(f"Combining {len(frames)} {filt} flats")
+            scales = flat_medians(frames, offset)
+            master_flat = combine(frames, offset=offset, scales=scales)
+            master_flat /= np.median(master_flat)
+            write(format_flat_name(calib_config, filt), master_flat, master_header(frames, headers, "Master Flat", args.method))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,8 +15,10 @@ from astropy.nddata import CCDData
 import sys
 import six
 import shutil
+import tempfile
+import contextlib
+from multiprocessing import Pool
 sys.modules['astropy.extern.six'] = six
-import ccdproc
 from inspect import getsourcefile
 from os.path import abspath
 # displaying imports
@@ -26,9 +28,15 @@ from astropy.visualization.mpl_normalize import ImageNormalize
 
 from sagelib import Frame, get_user_config_path
 from sagelib.utils import Config, findAllIn
-from sagelib.image_utils import read_ccddata_ls, show_img
+from sagelib.image_utils import show_img
 from sagelib.calib import CALIB_CONFIG
 from sagelib.calib.utils import format_flat_name, format_dark_name
+from sagelib.calib.library import CalibrationLibrary
+from sagelib.calib.combine import stack_cube, stack_arrays, write_stack
+from sagelib.calib.alignment import ReferenceFeatures, AlignmentError, align_cube, aligned_name
+from sagelib.header_index import default_index
+from sagelib import discovery
+from sagelib.writer import AsyncWriter, Compression
 import sagelib.calib
 
 from os.path import join, abspath
@@ -43,25 +51,148 @@ import re
 warnings.filterwarnings("ignore", category=wcs.FITSFixedWarning)
 warnings.filterwarnings("ignore", category=utils.exceptions.AstropyDeprecationWarning)
 
-def _find_files(rootdir, pattern, recursive=False, regex=False):
-    paths = []
-    if regex:
-        match_all = "**/*" if recursive else "*"
-        paths = [str(p) for p in Path.glob(Path(rootdir),match_all) if not p.is_dir()]
-        paths = [p for p in paths if re.match(pattern,p)]
-    else:
-        pattern = "**/"+pattern if recursive else pattern
-        paths = [str(p) for p in Path.glob(Path(rootdir),pattern) if not p.is_dir()]
-    return paths
-
-def find_files(rootdir, pattern, recursive=False, regex=False):
+def find_files(rootdir, pattern, recursive=False, regex=False, cache=None):
     try:
-        return _find_files(rootdir,pattern,recursive,regex)
+        return discovery.find_files(rootdir,pattern,recursive,regex,cache=cache)
     except Exception as e:
         print(f"ERROR: {'recursive' if recursive else ''} path search with {'regex' if regex else ''} pattern '{pattern}' failed")
         print(repr(e))
         sys.exit(1)
 
+def _plane_nbytes(header):
+    # size of one float32 2D plane described by this header
+    return header.get("NAXIS1",0) * header.get("NAXIS2",0) * 4
+
+def load_master(path, in_memory, date_format_in, date_format_out):
+    """
+    Load a master calibration frame. If `in_memory`, its pixels are read once into a native float32 array. Otherwise they stay memory-mapped and are paged in from disk as they're used
+    """
+    master = Frame.from_fits(path, lazy=True, date_format_in=date_format_in, date_format_out=date_format_out)
+    if in_memory:
+        master.img = master.data.astype(np.float32)
+    return master
+
+def iter_units(inputs, recipes, slots=False):
+    """
+    Yield a (path, plane, tincrement, recipe, slot) unit of work for every frame to reduce, from a list of (path, header) pairs and the recipe (see :func:`calibrate_with`) for each. `plane` is the index of the frame within its cube, or None for 2D files. If `slots`, `slot` is (filter, n) for the nth frame of each filter, which is where the calibrated frame goes in that filter's alignment cube (see :func:`count_slots`). Otherwise it's None
+    """
+    counts = {}
+    def slot(header):
+        if not slots:
+            return None
+        filt = header["FILTER"]
+        counts[filt] = counts.get(filt, 0) + 1
+        return filt, counts[filt] - 1
+    for (path, header), recipe in zip(inputs, recipes):
+        if header["NAXIS"] == 3:
+            print(f"Slicing cube {path}")
+            for plane in range(header["NAXIS3"]):
+                yield path, plane, float(header["EXPTIME"]), recipe, slot(header)
+        else:
+            yield path, None, None, recipe, slot(header)
+
+def count_slots(inputs):
+    """
+    The shape of each filter's alignment cube: (number of frames, rows, cols), from the (path, header) inputs of :func:`iter_units`. Raises a ValueError if frames of one filter have different shapes
+    """
+    shapes = {}
+    for path, header in inputs:
+        n = header["NAXIS3"] if header["NAXIS"] == 3 else 1
+        filt, plane = header["FILTER"], (header["NAXIS2"], header["NAXIS1"])
+        count, shape = shapes.get(filt, (0, plane))
+        if shape != plane:
+            raise ValueError(f"Can't align {path} (shape {plane}) with the other {filt} frames (shape {shape})")
+        shapes[filt] = (count + n, plane)
+    return {filt: (count,) + plane for filt, (count, plane) in shapes.items()}
+
+def share_master(master, directory):
+    """
+    Get a picklable reference to a master frame that pool workers can use without each making their own copy: masters that were loaded into memory are saved as native float32 .npy files in `directory` that every worker memory-maps, sharing the same pages, and masters that were left memory-mapped are referenced by their fits file
+    """
+    if master is None:
+        return None
+    if not master.is_loaded:
+        return ("fits", str(master.savepath))
+    path = os.path.join(directory, f"{len(os.listdir(directory))}.npy")
+    np.save(path, master.img)
+    return ("npy", path)
+
+def _resolve_master(ref, date_format_in, date_format_out):
+    if ref is None or isinstance(ref, Frame):
+        return ref
+    kind, path = ref
+    if kind == "npy":
+        return Frame(np.load(path, mmap_mode="r"), name=os.path.basename(path), lazy=True)
+    return load_master(path, False, date_format_in, date_format_out)
+
+# per-process state for reduce_unit: masters, destinations, and the reused calibration buffer
+_worker_state = {}
+
+def init_worker(masters, destinations, date_format_in, date_format_out, writer=None, cubes=None):
+    """
+    Set up this process to run :func:`reduce_unit`. `masters` maps the keys used in recipes to Frames or to references from :func:`share_master`. If `writer` (a :class:`sagelib.writer.AsyncWriter`) is given, calibrated frames are queued on it instead of being written before the next frame is started. `cubes` maps filters to the (frames, rows, cols) arrays, or .npy files to memory-map, that calibrated frames with a slot are copied into for alignment
+    """
+    _worker_state.update(
+        masters={key: _resolve_master(ref, date_format_in, date_format_out) for key, ref in masters.items()},
+        destinations=destinations,
+        date_format_in=date_format_in,
+        date_format_out=date_format_out,
+        work=None,
+        writer=writer,
+        cubes={filt: np.load(cube, mmap_mode="r+") if isinstance(cube, str) else cube for filt, cube in (cubes or {}).items()},
+    )
+
+def reduce_unit(unit):
+    """
+    Read (or slice), calibrate, and write one frame from :func:`iter_units`, returning the calibrated frame's name and, if it has a slot in an alignment cube, a copy of its header (otherwise None)
+    """
+    path, plane, tincrement, recipe, slot = unit
+    state = _worker_state
+    frame = Frame.from_fits(path, lazy=True, date_format_in=state["date_format_in"], date_format_out=state["date_format_out"])
+    if plane is not None:
+        frame = frame.slice_at(plane, tincrement=tincrement)
+    work = state["work"]
+    if work is None or work.shape != frame.shape:
+        work = state["work"] = Frame(np.empty(frame.shape, dtype=np.float32), name="work")
+    calibrated = calibrate_with(frame, work, recipe, state["masters"])
+    for directory, ow, by_filter, compression in state["destinations"]:
+        subdir = calibrated.header["FILTER"] if by_filter else ""
+        calibrated.write_fits(os.path.join(directory,subdir,calibrated.name+".fits"),overwrite=ow,writer=state["writer"],compression=compression)
+    if slot is None:
+        return calibrated.name, None
+    filt, i = slot
+    state["cubes"][filt][i] = calibrated.img
+    return calibrated.name, calibrated.header.copy()
+
+def calibrate(frame, out, super_bias=None, super_dark=None, super_flat=None, bias_dark=None):
+    """
+    Calibrate `frame` into the preallocated Frame `out` and return `out`, named like the calibration steps that were applied to it. `bias_dark` is a precombined bias+dark (see :func:`sagelib.calib.library.CalibrationLibrary.bias_dark`) that replaces `super_bias` and `super_dark`
+    """
+    name = frame.name
+    if bias_dark is not None:
+        frame.subtract(bias_dark, out=out)
+        name = "db_"+name
+    elif super_bias is not None:
+        frame.subtract(super_bias, out=out)
+        name = "b_"+name
+    else:
+        np.copyto(out.img, frame.data)
+        out.header = frame.header
+    if super_dark is not None and bias_dark is None:
+        out -= super_dark
+        name = "d"+name
+    if super_flat is not None:
+        out -= super_flat
+        name = "f"+name
+    out.name = name
+    return out
+
+def calibrate_with(frame, out, recipe, masters):
+    """
+    :func:`calibrate` with the masters named in `recipe`, a dict that maps some of 'bias', 'dark', 'flat', and 'bias_dark' to keys in `masters`
+    """
+    return calibrate(frame, out, **{f"super_{kind}" if kind != "bias_dark" else kind: masters[key] for kind, key in recipe.items()})
+
 def main():
     parser = argparse.ArgumentParser(description="Perform slicing, calibration, and alignment on input fits files. If no operations are specified, all will be performed.")
     parser.add_argument("target_name", action="store", type=str,help="the name of the target. no spaces")
@@ -82,12 +213,14 @@ def main():
     parser.add_argument("-f", "--flat", action="store_true", help="perform flat fielding")
     parser.add_argument("-d", "--dark", action="store_true", help="perform dark subtraction")
     parser.add_argument("-b", "--bias", action="store_true", help="perform bias subtraction")
-    parser.add_argument("-a", "--align", action="store_true", help="perform alignment. will result in temporarily saving intermediate files. Will clear 'temp_align_dir' if it exists.")
+    parser.add_argument("-a", "--align", action="store_true", help="perform alignment. calibrated frames are aligned and stacked in memory (or memory-mapped, if they don't fit in the memory budget) without writing intermediate files, unless -i is given")
     parser.add_argument("-w", "--wcs", action="store_true", help="(NOT IMPLEMENTED) perform wcs solving")
 
     parser.add_argument("-o", "--overwrite", action="store_true", default=False, help="if output files with the same names in the same locations already exist, overwrite them. if this is not enabled, conflicting new/existing products will cause an error.")
     parser.add_argument("-i", "--intermediate", action="store_true", help="save intermediate files throughout process. will overwrite existing files that share the same name in the intermediate directory.")
 
+    parser.add_argument("--translation", action="store_true", default=False, help="align frames by translation only, with FFT phase correlation (much faster than matching stars, for sidereally tracked sequences). frames whose correlation peak is weak are aligned by matching stars instead")
+
     parser.add_argument("--ref_image_path", action="store", type=str,help="the path to the reference image to use for alignment. if not specified, will use the first image in the input directory")
 
     parser.add_argument("-v", "--visualize", action="store_true", default=True, help="show superstack when finished")
@@ -96,6 +229,22 @@ def main():
     
     parser.add_argument("-p", "--profile", action="store", default=None, help="profile in configuration file to use")
 
+    parser.add_argument("-n", "--workers", action="store", type=int, default=1, help="number of processes to calibrate and write frames with. master frames are shared between them, not copied. output is the same as with one worker")
+
+    parser.add_argument("--max_calib_age_days", action="store", type=float, default=None, help="only use master calibration frames taken within this many days of each frame. by default, the closest in time is used regardless of age")
+
+    parser.add_argument("--stack_tile_mb", action="store", type=float, default=256, help="approximate memory, in MB, that each worker uses while stacking aligned frames. stacks are built a block of rows at a time, so this bounds memory use no matter how many frames are stacked")
+
+    parser.add_argument("--write_threads", action="store", type=int, default=2, help="number of background threads that write calibrated frames while the next ones are calibrated (with one worker). 0 writes each frame before starting the next. default is 2")
+
+    parser.add_argument("--compress", action="store", choices=("none","rice","gzip","gzip2"), default="none", help="tile-compress output frames and stacks with RICE or GZIP. compressed files are read transparently by Frame.from_fits. default is 'none'")
+
+    parser.add_argument("--quantize_level", action="store", type=float, default=16, help="with --compress, quantize float pixels to this many levels per standard deviation of the background noise before compressing. 0 is lossless (gzip and gzip2 only). default is 16")
+
+    parser.add_argument("--cache_listing", action="store_true", default=False, help="cache the listing of sci_data_dir (in the user config folder, not the data directory) and reuse it on later runs while the directory is unchanged. speeds up finding files in very large directories")
+
+    parser.add_argument("-m", "--max_memory_mb", action="store", type=float, default=2048, help="approximate budget, in MB, for the pixel data held in memory at once: master frames, the frame being calibrated, and calibrated frames waiting to be written. frames are streamed one at a time (per worker), so this doesn't grow with the number of frames. masters that don't fit are memory-mapped from disk instead")
+
 
     args = parser.parse_args()
 
@@ -109,8 +258,18 @@ def main():
     overwrite = args.overwrite
     save_intermediate = args.intermediate
     ref_image_path = args.ref_image_path
+    translation = args.translation
     config_path = args.config  
     profile = args.profile
+    max_memory_mb = args.max_memory_mb
+    workers = max(1, args.workers)
+    max_calib_age_days = args.max_calib_age_days
+    stack_tile_mb = args.stack_tile_mb
+    try:
+        compression = Compression.from_name(args.compress, args.quantize_level)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
     
     visualize = args.visualize
 
@@ -141,7 +300,7 @@ def main():
     CALIB_ROOT = abspath(os.path.join(abspath(getsourcefile(lambda:0)),os.pardir))
     os.chdir(CALIB_ROOT)
 
-    calib_config = Config(config_path)  # config_path *can* be passed in by cmdline and defaults to CALIB_CONFIG if not provided
+    calib_config = Config(config_path, compiled=True)  # config_path *can* be passed in by cmdline and defaults to CALIB_CONFIG if not provided
     if profile is not None:
         try:
             calib_config.choose_profile(profile)
@@ -158,218 +317,203 @@ def main():
     # find the data to reduce
     data_cfg = calib_config["data"]
 
-    filenames = find_files(raw_data_dir,data_cfg["pattern"],data_cfg["recursive_search"],data_cfg["regex"])
+    filenames = find_files(raw_data_dir,data_cfg["pattern"],data_cfg["recursive_search"],data_cfg["regex"],cache=args.cache_listing)
     print(f"Found the following {len(filenames)} files to reduce: {', '.join(filenames)}")
 
-    frames = []
-    cubenames = []
-    # slice any cubes - into what directory should these go? should we then move non-cube data to that folder too before proceeding?
-    for f in filenames:
-        frame = Frame.from_fits(f, date_format_in=FITS_DATE_FMT_IN, date_format_out=FITS_DATE_FMT_OUT)
-        d = frame.img.ndim
+    # find the frames to reduce from the header index, which only reads the headers of files it hasn't seen (or that have changed). cubes are sliced plane-by-plane while streaming below
+    cubes, singles = [], []
+    for f, header in zip(filenames, default_index().scan(filenames)):
+        d = header["NAXIS"]
         if d > 2:
-            cubenames.append(f)
-            if do_slice:
-                if d == 3:
-                    print(f"Slicing cube {f}")
-                    sliced = frame.slice(tincrement=float(frame.header["EXPTIME"]))
-                    for sliced_frame in sliced:
-                        frames.append(sliced_frame)
-                        # p = raw_data_dir/Path(sliced_frame.name+".fits")
-                        # print(f"Saving {p}")
-                        # sliced_frame.write_fits(p)
-                        # del(sliced_frame)
-                else:
-                    raise ValueError("Can't reduce data that isn't 2 or 3 dimensional")
-
-
-    filenames = find_files(raw_data_dir,data_cfg["pattern"],data_cfg["recursive_search"],data_cfg["regex"])
-    filenames = [f for f in filenames if f not in cubenames] # we don't delete the cubes after we slice them so we need to be careful not to re-open them
-    filters = []
-    for f in filenames:
-        print(f"Opening {f}")
-        frame = Frame.from_fits(f, date_format_in=FITS_DATE_FMT_IN, date_format_out=FITS_DATE_FMT_OUT)
-        frames.append(frame)
-        filters.append(frame.header["FILTER"])
-    filters = list(set(filters))
-
-    if not frames:
+            if not do_slice:
+                continue
+            if d != 3:
+                raise ValueError("Can't reduce data that isn't 2 or 3 dimensional")
+            cubes.append((f, header))
+        else:
+            singles.append((f, header))
+    inputs = cubes + singles
+
+    if not inputs:
         print("No frames to process!")
         sys.exit(1)
 
-    reduced = []
-    if do_bias:
-        bias_cfg = calib_config["biases"]
-        biases = find_files(CALIB_PATH, bias_cfg["pattern"], bias_cfg["recursive_search"], bias_cfg["regex"])
-        if not biases:
-            print(f"ERROR: no biases found matching pattern '{bias_cfg['pattern']}'")
-            sys.exit(1)
-        if len(biases) > 1:
-            print(f"ERROR: more than one bias found matching pattern '{bias_cfg['pattern']}'")
-            sys.exit(1)
-        bias_path = biases[0]
-        print("Subtracting superbias")
-        super_bias = Frame.from_fits(bias_path, date_format_in=FITS_DATE_FMT_IN, date_format_out=FITS_DATE_FMT_OUT)
-        for i, frame in enumerate(frames):
-            reduced.append(frames[i]-super_bias)
-            reduced[i].name = "b_"+frames[i].name
-        print("Bias subtracted")
-
-    if not reduced:
-        reduced = frames
-
-    # TODO: calibrate each unique exposure time separately?
-    # for now, all images must have the same exposure time!!!
-    exptime = int(reduced[0].header["EXPTIME"])
-
-    if do_dark:
-        dark_cfg = calib_config["darks"]
-        dark_pattern = format_dark_name(calib_config,exptime)
-        darks = find_files(CALIB_PATH, dark_pattern, dark_cfg["recursive_search"], dark_cfg["regex"])
-        if not darks:
-            print(f"ERROR: no darks found matching pattern '{dark_pattern}'")
-            sys.exit(1)
-        if len(darks) > 1:
-            print(f"ERROR: more than one dark found matching pattern '{dark_pattern}'")
-            sys.exit(1)
-        dark_path = darks[0]
-  
-        super_dark = Frame.from_fits(dark_path, date_format_in=FITS_DATE_FMT_IN, date_format_out=FITS_DATE_FMT_OUT)
-
-        print("Subtracting superdark")
-        for i, frame in enumerate(reduced):
-            reduced[i] = reduced[i] - super_dark
-            reduced[i].name = "d"+reduced[i].name
-        print("Subtracted")
-
-    if not reduced:
-        reduced = frames
-
-    if do_flat:
-        print("Loading superflats")
-        superflats = {}
-        flat_cfg = calib_config["flats"]
-        for filt in filters:
-            flat_pattern = format_flat_name(calib_config,filt)
-            flats = find_files(CALIB_PATH, flat_pattern, flat_cfg["recursive_search"], flat_cfg["regex"])
-            if not flats:
-                print(f"ERROR: no flats found matching pattern '{flat_pattern}'")
+    filters = sorted(set(header["FILTER"] for _, header in inputs))
+
+    # pick the best masters for each input from the calibration library
+    library = CalibrationLibrary(CALIB_PATH, calib_config, date_format_in=FITS_DATE_FMT_IN, max_age_days=max_calib_age_days, max_cache_mb=max_memory_mb)
+    print(library)
+    steps = [kind for kind, enabled in (("bias",do_bias),("dark",do_dark),("flat",do_flat)) if enabled]
+    selections = []
+    for path, header in inputs:
+        selected = {}
+        for kind in steps:
+            entry = library.select(kind, header)
+            if entry is None:
+                print(f"ERROR: no {kind} in {CALIB_PATH} matches {path} (filter {header.get('FILTER')}, exptime {header.get('EXPTIME')}, date {header.get('DATE-OBS')})")
                 sys.exit(1)
-            if len(flats) > 1:
-                print(f"ERROR: more than one flat found matching pattern '{flat_pattern}'")
-                sys.exit(1)
-            flat_path = flats[0]
-            superflats[filt] = Frame.from_fits(flat_path, date_format_in=FITS_DATE_FMT_IN, date_format_out=FITS_DATE_FMT_OUT)
-
-        print("Subtracting superflats")
-        for i, frame in enumerate(reduced):
-            reduced[i] = (frame-superflats[frame.header["FILTER"]])
-            reduced[i].name = "f"+frame.name
-        print("Subtracted")
+            selected[kind] = entry
+        selections.append(selected)
+
+    # masters are loaded once. any that don't fit in the memory budget (next to the frame each worker is calibrating) stay memory-mapped.
+    # when both bias and dark are subtracted, they're precombined so that each frame only needs one pass
+    budget_bytes = max_memory_mb*1024*1024
+    # with one worker, calibrated frames are written by background threads. up to 2 per thread can be waiting, each a copy of a frame
+    write_threads = max(0, args.write_threads) if workers == 1 else 0
+    write_queue = 2*write_threads
+    used_bytes = (workers + write_queue) * max(_plane_nbytes(header) for _, header in inputs)
+    masters = {}
+    def use(key, nbytes, load, path=None):
+        nonlocal used_bytes
+        if key not in masters:
+            if used_bytes + nbytes <= budget_bytes:
+                used_bytes += nbytes
+                masters[key] = load()
+            elif path is not None:
+                print(f"Memory budget of {max_memory_mb} MB exceeded - {path} will be memory-mapped instead of loaded")
+                masters[key] = load_master(path, False, FITS_DATE_FMT_IN, FITS_DATE_FMT_OUT)
+            else:
+                return None
+            print(f"Using master {key}")
+        return key
+
+    recipes = []
+    for selected in selections:
+        recipe = {}
+        bias, dark = selected.get("bias"), selected.get("dark")
+        if bias and dark and use(f"{bias.path}+{dark.path}", bias.nbytes, lambda: library.bias_dark(bias, dark)):
+            recipe["bias_dark"] = f"{bias.path}+{dark.path}"
+            del selected["bias"], selected["dark"]
+        for kind, entry in selected.items():
+            recipe[kind] = use(entry.path, entry.nbytes, lambda: library.load(entry), entry.path)
+        recipes.append(recipe)
+    library.clear_cache()  # everything we need is referenced by masters
 
-    if not reduced:
-        reduced = frames
     reduced_dir = os.path.join(raw_data_dir,"intermediate") if "intermediate" not in output_dir else os.path.join(raw_data_dir,"intermediate_temp")
-    intermediate_align_dir =  os.path.join(raw_data_dir,"temp_align_dir") if not save_intermediate else reduced_dir
-    # if we have steps left to do (alignment or wcs) and the user has asked us to save intermediate files, we do that here
-    if (save_intermediate and (do_wcs or do_align)):
-        if not os.path.exists(reduced_dir):
-            os.mkdir(reduced_dir)
 
-        for filt in filters:
-            if not os.path.exists(os.path.join(reduced_dir,filt)):
-                os.mkdir(os.path.join(reduced_dir,filt))
-        print("Saving reduced frames.")
-        for frame in reduced:
-            frame.write_fits(os.path.join(reduced_dir,frame.header["FILTER"],frame.name+".fits"),overwrite=overwrite)
-        print("Saved")
-    elif do_align and not save_intermediate:
-            print("Saving frames in preparation for alignment")
-            if os.path.exists(intermediate_align_dir):
-                shutil.rmtree(intermediate_align_dir)
-            os.mkdir(intermediate_align_dir)
-            for filt in filters:
-                if not os.path.exists(os.path.join(intermediate_align_dir,filt)): # getting wierd error where this already exists, don't know why
-                    os.mkdir(os.path.join(intermediate_align_dir,filt))
-            for frame in reduced:
-                frame.write_fits(os.path.join(intermediate_align_dir,frame.header["FILTER"],frame.name+".fits"))
-            print("Saved")
+    # where each calibrated frame is written: (directory, overwrite, whether to sort into per-filter subdirectories, compression)
+    destinations = []
+    if (save_intermediate and (do_wcs or do_align)):
+        # if we have steps left to do (alignment or wcs) and the user has asked us to save intermediate files, we do that here
+        destinations.append((reduced_dir, overwrite, True, compression))
+    if not do_align:
+        destinations.append((output_dir, False, False, compression))
 
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
+    for directory, _, by_filter, _ in destinations:
+        for filt in (filters if by_filter else []):
+            os.makedirs(os.path.join(directory,filt), exist_ok=True)
+
+    with contextlib.ExitStack() as cleanup:
+        # frames to align are calibrated straight into one (frames, rows, cols) cube per filter, which is aligned and stacked in place instead of being
+        # written out and read back. the cubes are kept in memory if they fit in the budget (with one worker), and otherwise memory-mapped from
+        # temporary .npy files that every worker maps
+        cubes = {}
+        if do_align:
+            try:
+                cube_shapes = count_slots(inputs)
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                sys.exit(1)
+            cube_bytes = sum(int(np.prod(shape))*4 for shape in cube_shapes.values())
+            if workers == 1 and used_bytes + cube_bytes <= budget_bytes:
+                cubes = {filt: np.empty(shape, dtype=np.float32) for filt, shape in cube_shapes.items()}
+            else:
+                cube_dir = cleanup.enter_context(tempfile.TemporaryDirectory(prefix=".align_", dir=output_dir))
+                print(f"Frames to align ({cube_bytes/1024**2:.0f} MB) don't fit in the memory budget" if workers == 1 else f"Sharing frames to align ({cube_bytes/1024**2:.0f} MB) with workers", f"- memory-mapping them from {cube_dir}")
+                for filt, shape in cube_shapes.items():
+                    cubes[filt] = os.path.join(cube_dir, f"{filt}.npy")
+                    np.lib.format.open_memmap(cubes[filt], mode="w+", dtype=np.float32, shape=shape).flush()
+
+        # stream: read (or slice) one frame, calibrate it into a reused buffer, write it (or put it in its alignment cube), move on. with workers, each does this for its share of the frames
+        print(f"Calibrating {'' if destinations else 'but not saving '}frames from {len(inputs)} files" + (f" with {workers} workers" if workers > 1 else ""))
+        names, headers = {}, {}
+        def collect(results, units):
+            # remember the name and header of each frame that has an alignment slot
+            for (name, header), unit in zip(results, units):
+                if unit[4] is not None:
+                    names[unit[4]], headers[unit[4]] = name, header
+        units = list(iter_units(inputs, recipes, slots=do_align))
+        if workers > 1:
+            with tempfile.TemporaryDirectory() as shared_dir:
+                share = lambda master: share_master(master, shared_dir)
+                initargs = ({key: share(master) for key, master in masters.items()}, destinations, FITS_DATE_FMT_IN, FITS_DATE_FMT_OUT, None, cubes)
+                with Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+                    collect(pool.imap(reduce_unit, units), units)
+        elif write_threads and destinations:
+            with AsyncWriter(threads=write_threads, max_queued=write_queue) as writer:
+                init_worker(masters, destinations, FITS_DATE_FMT_IN, FITS_DATE_FMT_OUT, writer, cubes)
+                collect(map(reduce_unit, units), units)
+        else:
+            init_worker(masters, destinations, FITS_DATE_FMT_IN, FITS_DATE_FMT_OUT, cubes=cubes)
+            collect(map(reduce_unit, units), units)
+        _worker_state.clear()  # drop this process's maps of the cubes
+        print(f"{'Saved' if destinations else 'Calibrated'} {len(units)} frames")
 
-    if do_wcs:
-        print("WCS solving is not yet implemented - skipping")
+        if do_wcs:
+            print("WCS solving is not yet implemented - skipping")
 
-    if not do_align:
-        print(f"Writing final output ({len(frames)} frames)")
-        for frame in reduced:
-            frame.write_fits(os.path.join(output_dir,frame.name+".fits"))
-        print("Saved")
-        sys.exit(0)
-
-    # if we haven't exited by this point, do alignment
-    import alipy
-    import glob
-
-    print("Aligning frames")
-    if not ref_image_path:
-        ref_image_path = os.path.join(intermediate_align_dir,filters[0],[f for f in os.listdir(os.path.join(intermediate_align_dir,filters[0])) if f.endswith("fits")][0])
-    stacks = []
-    for filt in filters:
-        images_to_align = sorted(glob.glob(os.path.join(intermediate_align_dir,filt,"*.fit*")))
-        print()
-        print("Aligning the following files:",images_to_align)
-        identifications = alipy.ident.run(ref_image_path, images_to_align, visu=False,verbose=False)
-
-        outputshape = alipy.align.shape(ref_image_path)
-
-        aligned_out = os.path.join(output_dir,filt+"_aligned")
-        if not os.path.exists(aligned_out):
-            os.mkdir(aligned_out)
-
-        for id in identifications:
-            if id.ok == True:
-                alipy.align.affineremap(id.ukn.filepath, id.trans, shape=outputshape, makepng=True,outdir=aligned_out,verbose=False)
-
-        aligned_ls = findAllIn(data_dir = aligned_out, file_matching='fdb_*.fits')
-
-        # running ccdproc.combine() + saving resulting image
-        aligned_slices = read_ccddata_ls(aligned_ls, aligned_out)
-
-        result_img = ccdproc.combine(aligned_slices,
-                                method='average',
-                                sigma_clip=True, sigma_clip_low_thresh=3, sigma_clip_high_thresh=3,
-                                sigma_clip_func=np.ma.average)
-        result_img.meta['combined'] = True
-        result_img.write(output_dir/Path(f'combined_{target_name}_{filt}.fits'),overwrite=overwrite)
-        stacks.append(f'combined_{target_name}_{filt}.fits')
-
-    # make one superstack
-    stacked_images = read_ccddata_ls(stacks, output_dir)
-
-    super_stack = ccdproc.combine(stacked_images,
-                            method='average',
-                            sigma_clip=True, sigma_clip_low_thresh=3, sigma_clip_high_thresh=3,
-                            sigma_clip_func=np.ma.average)
-    super_stack.meta['combined'] = True
-    super_stack.meta['FILTER'] = "all"
-
-    super_stack.write(output_dir/Path(f'{target_name}_superstack.fits'),overwrite=overwrite)
-
-    super_stack = Frame.from_fits(output_dir/Path(f'{target_name}_superstack.fits'), date_format_in=FITS_DATE_FMT_IN, date_format_out=FITS_DATE_FMT_OUT)
-
-    # clean up after ourselves: if the user asked for alignment but not intermediate file saving, delete the intermediate files
-    if not save_intermediate:
-        print("Cleaning up intermediate files")
+        if not do_align:
+            sys.exit(0)
+
+        # if we haven't exited by this point, do alignment
+        print("Aligning frames")
         try:
-            for filt in filters:
-                os.remove(os.path.join(intermediate_align_dir,filt))
-            os.remove(os.path.join(intermediate_align_dir,"intermediate"))
-            print("Cleaned up") 
-        except:
-            print(f"Warning: unable to remove intermediate alignment files at {intermediate_align_dir}. They may have already been deleted or access may be restricted.")
-    
+            # the reference's stars and star patterns are found once, for every filter
+            if ref_image_path:
+                reference = ReferenceFeatures.from_fits(ref_image_path, translation=translation)
+            else:
+                first = cubes[filters[0]]
+                reference = ReferenceFeatures(np.load(first, mmap_mode="r")[0] if isinstance(first, str) else first[0], translation=translation)
+                print(f"Aligning to {names[(filters[0], 0)]}")
+        except AlignmentError as e:
+            print(f"ERROR: can't align to reference image {ref_image_path or names[(filters[0], 0)]}: {e}")
+            sys.exit(1)
+        stacks = []
+        for filt in filters:
+            n = cube_shapes[filt][0]
+            frame_names = [names[(filt, i)] for i in range(n)]
+            print()
+            print(f"Aligning {n} {filt} frames")
+            try:
+                transforms = align_cube(reference, cubes[filt], workers=workers, names=frame_names, translation=translation)
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                sys.exit(1)
+            aligned = [i for i, t in enumerate(transforms) if t is not None]
+            if len(aligned) < n:
+                print(f"Warning: {n-len(aligned)} {filt} frames couldn't be aligned and won't be stacked")
+            if not aligned:
+                print(f"Warning: no {filt} frames were aligned - skipping the {filt} stack")
+                continue
+
+            # the aligned frames are the only per-frame output: written from the cube in the background while it's stacked
+            aligned_out = os.path.join(output_dir,filt+"_aligned")
+            os.makedirs(aligned_out, exist_ok=True)
+            cube = np.load(cubes[filt], mmap_mode="r") if isinstance(cubes[filt], str) else cubes[filt]
+            with AsyncWriter(threads=max(1, write_threads), max_queued=max(1, write_queue)) as writer:
+                for i in aligned:
+                    header = headers[(filt, i)]
+                    header["HISTORY"] = f"Aligned to reference: {transforms[i]}"
+                    writer.submit(os.path.join(aligned_out, aligned_name(frame_names[i]+".fits")), cube[i], header, overwrite=True, compression=compression, copy=False)
+                # stack a block of rows at a time, straight from the aligned cube
+                stack, count, rejected = stack_cube(cubes[filt], tile_mb=stack_tile_mb, workers=workers)
+            write_stack(output_dir/Path(f'combined_{target_name}_{filt}.fits'), stack, count, rejected, header=headers[(filt, aligned[0])], overwrite=overwrite, compression=compression)
+            stacks.append(stack)
+            del cube
+
+    if not stacks:
+        print("ERROR: no frames could be aligned")
+        sys.exit(1)
+
+    # make one superstack from the per-filter stacks, which are already in memory
+    super_stack, count, rejected = stack_arrays(stacks)
+    header = fits.Header()
+    header["FILTER"] = "all"
+    write_stack(output_dir/Path(f'{target_name}_superstack.fits'), super_stack, count, rejected, header=header, overwrite=overwrite, compression=compression)
+    super_stack = Frame(super_stack, name=f"{target_name}_superstack", header=header)
+
     if visualize:
         show_img(super_stack.img,"Superstack")
     
@@ -1,6 +1,7 @@
 #! python
 
 from sagelib import Frame, FrameSet
+from sagelib.stats import batch_stats
 import argparse
 import numpy as np
 from sagelib.utils import findAllIn
@@ -14,6 +15,7 @@ def main():
     parser.add_argument("ref_image_output_path", type=str, help="Path to the reference image output file")
     parser.add_argument("--file_pattern", type=str, default="*fits", help="File pattern to match in the data directory. default is '*fits'")
     parser.add_argument("--max_mem_usage_mb", type=int, default=40000, help="Maximum memory usage in MB (default: 40000)")
+    parser.add_argument("-n", "--workers", type=int, default=4, help="Number of threads to compute frame means with (default: 4)")
 
     parser.add_argument("--show", action="store_true", default=False, help="Show the resulting reference image. Defaults to False")
     args = parser.parse_args()
@@ -25,11 +27,8 @@ def main():
 
     filenames = [os.path.join(data_dir,filename) for filename in findAllIn(data_dir,file_matching=args.file_pattern)]
 
-    avgs = np.array([])
-    with FrameSet(filenames, max_mem_usage_mb) as frames:
-        for frame in frames:
-            avgs = np.append(avgs, frame.mean)
-    series_mean = avgs.mean()
+    # per-frame means, computed a batch at a time by several threads while the next batch is read
+    series_mean = batch_stats(FrameSet(filenames, max_mem_usage_mb), workers=args.workers, median=None)["mean"].mean()
 
     ref_img = Frame.from_fits(ref_image_input_path,kwargs={"name":"Scaled Reference Image"})
     ref_img = (ref_img*series_mean/ref_img.mean)
@@ -0,0 +1,263 @@
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+
+from sagelib.header_index import HeaderIndex
+from sagelib.image_utils import image_hdu
+from sagelib.writer import write_atomic
+
+COMBINE_METHODS = ("median", "sigclip")
+STACK_METHODS = ("mean", "median")
+
+
+def _read_rows(path, r0, r1):
+    # read only rows r0:r1 of a 2D primary HDU. sections work for scaled (BZERO/BSCALE) data, which is what most raw frames are
+    with fits.open(path) as f:
+        return image_hdu(f).section[r0:r1, :]
+
+
+def _sigma_clip(block, sigma_low=3.0, sigma_high=3.0, maxiters=1, center="median"):
+    """Iteratively reject pixels more than `sigma_low` standard deviations below or `sigma_high` above the `center` ('median' or 'mean') of each (frames, rows, cols) block column, by setting them to NaN in `block`"""
+    center_func = np.nanmedian if center == "median" else np.nanmean
+    n_good = np.count_nonzero(~np.isnan(block), axis=0)
+    for _ in range(maxiters):
+        c = center_func(block, axis=0)
+        std = np.nanstd(block, axis=0)
+        dev = block - c
+        block[(dev < -sigma_low*std) | (dev > sigma_high*std)] = np.nan
+        n_now = np.count_nonzero(~np.isnan(block), axis=0)
+        if np.array_equal(n_now, n_good):
+            break
+        n_good = n_now
+
+
+def _combine_block(block, method="mean", clip=None):
+    """Combine a (frames, rows, cols) float32 block along its first axis with `method` ('mean' or 'median'), ignoring NaNs, after sigma clipping with the :func:`_sigma_clip` keyword arguments in `clip` if given. `block` is modified. Returns the combined rows, the number of pixels used for each, and the number that were rejected by clipping"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN columns
+        n_valid = np.count_nonzero(~np.isnan(block), axis=0)
+        if clip is not None:
+            _sigma_clip(block, **clip)
+        count = np.count_nonzero(~np.isnan(block), axis=0)
+        combined = np.nanmedian(block, axis=0) if method == "median" else np.nanmean(block, axis=0)
+    return combined.astype(np.float32), count.astype(np.uint16), (n_valid - count).astype(np.uint16)
+
+
+def _combine_tile(args):
+    paths, r0, r1, ncols, offset, scales, method, clip = args
+    block = np.empty((len(paths), r1-r0, ncols), dtype=np.float32)
+    for i, path in enumerate(paths):
+        block[i] = _read_rows(path, r0, r1)
+    if offset is not None:
+        block -= offset
+    if scales is not None:
+        block /= scales[:, None, None]
+    return (r0, r1) + _combine_block(block, method, clip)
+
+
+def _combine_tiled(paths, method, clip, offset=None, scales=None, tile_mb=64, workers=1):
+    # combine files a block of rows at a time, with each block of all inputs held by one worker. returns (combined, count, rejected)
+    if not paths:
+        raise ValueError("No files to combine")
+    # inputs are often temporary (like aligned frames), so their headers are read in parallel without being added to the persistent index
+    headers = HeaderIndex(persist=False).scan(paths)
+    shape = (headers[0]["NAXIS2"], headers[0]["NAXIS1"])
+    for path, h in zip(paths[1:], headers[1:]):
+        if (h["NAXIS2"], h["NAXIS1"]) != shape:
+            raise ValueError(f"Can't combine {path} (shape {(h['NAXIS2'], h['NAXIS1'])}) with images of shape {shape}")
+    if offset is not None:
+        offset = np.asarray(offset, dtype=np.float32)
+    if scales is not None:
+        scales = np.asarray(scales, dtype=np.float32)
+
+    rows_per_tile = int(max(1, min(shape[0], tile_mb*1024*1024 // (len(paths) * shape[1] * 4))))
+    tiles = [(paths, r0, min(r0+rows_per_tile, shape[0]), shape[1], offset[r0:r0+rows_per_tile] if offset is not None else None, scales, method, clip)
+             for r0 in range(0, shape[0], rows_per_tile)]
+
+    combined = np.empty(shape, dtype=np.float32)
+    count = np.empty(shape, dtype=np.uint16)
+    rejected = np.empty(shape, dtype=np.uint16)
+    def collect(results):
+        for r0, r1, rows, n, rej in results:
+            combined[r0:r1], count[r0:r1], rejected[r0:r1] = rows, n, rej
+    if workers > 1:
+        with Pool(workers) as pool:
+            collect(pool.imap_unordered(_combine_tile, tiles))
+    else:
+        collect(map(_combine_tile, tiles))
+    return combined, count, rejected
+
+
+def combine_files(paths, method="median", sigma=3.0, maxiters=5, offset=None, scales=None, tile_mb=64, workers=1):
+    """
+    Combine the 2D images in fits files `paths` pixel-by-pixel, reading them in blocks of rows so that memory use is bounded by `tile_mb` (per worker) instead of by the number of files. Input files are never fully loaded, only read a block of rows at a time.
+
+    :param paths: fits files to combine. must all have the same shape
+    :type paths: list[str]
+    :param method: 'median', or 'sigclip' for the mean after iterative sigma clipping around the median, defaults to 'median'
+    :type method: str, optional
+    :param sigma: clipping threshold, in standard deviations, for 'sigclip', defaults to 3.0
+    :type sigma: float, optional
+    :param maxiters: maximum number of clipping iterations for 'sigclip', defaults to 5
+    :type maxiters: int, optional
+    :param offset: image to subtract from every input before combining (for example, a master bias), defaults to None
+    :type offset: np.ndarray, optional
+    :param scales: one value per input to divide it by after subtracting `offset` (for example, each flat's median), defaults to None
+    :type scales: array-like, optional
+    :param tile_mb: approximate size in MB of the block of all inputs that each worker holds at once, defaults to 64
+    :type tile_mb: float, optional
+    :param workers: number of processes to combine tiles with, defaults to 1
+    :type workers: int, optional
+    :return: the combined float32 image
+    :rtype: np.ndarray
+    """
+    if method not in COMBINE_METHODS:
+        raise ValueError(f"Unknown combine method '{method}' - must be one of {COMBINE_METHODS}")
+    if method == "median":
+        combined, _, _ = _combine_tiled(paths, "median", None, offset, scales, tile_mb, workers)
+    else:
+        combined, _, _ = _combine_tiled(paths, "mean", dict(sigma_low=sigma, sigma_high=sigma, maxiters=maxiters, center="median"), offset, scales, tile_mb, workers)
+    return combined
+
+
+def stack_files(paths, method="mean", sigma_low:float|None=3.0, sigma_high:float|None=3.0, maxiters=1, center="mean", tile_mb=64, workers=1):
+    """
+    Stack aligned 2D images from fits files with a sigma-clipped mean or median, a block of rows at a time, so that memory use is bounded by `tile_mb` (per worker) no matter how many frames are stacked. NaN pixels (for example, outside the overlap of aligned frames) are ignored.
+
+    The defaults reproduce the ``ccdproc.combine(..., method='average', sigma_clip=True, sigma_clip_low_thresh=3, sigma_clip_high_thresh=3, sigma_clip_func=np.ma.average)`` call that this replaces: one round of clipping around the mean.
+
+    :param paths: fits files to stack. must all have the same shape
+    :type paths: list[str]
+    :param method: 'mean' or 'median' of the unrejected pixels, defaults to 'mean'
+    :type method: str, optional
+    :param sigma_low: reject pixels this many standard deviations below the center. if None (along with `sigma_high`), no clipping is done, defaults to 3.0
+    :type sigma_low: float | None, optional
+    :param sigma_high: reject pixels this many standard deviations above the center, defaults to 3.0
+    :type sigma_high: float | None, optional
+    :param maxiters: maximum rounds of clipping, defaults to 1
+    :type maxiters: int, optional
+    :param center: 'mean' or 'median' - what to clip around, defaults to 'mean'
+    :type center: str, optional
+    :param tile_mb: approximate size in MB of the block of all inputs that each worker holds at once, defaults to 64
+    :type tile_mb: float, optional
+    :param workers: number of processes to stack tiles with, defaults to 1
+    :type workers: int, optional
+    :return: the float32 stack, a uint16 map of the number of frames used for each pixel, and a uint16 map of the number of frames rejected for each pixel
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    return _combine_tiled(paths, *_stack_args(method, sigma_low, sigma_high, maxiters, center), tile_mb=tile_mb, workers=workers)
+
+
+def stack_arrays(arrays, method="mean", sigma_low:float|None=3.0, sigma_high:float|None=3.0, maxiters=1, center="mean"):
+    """
+    :func:`stack_files` for a few images that are already in memory (for example, per-filter stacks being combined into a superstack)
+    """
+    block = np.stack([np.asarray(a, dtype=np.float32) for a in arrays])
+    return _combine_block(block, *_stack_args(method, sigma_low, sigma_high, maxiters, center))
+
+
+def _stack_cube_tile(args):
+    cube, r0, r1, method, clip = args
+    if isinstance(cube, str):
+        cube = np.load(cube, mmap_mode="r")
+    block = np.array(cube[:, r0:r1], dtype=np.float32)
+    return (r0, r1) + _combine_block(block, method, clip)
+
+
+def stack_cube(cube, method="mean", sigma_low:float|None=3.0, sigma_high:float|None=3.0, maxiters=1, center="mean", tile_mb=64, workers=1):
+    """
+    :func:`stack_files` for images that are already in memory or memory-mapped, as the planes of a (frames, rows, cols) array, so they don't have to be written to fits files first. The cube is stacked a block of rows at a time, so only one block per worker is copied out of it at once
+
+    :param cube: the images to stack, or the path of a .npy file holding them, which is memory-mapped (by each worker, if `workers` > 1 - an in-memory cube is always stacked by this process)
+    :type cube: np.ndarray | str
+    :return: the float32 stack, a uint16 map of the number of frames used for each pixel, and a uint16 map of the number of frames rejected for each pixel
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    method, clip = _stack_args(method, sigma_low, sigma_high, maxiters, center)
+    source = cube
+    if isinstance(cube, str):
+        cube = np.load(cube, mmap_mode="r")
+    n, nrows, ncols = cube.shape
+    if n == 0:
+        raise ValueError("No images to stack")
+    rows_per_tile = int(max(1, min(nrows, tile_mb*1024*1024 // (n * ncols * 4))))
+    combined = np.empty((nrows, ncols), dtype=np.float32)
+    count = np.empty((nrows, ncols), dtype=np.uint16)
+    rejected = np.empty((nrows, ncols), dtype=np.uint16)
+    if workers > 1 and isinstance(source, str):
+        tiles = [(source, r0, min(r0+rows_per_tile, nrows), method, clip) for r0 in range(0, nrows, rows_per_tile)]
+        with Pool(workers) as pool:
+            results = list(pool.imap_unordered(_stack_cube_tile, tiles))
+    else:
+        results = map(_stack_cube_tile, ((cube, r0, min(r0+rows_per_tile, nrows), method, clip) for r0 in range(0, nrows, rows_per_tile)))
+    for r0, r1, rows, c, rej in results:
+        combined[r0:r1], count[r0:r1], rejected[r0:r1] = rows, c, rej
+    return combined, count, rejected
+
+
+def _stack_args(method, sigma_low, sigma_high, maxiters, center):
+    if method not in STACK_METHODS:
+        raise ValueError(f"Unknown stacking method '{method}' - must be one of {STACK_METHODS}")
+    if sigma_low is None and sigma_high is None:
+        return method, None
+    inf = float("inf")
+    return method, dict(sigma_low=inf if sigma_low is None else sigma_low, sigma_high=inf if sigma_high is None else sigma_high, maxiters=maxiters, center=center)
+
+
+def write_stack(path, stack, count, rejected, header=None, overwrite=False, compression=None):
+    """
+    Write the output of :func:`stack_files` or :func:`stack_arrays`: the stack to `path`, and the count and rejection maps next to it, with `_count` and `_rejected` added to its name. If `compression` (a :class:`sagelib.writer.Compression`) is given, all three are tile-compressed (the maps losslessly)
+    """
+    header = fits.Header() if header is None else header.copy()
+    for key in ("BZERO", "BSCALE", "BLANK"):
+        header.remove(key, ignore_missing=True)
+    header["COMBINED"] = True
+    header["NCOMBINE"] = (int((count.astype(np.int32) + rejected).max()), "max number of frames stacked per pixel")
+    write_atomic(path, stack, header, overwrite, compression)
+    root, ext = str(path).rsplit(".", 1)
+    write_atomic(f"{root}_count.{ext}", count, header, overwrite, compression)
+    write_atomic(f"{root}_rejected.{ext}", rejected, header, overwrite, compression)
+
+
+if __name__ == "__main__":
+    # benchmark stack_files against ccdproc.combine with the settings reduce uses
+    import os, sys, tempfile, time, tracemalloc, argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng()
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(args.frames):
+            path = os.path.join(tmp, f"{i}.fits")
+            fits.writeto(path, rng.normal(100, 10, (args.size, args.size)).astype(np.float32))
+            paths.append(path)
+
+        def run(label, func):
+            tracemalloc.start()
+            start = time.perf_counter()
+            result = func()
+            duration = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{label}: {duration:.2f} s, peak {peak/1024**2:.0f} MB")
+            return result
+
+        stack, count, rejected = run(f"stack_files ({args.workers} workers)", lambda: stack_files(paths, workers=args.workers))
+        try:
+            import six
+            sys.modules['astropy.extern.six'] = six
+            import ccdproc
+            from astropy.nddata import CCDData
+        except ImportError:
+            print("ccdproc isn't installed - can't compare")
+            sys.exit(0)
+        result = run("ccdproc.combine", lambda: ccdproc.combine([CCDData.read(p, unit="adu") for p in paths], method="average",
+                                                                sigma_clip=True, sigma_clip_low_thresh=3, sigma_clip_high_thresh=3,
+                                                                sigma_clip_func=np.ma.average))
+        print(f"max difference: {np.nanmax(np.abs(result.data - stack)):.3g}")
@@ -0,0 +1,273 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from sagelib import Frame
+from sagelib.image_utils import FITS_DATE_IN
+from sagelib.header_index import default_index
+from sagelib.discovery import walk_files
+
+MASTER_TYPES = ("bias", "dark", "flat")
+
+# config table that holds each master type's file pattern
+_CONFIG_TABLES = {"bias": "biases", "dark": "darks", "flat": "flats"}
+
+# values of the IMAGETYP/OBSTYPE header keyword for raw frames of each type. masters made by make_masters have "Master " prepended, which
+# is how a master's type is identified when its filename doesn't match the config's pattern (raw frames in calib_path are never indexed)
+_HEADER_TYPES = {"bias": ("bias", "bias frame", "zero"), "dark": ("dark", "dark frame"), "flat": ("flat", "flat field", "flat frame", "skyflat", "domeflat")}
+
+
+def _parse_date(value, date_format_in=FITS_DATE_IN):
+    if not value:
+        return None
+    try:
+        dt = datetime.strptime(value, date_format_in)
+    except ValueError:
+        try:
+            dt = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _binning(header):
+    return (int(header.get("XBINNING", header.get("CCDXBIN", 1))), int(header.get("YBINNING", header.get("CCDYBIN", 1))))
+
+
+def _pattern_regex(pattern, regex):
+    # turn a calib config pattern (unix wildcards or python regex, optionally with {filter} and {exptime}) into a regex with named groups
+    parts = re.split(r"(\{filter\}|\{exptime\})", pattern)
+    out = []
+    for part in parts:
+        if part == "{filter}":
+            out.append(r"(?P<filter>.+?)")
+        elif part == "{exptime}":
+            out.append(r"(?P<exptime>[0-9.]+)")
+        elif regex:
+            out.append(part)
+        else:
+            out.append("".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in part))
+    return re.compile("".join(out))
+
+
+@dataclass(frozen=True)
+class CalibEntry:
+    """One master calibration frame in a :class:`CalibrationLibrary`"""
+    path: str
+    kind: str
+    filter: str|None
+    exptime: float|None
+    binning: tuple
+    date: datetime|None
+    shape: tuple
+    mtime: float
+    size: int
+
+    @property
+    def nbytes(self):
+        """Size of this master's pixels as float32"""
+        return int(np.prod(self.shape)) * 4
+
+
+class CalibrationLibrary:
+    def __init__(self, calib_path:str, calib_config=None, date_format_in:str=FITS_DATE_IN, max_age_days:float|None=None, max_cache_mb:float=1024):
+        """An index of the master calibration frames (biases, darks, and flats) in `calib_path`, with an in-memory LRU cache of the masters it has loaded.
+
+        Masters are indexed by type, filter, exposure time, binning, and date. A master's type comes from matching its filename against the `pattern` of the matching table in `calib_config` (where `{filter}` and `{exptime}` also provide its filter and exposure time), or from an IMAGETYP/OBSTYPE header keyword like 'Master Flat' (as written by make_masters). The FILTER, EXPTIME, XBINNING/YBINNING, and DATE-OBS header keywords fill in the rest.
+
+        :func:`CalibrationLibrary.select` picks the best master for a frame's header: the one of the right type with the same binning (and the same filter, for flats, or exposure time, for darks) that was taken closest in time to the frame, within `max_age_days` if given. Selected masters are loaded with :func:`CalibrationLibrary.load`, which decodes each one into a float32 array once and keeps it until `max_cache_mb` is exceeded, so long-running processes don't re-read calibration files::
+
+        >>> library = CalibrationLibrary("/data/calib", Config(CALIB_CONFIG))
+        >>> flat = library.load(library.select("flat", frame.header))
+        >>> bias_dark = library.bias_dark(library.select("bias", frame.header), library.select("dark", frame.header))
+
+        :param calib_path: directory that contains the master frames. its subdirectories are searched for the types whose config table has `recursive_search` set (or for every type, if there's no `calib_config`)
+        :type calib_path: str
+        :param calib_config: calib config with `biases`, `darks`, and `flats` tables whose `pattern` and `regex` keys identify masters by filename. if None, only header keywords are used, defaults to None
+        :type calib_config: Config | dict, optional
+        :param date_format_in: datetime format of DATE-OBS in headers. ISO dates are also accepted, defaults to FITS_DATE_IN
+        :type date_format_in: str, optional
+        :param max_age_days: masters taken more than this many days from a frame aren't selected for it. masters and frames without dates always match. if None, any age is allowed, defaults to None
+        :type max_age_days: float | None, optional
+        :param max_cache_mb: size in MB of decoded masters to keep in memory, defaults to 1024
+        :type max_cache_mb: float, optional
+        """
+        self.calib_path = os.path.abspath(calib_path)
+        self.date_format_in = date_format_in
+        self.max_age = timedelta(days=max_age_days) if max_age_days is not None else None
+        self.max_cache_bytes = max_cache_mb*1024*1024
+        self._patterns = {}
+        self._recursive = dict.fromkeys(MASTER_TYPES, True)  # kind -> whether masters of that kind are found in subdirectories
+        if calib_config is not None:
+            for kind, table in _CONFIG_TABLES.items():
+                cfg = calib_config[table]
+                self._patterns[kind] = (_pattern_regex(cfg["pattern"], cfg["regex"]), cfg["regex"])
+                self._recursive[kind] = bool(cfg["recursive_search"])
+        self.entries = {}  # path -> CalibEntry
+        self._cache = OrderedDict()  # key -> Frame
+        self._cache_bytes = 0
+        self._lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        """Re-scan `calib_path`, only reading the headers of masters that are new or have changed since the last scan. Cached masters whose files changed or disappeared are dropped"""
+        found, changed = {}, []
+        for path in walk_files(self.calib_path, recursive=any(self._recursive.values())):
+            f = os.path.basename(path)
+            if f.startswith(".") or not f.lower().endswith((".fits", ".fit", ".fts")):
+                continue
+            stat = os.stat(path)
+            old = self.entries.get(path)
+            if old is not None and old.mtime == stat.st_mtime and old.size == stat.st_size:
+                found[path] = old
+            else:
+                changed.append((path, stat))
+        # headers of new and changed files come from the shared header index, which reads them in parallel (and only if it hasn't seen them)
+        for (path, stat), header in zip(changed, self._headers([path for path, _ in changed])):
+            entry = self._index(path, stat, header) if header is not None else None
+            if entry is not None:
+                found[path] = entry
+        with self._lock:
+            stale = [path for path, entry in self.entries.items() if found.get(path) != entry]
+            self.entries = found
+            for key in list(self._cache):
+                if any(path in key for path in stale):
+                    self._evict(key)
+
+    @staticmethod
+    def _headers(paths):
+        try:
+            return default_index().scan(paths)
+        except Exception:
+            # find the unreadable file(s) one at a time
+            headers = []
+            for path in paths:
+                try:
+                    headers.append(default_index().header(path))
+                except Exception as e:
+                    print(f"Warning: couldn't read header of {path}: {e}")
+                    headers.append(None)
+            return headers
+
+    def _index(self, path, stat, header):
+        kind, filt, exptime = None, None, None
+        # masters in subdirectories only count for the types that are searched recursively
+        kinds = MASTER_TYPES if os.path.dirname(path) == self.calib_path else [k for k in MASTER_TYPES if self._recursive[k]]
+        for k, (pattern, regex) in self._patterns.items():
+            if k not in kinds:
+                continue
+            m = pattern.search(path) if regex else pattern.fullmatch(os.path.basename(path))
+            if m:
+                kind = k
+                groups = m.groupdict()
+                filt = groups.get("filter")
+                exptime = float(groups["exptime"]) if groups.get("exptime") else None
+                break
+        if kind is None:
+            imtype = str(header.get("IMAGETYP", header.get("OBSTYPE", ""))).strip().lower()
+            if not imtype.startswith("master"):
+                return None
+            kind = next((k for k, names in _HEADER_TYPES.items() if imtype[len("master"):].strip() in names), None)
+            if kind not in kinds:
+                return None
+        if filt is None and "FILTER" in header:
+            filt = str(header["FILTER"])
+        if exptime is None and "EXPTIME" in header:
+            exptime = float(header["EXPTIME"])
+        shape = tuple(header.get(f"NAXIS{i}", 0) for i in range(header.get("NAXIS", 0), 0, -1))
+        return CalibEntry(path=path, kind=kind, filter=filt, exptime=exptime, binning=_binning(header),
+                          date=_parse_date(header.get("DATE-OBS"), self.date_format_in), shape=shape,
+                          mtime=stat.st_mtime, size=stat.st_size)
+
+    def find(self, kind:str, filter:str|None=None, exptime:float|None=None, binning:tuple|None=None):
+        """All indexed masters of type `kind` that match the given filter, exposure time (compared as whole seconds), and binning. Criteria that are None aren't checked"""
+        if kind not in MASTER_TYPES:
+            raise ValueError(f"Unknown master type '{kind}' - must be one of {MASTER_TYPES}")
+        return [e for e in self.entries.values() if e.kind == kind
+                and (filter is None or e.filter == str(filter))
+                and (exptime is None or (e.exptime is not None and int(e.exptime) == int(exptime)))
+                and (binning is None or e.binning == tuple(binning))]
+
+    def select(self, kind:str, header) -> CalibEntry|None:
+        """The best master of type `kind` for the frame with header `header`, or None if there isn't one. Flats must match the frame's filter and darks its exposure time; all must match its binning. Of those, the master closest in time to the frame (and within `max_age_days`) is chosen"""
+        candidates = self.find(kind,
+                               filter=header.get("FILTER") if kind == "flat" else None,
+                               exptime=header.get("EXPTIME") if kind == "dark" else None,
+                               binning=_binning(header))
+        date = _parse_date(header.get("DATE-OBS"), self.date_format_in)
+
+        def age(entry):
+            if date is None or entry.date is None:
+                return None
+            return abs(entry.date - date)
+
+        if self.max_age is not None:
+            candidates = [e for e in candidates if age(e) is None or age(e) <= self.max_age]
+        if not candidates:
+            return None
+        # dated masters closest in time first, then undated ones. ties are broken by path so the choice is deterministic
+        return min(candidates, key=lambda e: (age(e) is None, age(e) or timedelta(0), e.path))
+
+    def load(self, entry:CalibEntry) -> Frame:
+        """The master `entry` as a Frame with native float32 pixels, from the cache if it's been loaded before"""
+        key = (entry.path,)
+        with self._lock:
+            cached = self._get(key)
+            if cached is not None:
+                return cached
+        master = Frame.from_fits(entry.path, date_format_in=self.date_format_in)
+        master.img = master.data.astype(np.float32)
+        with self._lock:
+            self._put(key, master)
+        return master
+
+    def bias_dark(self, bias:CalibEntry, dark:CalibEntry) -> Frame:
+        """The sum of a master bias and a master dark, so both can be subtracted in one pass. Cached like :func:`CalibrationLibrary.load`. Equal to subtracting them one after the other up to float32 rounding"""
+        key = (bias.path, dark.path)
+        with self._lock:
+            cached = self._get(key)
+            if cached is not None:
+                return cached
+        combined = self.load(bias).add(self.load(dark))
+        combined.name = f"{combined.name}+{os.path.basename(dark.path)}"
+        with self._lock:
+            self._put(key, combined)
+        return combined
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    def _get(self, key):
+        frame = self._cache.get(key)
+        if frame is not None:
+            self._cache.move_to_end(key)
+        return frame
+
+    def _put(self, key, frame):
+        if key in self._cache:
+            self._evict(key)
+        self._cache[key] = frame
+        self._cache_bytes += frame.img.nbytes
+        # evict least-recently-used masters, but always keep the one just added
+        while self._cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+            self._evict(next(iter(self._cache)))
+
+    def _evict(self, key):
+        frame = self._cache.pop(key)
+        self._cache_bytes -= frame.img.nbytes
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        counts = {kind: len(self.find(kind)) for kind in MASTER_TYPES}
+        return f"CalibrationLibrary at {self.calib_path}: " + ", ".join(f"{n} {kind}" for kind, n in counts.items())
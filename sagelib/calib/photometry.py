@@ -1,11 +1,12 @@
 from sagelib import Frame
 from sagelib.calib.imanalysis import fwhm
 from photutils.utils import calc_total_error
-from photutils.aperture import CircularAperture, CircularAnnulus, aperture_photometry, ApertureStats
+from photutils.aperture import CircularAperture, CircularAnnulus
 from photutils.detection import DAOStarFinder
 from astropy.io import fits
 import numpy as np
-import sys, os, glob, time
+from scipy import sparse
+import sys, os, glob, time, warnings
 import pandas as pd
 from datetime import datetime
 from pathlib import Path
@@ -17,8 +18,14 @@ from astropy.table import QTable, vstack
 from astropy.nddata import CCDData
 from multiprocessing import Pool
 
+from sagelib.image_utils import image_hdu
+from sagelib.writer import write_atomic
+
+ERROR_MODES = ("image", "analytic")
+
 
 def add_err_img(filename,bkg_std_dev,effective_gain):
+    """Append an UNCERT extension holding the error image of `filename` to it, rewriting the file. :func:`photometry` doesn't need this anymore (it computes error images in memory, and can cache them with `error_cache_dir`), but still uses UNCERT extensions that were added by it"""
     with fits.open(filename, 'update') as hdu:
         if len(hdu) == 1:
             # print("Datatype:",hdu[0].data.dtype)
@@ -30,58 +37,168 @@ def add_err_img(filename,bkg_std_dev,effective_gain):
         else:
             print("Error image already exists in",filename," - not adding a new one")
 
-def _photometry(img_path, bkg_std_dev, effective_gain, all_apertures, all_annulus, phot_zp):
+def error_image(data, bkg_std_dev, effective_gain):
+    """
+    The per-pixel uncertainty of `data` from the CCD equation: the background noise `bkg_std_dev` and the Poisson noise of the (non-negative) signal, ``sqrt(bkg_std_dev**2 + max(data, 0)/effective_gain)``. The same as photutils' ``calc_total_error`` with a scalar gain, computed in place in one float64 array instead of several
+    """
+    err = np.maximum(data, 0, dtype=np.float64)
+    if effective_gain:
+        err /= effective_gain
+    else:
+        err[:] = 0  # as calc_total_error does, no source variance where the gain is 0
+    err += bkg_std_dev**2
+    return np.sqrt(err, out=err)
+
+
+def _cached_error_image(img_path, data, bkg_std_dev, effective_gain, cache_dir):
+    # the error image of img_path from cache_dir, if it was made from this version of the file with the same noise parameters. otherwise it's
+    # computed and saved there (as float32, like UNCERT extensions were), so later runs can reuse it
+    cache_path = os.path.join(cache_dir, os.path.splitext(os.path.basename(img_path))[0] + "_err.fits")
+    mtime_ns = os.stat(img_path).st_mtime_ns
+    if os.path.exists(cache_path):
+        try:
+            with fits.open(cache_path) as f:
+                h = f[0].header
+                if h.get("SRCMTIME") == str(mtime_ns) and h.get("BKGSTD") == bkg_std_dev and h.get("GAIN") == effective_gain and f[0].data.shape == data.shape:
+                    return f[0].data.astype(np.float64)
+        except OSError:
+            pass  # unreadable: replace it
+    err = error_image(data, bkg_std_dev, effective_gain)
+    header = fits.Header({"SRCMTIME": str(mtime_ns), "BKGSTD": bkg_std_dev, "GAIN": effective_gain})
+    header["SRCFILE"] = os.path.basename(img_path)
+    write_atomic(cache_path, err.astype(np.float32), header, overwrite=True)
+    return err
+
+
+class ApertureWeights:
+    """
+    The pixel weights of a fixed set of circular apertures (every position at every radius) and of one annulus around each position, computed once for images of one shape, so that photometry on each (aligned) image is a sparse matrix product and a masked median instead of rebuilding every aperture's mask per image. The weights are photutils' 'exact' overlap fractions, as ``aperture_photometry`` and ``area_overlap`` use, and the annulus pixels are those whose centers are in it, as ``ApertureStats`` uses for the median.
+    :param positions: (x, y) positions of the sources
+    :param radii: aperture radii, in pixels
+    :param ann_radius_inner: inner radius of the annulus, in pixels
+    :param ann_radius_outer: outer radius of the annulus, in pixels
+    :param shape: (rows, cols) shape of the images
+    """
+    def __init__(self, positions, radii, ann_radius_inner, ann_radius_outer, shape):
+        self.positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))
+        self.radii = list(radii)
+        self.shape = tuple(shape)
+        n_stars = len(self.positions)
+        rows, cols, weights = [], [], []
+        for ap_num, r in enumerate(self.radii):
+            for star, mask in enumerate(CircularAperture(self.positions, r=r).to_mask(method="exact")):
+                index, w = self._mask_pixels(mask)
+                rows.append(np.full(len(index), ap_num*n_stars + star, dtype=np.int64))
+                cols.append(index)
+                weights.append(w)
+        # row ap_num*n_stars + star holds the weights of the aperture of radius radii[ap_num] at positions[star]
+        self.matrix = sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))), shape=(len(self.radii)*n_stars, self.shape[0]*self.shape[1]))
+        # apertures entirely off the image have no area or sum (NaN), as area_overlap and aperture_photometry give them
+        self._outside = (np.diff(self.matrix.indptr) == 0).reshape(len(self.radii), n_stars)
+        self.areas = np.asarray(self.matrix.sum(axis=1)).reshape(len(self.radii), n_stars)
+        self.areas[self._outside] = np.nan
+
+        # annulus pixel indices, one row per source, padded with -1 to the longest
+        annuli = [self._mask_pixels(mask)[0] for mask in CircularAnnulus(self.positions, r_in=ann_radius_inner, r_out=ann_radius_outer).to_mask(method="center")]
+        self.annulus_index = np.full((n_stars, max([len(a) for a in annuli] + [1])), -1, dtype=np.int64)
+        for star, a in enumerate(annuli):
+            self.annulus_index[star, :len(a)] = a
+
+    def _mask_pixels(self, mask):
+        # flat indices and weights of the nonzero pixels of an ApertureMask that are inside the image
+        slices = mask.get_overlap_slices(self.shape)
+        if slices[0] is None:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        large, small = slices
+        w = mask.data[small]
+        y, x = np.nonzero(w)
+        index = (y + large[0].start)*self.shape[1] + x + large[1].start
+        return index.astype(np.int64), w[y, x]
+
+    def sums(self, flat):
+        """(radii, positions) array of the aperture sums of a flattened image (or other per-pixel quantity, like a variance image)"""
+        sums = (self.matrix @ flat).reshape(len(self.radii), len(self.positions))
+        sums[self._outside] = np.nan
+        return sums
+
+    def annulus_medians(self, flat):
+        """The median of each annulus of a flattened image, ignoring non-finite pixels (NaN where there are none)"""
+        values = flat[self.annulus_index]
+        values[(self.annulus_index < 0) | ~np.isfinite(values)] = np.nan
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN annuli
+            return np.nanmedian(values, axis=1)
+
+
+_phot_state = {}
+
+
+def _init_photometry(weights, bkg_std_dev, effective_gain, phot_zp, error, error_cache_dir):
+    _phot_state.update(weights=weights, bkg_std_dev=bkg_std_dev, effective_gain=effective_gain, phot_zp=phot_zp, error=error, error_cache_dir=error_cache_dir)
+
+
+def _photometry(img_path):
+    s = _phot_state
+    weights, bkg_std_dev, effective_gain, error = s["weights"], s["bkg_std_dev"], s["effective_gain"], s["error"]
     try:
-        add_err_img(img_path, bkg_std_dev, effective_gain)
+        # the file is only read: its pixels once, cast to float64 once, and, if it has one, the UNCERT extension made by add_err_img
         with fits.open(img_path) as im:
-            batch_phot_table = aperture_photometry(im[0].data.astype(np.float64), all_apertures, im[1].data.astype(np.float64))
-            
-            # This loops through all of the columns in the aperture_phot_table to reformat the output :
-            for col in batch_phot_table.colnames:
-                batch_phot_table[col].info.format = '%.8g'  # for consistent table output
-
-            # add timestamp + filter info
-            batch_phot_table['timestamp'] = im[0].header['DATE-OBS']
-            batch_phot_table['filter'] = im[0].header['FILTER']
-            annulus_stats = [ApertureStats(im[0].data, ann_ap) for ann_ap in all_annulus]
-            bkg_median = [stat.median for stat in annulus_stats]
-
-            #aperture_areas = []
-            for ap_num in range(len(all_apertures)):
-                # Name the new columns
-                aperture_sum_title = 'aperture_sum_' + str(ap_num)  # This is not written out, it is read it.  Others below are written out.
-                aperture_sum_err_title = 'aperture_sum_err_' + str(ap_num) 
-                skyflux_title = 'skyflux_' + str(ap_num)
-                objflux_title = 'objflux_' + str(ap_num)
-                mag_title = 'mag_' + str(ap_num)
-                magerr_title = 'mag_err_' + str(ap_num)
-
-                # annulus background calculations
-                # the following line used to have "img" (the ref img) instead of "im" (the current img), changed on 1/27/24
-                # changed from im[0] back to img
-                aperture_area = [ap.area_overlap(im[0].data.astype(np.float64)) for ap in all_apertures[ap_num]]
-
-                # compute background total_bkg & phot_bkgsub
-                total_bkg = [bkg_median[0][i] * aperture_area[i] for i in range(len(all_apertures[ap_num]))]        
-                phot_bkgsub = batch_phot_table[aperture_sum_title] - total_bkg
-                batch_phot_table[skyflux_title] = total_bkg
-                batch_phot_table[objflux_title] = phot_bkgsub
-                
-                # compute instrumental (uncalibrated) magnitude from aperture sum
-                mag = -2.5 * np.log10(phot_bkgsub) + phot_zp
-                batch_phot_table[mag_title] = mag
-                batch_phot_table[magerr_title] = 1.0875*(batch_phot_table[aperture_sum_err_title]/batch_phot_table[objflux_title])  
+            hdu = image_hdu(im)
+            data = hdu.data.astype(np.float64)
+            header = hdu.header.copy()
+            err = im["UNCERT"].data.astype(np.float64) if "UNCERT" in im else None
+        if data.shape != weights.shape:
+            raise ValueError(f"image shape {data.shape} doesn't match the reference's {weights.shape}")
+        flat = data.ravel()
+
+        # as with aperture_photometry, a non-finite pixel makes the sum of every aperture it has weight in non-finite
+        areas = weights.areas
+        sums = weights.sums(flat)
+
+        if error == "analytic":
+            # the CCD equation summed over each aperture: variance = area * bkg_std_dev**2 + max(sum, 0) / gain. the same as the error image
+            # summed over the aperture, except where pixels are negative, whose Poisson noise the error image counts as 0 instead of canceling
+            variance = areas*bkg_std_dev**2 + (np.maximum(sums, 0)/effective_gain if effective_gain else 0)
+        elif err is not None or s["error_cache_dir"] is not None:
+            if err is None:
+                err = _cached_error_image(img_path, data, bkg_std_dev, effective_gain, s["error_cache_dir"])
+            err = err.ravel()
+            variance = weights.sums(err*err)
+        else:
+            # the error image summed in quadrature over each aperture, without making it: the sum of bkg_std_dev**2 + max(data, 0)/gain
+            variance = areas*bkg_std_dev**2 + (weights.sums(np.maximum(flat, 0))/effective_gain if effective_gain else 0)
+        sum_errs = np.sqrt(variance)
+
+        # background from the first annulus' median, scaled by the area of each aperture that overlaps the image, then magnitudes at every radius at once
+        bkg_median = weights.annulus_medians(flat)
+        total_bkg = bkg_median*areas
+        phot_bkgsub = sums - total_bkg
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mags = -2.5*np.log10(phot_bkgsub) + s["phot_zp"]
+            mag_errs = 1.0875*(sum_errs/phot_bkgsub)
+
+        # the same columns, in the same order, as aperture_photometry's table with the sky, flux, and magnitude columns added
+        columns = {"id": np.arange(1, len(weights.positions) + 1), "xcenter": weights.positions[:, 0], "ycenter": weights.positions[:, 1]}
+        for ap_num in range(len(weights.radii)):
+            columns['aperture_sum_' + str(ap_num)] = sums[ap_num]
+            columns['aperture_sum_err_' + str(ap_num)] = sum_errs[ap_num]
+        columns['timestamp'] = header['DATE-OBS']
+        columns['filter'] = header['FILTER']
+        for ap_num in range(len(weights.radii)):
+            columns['skyflux_' + str(ap_num)] = total_bkg[ap_num]
+            columns['objflux_' + str(ap_num)] = phot_bkgsub[ap_num]
+            columns['mag_' + str(ap_num)] = mags[ap_num]
+            columns['mag_err_' + str(ap_num)] = mag_errs[ap_num]
         print(f"Completed photometry on {img_path}.")
-        return {img_path: batch_phot_table.to_pandas()}
+        return {img_path: pd.DataFrame(columns)}
     except Exception as e:
         print(f"Failed to do photometry on {img_path}. Error: {e}")
         return {img_path: None}
 
 
-
-def photometry(ref_img_path, img_paths, ap_radius, ann_radius_inner, ann_radius_outer, radii, output_csv_dir, output_csv_name, bkg_std_dev, stellar_fwhm=None, phot_zp=25, keep_brightest=10, effective_gain=0.8,detection_sigma=3):
+def photometry(ref_img_path, img_paths, ap_radius, ann_radius_inner, ann_radius_outer, radii, output_csv_dir, output_csv_name, bkg_std_dev, stellar_fwhm=None, phot_zp=25, keep_brightest=10, effective_gain=0.8,detection_sigma=3, error="image", error_cache_dir=None):
     """
-    Perform aperture photometry on a series of *aligned* images, using a reference image to find the positions of stars.
+    Perform aperture photometry on a series of *aligned* images, using a reference image to find the positions of stars. Images are only read, never modified.
     :param ref_img_path: path to reference image
     :param img_paths: list of paths to images to be photometered
     :param ap_radius: radius of aperture, in units of hwhm
@@ -96,7 +213,13 @@ def photometry(ref_img_path, img_paths, ap_radius, ann_radius_inner, ann_radius_
     :param keep_brightest: number of brightest stars to do photometry on, will ignore the rest
     :param effective_gain: effective gain of camera
     :param detection_sigma: number of sigma above background to use as detection threshold for source extraction
+    :param error: how aperture sum errors are found: 'image' sums an error image (see :func:`error_image`) computed in memory for each image (or read from its UNCERT extension, if :func:`add_err_img` added one), and 'analytic' applies the CCD equation to each aperture's sum and area, which needs no error image, defaults to 'image'
+    :param error_cache_dir: with `error`='image', save each image's error image in this directory (as <name>_err.fits) and reuse it on later runs while the image and noise parameters are unchanged, defaults to None (don't save them)
     """
+    if error not in ERROR_MODES:
+        raise ValueError(f"Unknown error mode '{error}' - must be one of {ERROR_MODES}")
+    if error_cache_dir is not None:
+        os.makedirs(error_cache_dir, exist_ok=True)
     assert os.path.exists(ref_img_path), f"Reference image {ref_img_path} does not exist."
     if not os.path.exists(output_csv_dir):
         os.mkdir(output_csv_dir)
@@ -104,18 +227,21 @@ def photometry(ref_img_path, img_paths, ap_radius, ann_radius_inner, ann_radius_
     ### SETUP ###
     # do the following setup once at the beginning: 
         # load reference frame
-        # add error image to reference frame, if it does not already have one
         # do stats on reference frame
         # find stars in reference frame
         # get positions of sources in reference frame, make list
         # make annuli and apertures
     start = time.perf_counter()
-    # add error img to reference img if it does not already have one:
-    add_err_img(ref_img_path, bkg_std_dev, effective_gain)
-    ref_frame = Frame.from_fits(ref_img_path)
+    # load reference image (once, read-only)
+    with fits.open(Path(ref_img_path)) as hdul:
+        hdu = image_hdu(hdul)
+        ref_detect = hdu.data.astype(np.float64)
+        ref_detect_header = hdu.header.copy()
 
     if stellar_fwhm is None:
         print("No stellar fwhm provided. Calculating stellar fwhm...")
+        # fwhm subtracts the background from the frame it's given, so give it a copy
+        ref_frame = Frame(ref_detect.astype(np.float32), name=os.path.basename(ref_img_path), header=ref_detect_header)
         stellar_fwhm = fwhm(ref_frame)["avg_fwhm"].value
         print(f"Average stellar fwhm calculated as {stellar_fwhm} pixels.")
 
@@ -126,13 +252,6 @@ def photometry(ref_img_path, img_paths, ap_radius, ann_radius_inner, ann_radius_
     ann_radius_outer *= hwhm
     radii = [r * hwhm for r in radii]
 
-    # load reference image
-    hdu = fits.open(Path(ref_img_path))
-    ref_detect = hdu[0].data.astype(np.float64)
-    ref_err = hdu[1].data.astype(np.float64)
-    ref_detect_header = hdu[0].header
-    hdu.close()
-
     # get stats for setting detection threshold
     stars_mean, stars_med, stars_sd = stats.sigma_clipped_stats(ref_detect, sigma=3.0, maxiters=3, std_ddof=1)
     print("mean, median, standard deviation: %5.3f / %5.3f / %5.3f" % (stars_mean, stars_med, stars_sd))
@@ -159,9 +278,8 @@ def photometry(ref_img_path, img_paths, ap_radius, ann_radius_inner, ann_radius_
     for i in range(len(sources)):
         positions.append((sources[x_colname][i], sources[y_colname][i]))
 
-    # make annuli and apertures
-    all_apertures = [CircularAperture(positions, r=r) for r in radii]
-    all_annulus = [CircularAnnulus(positions, r_in=ann_radius_inner, r_out=ann_radius_outer)]
+    # make the aperture and annulus weights once: every image is aligned to the reference, so they're the same for all of them
+    weights = ApertureWeights(positions, radii, ann_radius_inner, ann_radius_outer, ref_detect.shape)
 
     ### PHOTOMETRY ###
     # multiprocess the following for each image:
@@ -174,8 +292,9 @@ def photometry(ref_img_path, img_paths, ap_radius, ann_radius_inner, ann_radius_
     
     # do aperture photometry on each image
     print("Doing aperture photometry...")
-    with Pool() as pool:
-        df_dict = pool.starmap(_photometry, [(img_path, bkg_std_dev, effective_gain, all_apertures, all_annulus, phot_zp) for img_path in img_paths])
+    # the weights are sent to each worker once, not with every image
+    with Pool(initializer=_init_photometry, initargs=(weights, bkg_std_dev, effective_gain, phot_zp, error, error_cache_dir)) as pool:
+        df_dict = pool.map(_photometry, img_paths, chunksize=max(1, len(img_paths)//(4*(os.cpu_count() or 1))))
     # combine results into a csv
     failed = [k for d in df_dict for k, v in d.items() if v is None]
     print(f"Failed to do photometry on {len(failed)} images: {failed}")
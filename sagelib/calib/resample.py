@@ -0,0 +1,263 @@
+import os
+import time
+import threading
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+
+# how many transforms that have been used once are remembered, so that their maps are built and cached if they're used again
+MAX_SEEN_TRANSFORMS = 4096
+
+
+class WCSTransform:
+    def __init__(self, wcs, ref_wcs):
+        """The transform from pixel coordinates of an image with the celestial WCS `wcs` to pixel coordinates of a reference image with `ref_wcs` (both :class:`astropy.wcs.WCS`), for resampling an image onto the reference's grid with :class:`Resampler`"""
+        self.wcs = wcs
+        self.ref_wcs = ref_wcs
+        self.key = ("wcs", wcs.to_header_string(relax=True), ref_wcs.to_header_string(relax=True))
+
+    def source_coordinates(self, x, y):
+        """The (x, y) image pixel coordinates of the reference pixels (x, y)"""
+        return self.wcs.world_to_pixel(self.ref_wcs.pixel_to_world(x, y))
+
+
+def _transform_key(transform):
+    # what identifies a transform in the cache of coordinate maps: near-identical affine transforms (within ~1e-6 of a pixel over a frame) share one
+    if isinstance(transform, WCSTransform):
+        return transform.key
+    return ("affine",) + tuple(np.round(transform.params.ravel(), 9))
+
+
+def _source_xy(transform, r0, r1, ncols):
+    # (x, y) pixel coordinates in the input image of output rows r0:r1, as float64 arrays of shape (r1-r0, ncols)
+    y, x = np.mgrid[r0:r1, 0:ncols].astype(np.float64)
+    if isinstance(transform, WCSTransform):
+        sx, sy = transform.source_coordinates(x, y)
+        return np.asarray(sx, dtype=np.float64), np.asarray(sy, dtype=np.float64)
+    p = transform.inverse().params  # output (reference) -> input
+    return p[0, 0]*x + p[0, 1]*y + p[0, 2], p[1, 0]*x + p[1, 1]*y + p[1, 2]
+
+
+class _BilinearMap:
+    # for each output pixel: the flat index of the input pixel at the top left of the 4 it's interpolated between (-1 if it's outside the input),
+    # and its fractional offsets from that pixel
+    def __init__(self, sx, sy, in_shape):
+        ny, nx = in_shape
+        valid = (sx >= 0) & (sx <= nx-1) & (sy >= 0) & (sy <= ny-1)
+        # on the last row or column, interpolate from the one before, with an offset of 1
+        x0 = np.clip(np.floor(sx), 0, max(nx-2, 0))
+        y0 = np.clip(np.floor(sy), 0, max(ny-2, 0))
+        self.fx = (sx - x0).astype(np.float32)
+        self.fy = (sy - y0).astype(np.float32)
+        self.index = np.where(valid, y0*nx + x0, -1).astype(np.int32 if ny*nx < 2**31 else np.int64)
+        self.row_stride = nx
+        self.nbytes = self.fx.nbytes + self.fy.nbytes + self.index.nbytes
+
+    def rows(self, r0, r1):
+        m = object.__new__(_BilinearMap)
+        m.fx, m.fy, m.index, m.row_stride = self.fx[r0:r1], self.fy[r0:r1], self.index[r0:r1], self.row_stride
+        return m
+
+    def apply(self, flat, out, cval):
+        invalid = self.index < 0
+        index = np.where(invalid, 0, self.index)
+        top = flat.take(index)
+        right = flat.take(index + 1)
+        right -= top
+        right *= self.fx
+        top += right  # interpolated along the top row
+        bottom = flat.take(index + self.row_stride)
+        right = flat.take(index + self.row_stride + 1, out=right)
+        right -= bottom
+        right *= self.fx
+        bottom += right  # and along the bottom row
+        bottom -= top
+        bottom *= self.fy
+        np.add(top, bottom, out=out)
+        out[invalid] = cval
+
+
+class _SplineMap:
+    # for interpolation orders above 1: the (row, col) input coordinates of each output pixel, for ndimage.map_coordinates
+    def __init__(self, sx, sy, in_shape):
+        self.coords = np.stack([sy, sx]).astype(np.float32)
+        self.nbytes = self.coords.nbytes
+
+    def rows(self, r0, r1):
+        m = object.__new__(_SplineMap)
+        m.coords = self.coords[:, r0:r1]
+        return m
+
+    def apply(self, coefficients, out, cval, order):
+        ndimage.map_coordinates(coefficients, self.coords, output=out, order=order, cval=cval, prefilter=False)
+
+
+class Resampler:
+    def __init__(self, shape, order:int=1, tile_rows:int=256, cache_mb:float=256, workers:int|None=None, cval=np.nan):
+        """Resample batches of frames onto a reference's pixel grid of `shape` through affine (:class:`sagelib.calib.alignment.AffineTransform`, image -> reference) or WCS (:class:`WCSTransform`) transforms.
+
+        Each repeated transform's coordinate map (where in the input every output pixel comes from, as interpolation indices and weights) is computed once and kept, up to `cache_mb`, so repeated transforms (like the positions of a repeating dither pattern, or frames that share a WCS) don't recompute it. A map is only built and cached once its transform is used a second time (in the same batch or a later one), so frames whose transforms are all different (like star-matched ones) aren't slowed down by building maps that are never reused, and a map larger than `cache_mb` is never cached. Maps are cached for bilinear (and nearest-neighbor) interpolation, and for WCS transforms of any order, whose maps are expensive to compute. Maps that aren't cached are computed a block of `tile_rows` rows at a time, so memory use is bounded by the tile size (affine tiles without a cached map are resampled directly by ``ndimage.affine_transform``, which is faster than building a map that is used once). Tiles of every frame in a batch are resampled in parallel by `workers` threads (interpolation releases the GIL)::
+
+        >>> resampler = Resampler(ref_shape, order=1)
+        >>> aligned = resampler.resample_batch(cube, transforms, verbose=True)
+        Resampled 40 frames in 3.12 s (12.8 frames/s)
+
+        Order 1 (bilinear) interpolation matches ``ndimage.affine_transform(..., order=1)``, but from cached maps it's about twice as fast. Higher orders interpolate each frame's spline coefficients, which are computed once per frame (with NaNs set to 0 first, since they would spread through the whole frame otherwise).
+
+        :param shape: (rows, cols) of the output grid
+        :type shape: tuple
+        :param order: spline interpolation order, 0-5, defaults to 1 (bilinear)
+        :type order: int, optional
+        :param tile_rows: rows of output per unit of work, defaults to 256
+        :type tile_rows: int, optional
+        :param cache_mb: size in MB of coordinate maps to keep (12 bytes per output pixel for order 1, 8 for higher orders). 0 disables caching, defaults to 256
+        :type cache_mb: float, optional
+        :param workers: number of threads, defaults to None (one per CPU core)
+        :type workers: int | None, optional
+        :param cval: value of output pixels that come from outside the input, defaults to NaN (which stacking ignores)
+        """
+        if not 0 <= order <= 5:
+            raise ValueError(f"Interpolation order must be between 0 and 5, not {order}")
+        self.shape = tuple(shape)
+        self.order = order
+        self.tile_rows = max(1, tile_rows)
+        self.max_cache_bytes = cache_mb*1024*1024
+        self.workers = workers or os.cpu_count() or 1
+        self.cval = cval
+        self.frames_per_second = None  # of the last batch
+        self._cache = OrderedDict()  # (transform key, input shape) -> full-frame map
+        self._cache_bytes = 0
+        self._seen = OrderedDict()  # keys of transforms used once, whose maps haven't been built yet
+        self._map_bytes = self.shape[0]*self.shape[1]*(12 if order <= 1 else 8)
+        self._lock = threading.Lock()
+
+    def _make_map(self, transform, in_shape, r0, r1):
+        sx, sy = _source_xy(transform, r0, r1, self.shape[1])
+        if self.order == 0:
+            sx, sy = np.round(sx), np.round(sy)
+        return (_BilinearMap if self.order <= 1 else _SplineMap)(sx, sy, in_shape)
+
+    def _full_map(self, transform, in_shape, uses=1):
+        # the cached map of the whole output grid, computing (and caching) it if it isn't cached and the transform is used a second time (`uses`
+        # is how many frames of the current batch use it). None if caching is off, if the map wouldn't fit in the cache, or for affine
+        # transforms with orders above 1, which ndimage resamples faster from the transform than from a map
+        if self._map_bytes > self.max_cache_bytes or (self.order > 1 and not isinstance(transform, WCSTransform)):
+            return None
+        key = (_transform_key(transform), tuple(in_shape))
+        with self._lock:
+            m = self._cache.get(key)
+            if m is not None:
+                self._cache.move_to_end(key)
+                return m
+            if uses < 2 and self._seen.pop(key, None) is None:
+                # first use: remember it, but don't build a map that may never be reused
+                self._seen[key] = True
+                while len(self._seen) > MAX_SEEN_TRANSFORMS:
+                    self._seen.popitem(last=False)
+                return None
+        m = self._make_map(transform, in_shape, 0, self.shape[0])
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = m
+                self._cache_bytes += m.nbytes
+            # evict least-recently-used maps. the one just added fits, so it's kept
+            while self._cache_bytes > self.max_cache_bytes:
+                self._cache_bytes -= self._cache.popitem(last=False)[1].nbytes
+        return m
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._seen.clear()
+            self._cache_bytes = 0
+
+    def _source(self, frame, copy=False):
+        # what tiles of one frame are interpolated from: its pixels for order <= 1 (copied if `copy`, because they'll be overwritten), or its
+        # spline coefficients for higher orders
+        frame = np.asarray(frame, dtype=np.float32)
+        if self.order <= 1:
+            return np.array(frame) if copy else np.ascontiguousarray(frame)
+        return ndimage.spline_filter(np.nan_to_num(frame, nan=0.0), order=self.order, output=np.float32)
+
+    def _resample_tile(self, source, full_map, transform, out, r0, r1):
+        if full_map is None and not isinstance(transform, WCSTransform):
+            # without a cached map, an affine tile is fastest straight from ndimage, which computes coordinates as it goes
+            inverse = transform.inverse().params  # output (x, y) -> input (x, y)
+            matrix, offset = inverse[::-1, 1::-1], inverse[::-1, 2]
+            ndimage.affine_transform(source, matrix, offset + matrix[:, 0]*r0, output_shape=(r1-r0, self.shape[1]), output=out[r0:r1],
+                                     order=self.order, cval=self.cval, prefilter=False)
+            return
+        m = full_map.rows(r0, r1) if full_map is not None else self._make_map(transform, source.shape, r0, r1)
+        if self.order <= 1:
+            m.apply(source.ravel(), out[r0:r1], self.cval)
+        else:
+            m.apply(source, out[r0:r1], self.cval, self.order)
+
+    def resample_batch(self, frames, transforms, out=None, verbose:bool=False):
+        """
+        Resample each of `frames` onto the output grid through the matching transform in `transforms`
+
+        :param frames: (n, rows, cols) array, or a list of 2D frames (which may have different shapes)
+        :param transforms: one :class:`sagelib.calib.alignment.AffineTransform` (image -> reference) or :class:`WCSTransform` per frame
+        :param out: (n, *shape) float32 array to write the resampled frames into, which may be `frames` itself if the shapes match, defaults to None (a new array)
+        :param verbose: print the number of frames resampled per second, defaults to False
+        :return: `out`
+        :rtype: np.ndarray
+        """
+        if len(frames) != len(transforms):
+            raise ValueError(f"Got {len(frames)} frames but {len(transforms)} transforms")
+        start = time.perf_counter()
+        out = np.empty((len(frames),) + self.shape, dtype=np.float32) if out is None else out
+        with ThreadPoolExecutor(self.workers) as pool:
+            # read every frame (it may be resampled in place) and find every map before any tile is written
+            in_place = isinstance(frames, np.ndarray) and np.may_share_memory(frames, out)
+            sources = list(pool.map(lambda f: self._source(f, in_place), frames))
+            maps = [None]*len(frames)
+            if self.max_cache_bytes > 0:
+                # each distinct map is computed once, even if several frames in the batch need it
+                keys = [(_transform_key(t), np.shape(f)) for t, f in zip(transforms, frames)]
+                uses = Counter(keys)
+                distinct = {key: (t, key[1], uses[key]) for key, t in zip(keys, transforms)}
+                found = dict(zip(distinct, pool.map(lambda args: self._full_map(*args), distinct.values())))
+                maps = [found[key] for key in keys]
+            tiles = [(i, r0, min(r0+self.tile_rows, self.shape[0])) for i in range(len(frames)) for r0 in range(0, self.shape[0], self.tile_rows)]
+            list(pool.map(lambda t: self._resample_tile(sources[t[0]], maps[t[0]], transforms[t[0]], out[t[0]], t[1], t[2]), tiles))
+        elapsed = time.perf_counter() - start
+        self.frames_per_second = len(frames)/elapsed if elapsed > 0 else float("inf")
+        if verbose:
+            print(f"Resampled {len(frames)} frames in {elapsed:.2f} s ({self.frames_per_second:.1f} frames/s)")
+        return out
+
+    def resample(self, frame, transform, out=None):
+        """:func:`Resampler.resample_batch` for one frame. `out` is a float32 array of the output shape (not `frame` itself)"""
+        return self.resample_batch([frame], [transform], None if out is None else out[None])[0]
+
+
+if __name__ == "__main__":
+    # benchmark: per-frame ndimage.affine_transform vs. batched resampling with cached maps, on frames at the positions of a repeating dither pattern
+    import argparse
+    from sagelib.calib.alignment import AffineTransform, apply_transform
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=24)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--dithers", type=int, default=4, help="number of distinct positions in the dither pattern")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng()
+    frames = rng.normal(1000, 10, (args.frames, args.size, args.size)).astype(np.float32)
+    pattern = [AffineTransform([[np.cos(a), -np.sin(a), dx], [np.sin(a), np.cos(a), dy]])
+               for a, dx, dy in zip(rng.uniform(-0.002, 0.002, args.dithers), rng.uniform(-20, 20, args.dithers), rng.uniform(-20, 20, args.dithers))]
+    transforms = [pattern[i % args.dithers] for i in range(args.frames)]
+
+    for order in (1, 3):
+        start = time.perf_counter()
+        expected = [apply_transform(f, t, order=order) for f, t in zip(frames, transforms)]
+        print(f"apply_transform (order {order}): {args.frames/(time.perf_counter()-start):.1f} frames/s")
+        for cache_mb in (0, 1024):
+            resampler = Resampler((args.size, args.size), order=order, cache_mb=cache_mb, workers=args.workers)
+            resampled = resampler.resample_batch(frames, transforms)
+            both = np.isfinite(resampled) & np.isfinite(np.array(expected))
+            print(f"Resampler (order {order}, {'cached maps' if cache_mb else 'no cache'}): {resampler.frames_per_second:.1f} frames/s, max difference {np.max(np.abs(resampled - expected)[both]):.2g}")
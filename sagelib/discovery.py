@@ -0,0 +1,161 @@
+import os
+import re
+import json
+import sqlite3
+import fnmatch
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+class ListingCache:
+    def __init__(self, db_path:str|None=None):
+        """A persistent cache of directory listings, kept in an sqlite database (by default, listing_cache.db in the user config folder). A directory's cached listing is used as long as the directory's modification time is unchanged, which is the case until a file is added to, removed from, or renamed in it. Listings of subdirectories are cached separately, so a change deep in a tree only causes that directory to be re-listed
+
+        :param db_path: sqlite database to keep listings in, defaults to None (listing_cache.db in the user config folder)
+        :type db_path: str | None, optional
+        """
+        if db_path is None:
+            from sagelib import get_user_config_path
+            db_path = get_user_config_path("listing_cache.db")
+        self.db_path = db_path
+        with self._connect() as con:
+            # (v2: listings made before symlinked directories were skipped are in the old "listings" table, and aren't used)
+            con.execute('CREATE TABLE IF NOT EXISTS "listings_v2" (\n"directory"\tSTRING NOT NULL PRIMARY KEY,\n"mtime_ns"\tINTEGER NOT NULL,\n"files"\tSTRING NOT NULL,\n"dirs"\tSTRING NOT NULL\n)')
+
+    @contextmanager
+    def _connect(self):
+        # a new connection per use, so that listings can be looked up from any thread
+        con = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield con
+            con.commit()
+        finally:
+            con.close()
+
+    def get(self, directory, mtime_ns):
+        with self._connect() as con:
+            row = con.execute("SELECT files, dirs FROM listings_v2 WHERE directory = ? AND mtime_ns = ?", (directory, mtime_ns)).fetchone()
+        return None if row is None else (json.loads(row[0]), json.loads(row[1]))
+
+    def put(self, directory, mtime_ns, files, dirs):
+        with self._connect() as con:
+            con.execute("INSERT OR REPLACE INTO listings_v2 VALUES (?,?,?,?)", (directory, mtime_ns, json.dumps(files), json.dumps(dirs)))
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def default_cache() -> ListingCache:
+    """The process-wide :class:`ListingCache` backed by the default database"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ListingCache()
+    return _default_cache
+
+
+def _list_dir(directory, cache=None):
+    # (file names, subdirectory names) in `directory`, from one os.scandir, which gets entry types without a stat per entry. like pathlib's '**',
+    # symlinks to directories are neither files nor followed, so symlink loops can't make the walk repeat itself
+    if cache is not None:
+        mtime_ns = os.stat(directory).st_mtime_ns
+        cached = cache.get(directory, mtime_ns)
+        if cached is not None:
+            return cached
+    files, dirs = [], []
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+                is_link = is_dir and entry.is_symlink()
+            except OSError:
+                is_dir = is_link = False
+            if not is_link:
+                (dirs if is_dir else files).append(entry.name)
+    if cache is not None:
+        cache.put(directory, mtime_ns, files, dirs)
+    return files, dirs
+
+
+def walk_files(rootdir, recursive=False, workers=8, cache:ListingCache|bool|None=None):
+    """
+    Every file (anything that isn't a directory) in `rootdir`, and, if `recursive`, in its subdirectories, as paths joined to `rootdir`. Each level of subdirectories is listed in parallel by `workers` threads
+
+    :param cache: :class:`ListingCache` to use for directory listings, True for the default one, or None to always list directories, defaults to None
+    :type cache: ListingCache | bool | None, optional
+    :return: list of paths
+    :rtype: list[str]
+    """
+    if cache is True:
+        cache = default_cache()
+    cache = cache or None
+    rootdir = str(Path(rootdir))
+    paths = []
+    level = [rootdir]
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        while level:
+            listings = list(pool.map(lambda d: _list_dir(d, cache), level)) if len(level) > 1 else [_list_dir(level[0], cache)]
+            next_level = []
+            for directory, (files, dirs) in zip(level, listings):
+                paths.extend(os.path.join(directory, f) for f in files)
+                if recursive:
+                    next_level.extend(os.path.join(directory, d) for d in dirs)
+            level = next_level
+    return paths
+
+
+def find_files(rootdir, pattern, recursive=False, regex=False, include_hidden=True, workers=8, cache:ListingCache|bool|None=None):
+    """
+    Files in `rootdir` (and its subdirectories, if `recursive`) that match `pattern`, sorted. Directories are listed with os.scandir (in parallel, by `workers` threads) and matched against a pattern compiled once, instead of building and filtering Path objects
+
+    :param pattern: unix-style wildcard pattern matched against file names, or, if `regex`, a python regex matched (with re.match) against the whole path, as the calib config's data pattern is
+    :type pattern: str
+    :param include_hidden: whether wildcard patterns match names starting with '.', as pathlib's glob does. set to False to behave like glob.glob, defaults to True
+    :type include_hidden: bool, optional
+    :param cache: :class:`ListingCache` to use for directory listings, True for the default one, or None to always list directories, defaults to None
+    :type cache: ListingCache | bool | None, optional
+    :return: matching paths, joined to `rootdir`
+    :rtype: list[str]
+    """
+    if not regex and os.sep in pattern.rstrip(os.sep):
+        # patterns with directory parts are rare enough to leave to pathlib
+        pattern = "**/"+pattern if recursive else pattern
+        return sorted(str(p) for p in Path(rootdir).glob(pattern) if not p.is_dir())
+    if regex:
+        match = re.compile(pattern).match
+        return sorted(p for p in walk_files(rootdir, recursive, workers, cache) if match(p))
+    match = re.compile(fnmatch.translate(pattern)).match
+    hidden = pattern.startswith(".")
+    return sorted(p for p in walk_files(rootdir, recursive, workers, cache)
+                  if match(os.path.basename(p)) and (include_hidden or hidden or not os.path.basename(p).startswith(".")))
+
+
+if __name__ == "__main__":
+    # benchmark finding files in a large directory against the pathlib glob + re.match approach this replaces
+    import tempfile, time
+    n_files = 100000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i in range(n_files):
+            sub = os.path.join(tmpdir, str(i % 10))
+            if i < 10:
+                os.mkdir(sub)
+            open(os.path.join(sub, f"{i}.fits" if i % 2 else f"{i}.txt"), "w").close()
+        pattern = r"^[^\.].*\.fits$"
+
+        start = time.perf_counter()
+        old = [str(p) for p in Path.glob(Path(tmpdir), "**/*") if not p.is_dir()]
+        old = [p for p in old if re.match(pattern, p)]
+        print(f"pathlib glob + re.match: {time.perf_counter()-start:.2f} s ({len(old)} files)")
+
+        start = time.perf_counter()
+        new = find_files(tmpdir, pattern, recursive=True, regex=True)
+        print(f"find_files: {time.perf_counter()-start:.2f} s ({len(new)} files)")
+        assert sorted(old) == new
+
+        cache = ListingCache(os.path.join(tmpdir, "listings.db"))
+        find_files(tmpdir, pattern, recursive=True, regex=True, cache=cache)
+        start = time.perf_counter()
+        find_files(tmpdir, pattern, recursive=True, regex=True, cache=cache)
+        print(f"find_files (cached listing): {time.perf_counter()-start:.2f} s")
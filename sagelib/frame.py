@@ -10,6 +10,10 @@ from datetime import datetime, timedelta
 import os
 import glob
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
 
 from astropy.io import fits
 
@@ -22,7 +26,24 @@ import matplotlib.pyplot as plt
 from astropy.visualization import ZScaleInterval
 from astropy.visualization.mpl_normalize import ImageNormalize
 
-from sagelib.image_utils import show_img, FITS_DATE_IN, FITS_DATE_OUT
+from sagelib.image_utils import show_img, image_hdu, get_image_header, FITS_DATE_IN, FITS_DATE_OUT
+from sagelib.stats import frame_stats
+from sagelib.header_index import default_index
+from sagelib.writer import write_atomic
+
+def _read_fits(path):
+    # the image's header and data (see image_hdu), memory-mapping the data if possible. the map stays open after the file is closed as long as the data is referenced. tile-compressed data is decompressed
+    try:
+        with fits.open(path, memmap=True) as f:
+            hdu = image_hdu(f)
+            return hdu.header, hdu.data
+    except ValueError:  # scaled data (BZERO/BSCALE/BLANK) can't be memory-mapped
+        with fits.open(path, memmap=False) as f:
+            hdu = image_hdu(f)
+            return hdu.header, hdu.data
+
+def _read_fits_data(path):
+    return _read_fits(path)[1]
 
 # adapted from @Pei Qin
 def increment_date(strdate, tincrement, date_format_in=FITS_DATE_IN, date_format_out=FITS_DATE_OUT):
@@ -31,6 +52,28 @@ def increment_date(strdate, tincrement, date_format_in=FITS_DATE_IN, date_format
     incremented_dateobj = later.strftime(date_format_out)
     return incremented_dateobj
 
+def increment_dates(strdate, tincrements, date_format_in=FITS_DATE_IN, date_format_out=FITS_DATE_OUT):
+    """
+    :func:`increment_date` for many increments at once: `strdate` is only parsed once, and the results are formatted in one vectorized pass when `date_format_out` is an ISO-style format (like FITS_DATE_OUT, optionally followed by a literal suffix like '+00:00'). Returns a list of strings
+    """
+    parsed = datetime.strptime(strdate,date_format_in)
+    # timedelta rounds to the microsecond exactly like increment_date does
+    offsets = np.array([timedelta(seconds=float(t)) for t in np.ravel(tincrements)], dtype="timedelta64[us]")
+    iso_format = date_format_out.replace("%X","%H:%M:%S")
+    if iso_format.startswith("%Y-%m-%dT%H:%M:%S.%f") and "%" not in iso_format[len("%Y-%m-%dT%H:%M:%S.%f"):]:
+        suffix = iso_format[len("%Y-%m-%dT%H:%M:%S.%f"):]
+        stamps = np.datetime64(parsed.replace(tzinfo=None), "us") + offsets
+        return [stamp + suffix for stamp in np.datetime_as_string(stamps, unit="us")]
+    return [(parsed + timedelta(microseconds=int(o))).strftime(date_format_out) for o in offsets.astype(np.int64)]
+
+def _memmap_cube(path):
+    # memory-map a cube's raw (unscaled) data, returning it with its BSCALE and BZERO so planes can be scaled one at a time
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as f:
+        hdu = image_hdu(f)
+        if isinstance(hdu, fits.CompImageHDU):  # compressed cubes are decompressed (and scaled) instead
+            return hdu.data, 1, 0
+        return hdu.data, hdu.header.get("BSCALE", 1), hdu.header.get("BZERO", 0)
+
 
 def open_frames_in_chunks(filename_list,max_size_mb):
     """
@@ -52,48 +95,244 @@ def open_frames_in_chunks(filename_list,max_size_mb):
     yield current_chunk
 
 
+def plan_batches(filename_list, max_size_mb, index=None):
+    """
+    Group 2D fits files into batches of the same shape whose pixels, as float32, add up to at most max_size_mb (a file bigger than that gets a batch of its own). Files that aren't 2D (like cubes) each get a batch of their own, so they're loaded one at a time, as they were before batching. Shapes come from the header index, so files are only opened if they're new or have changed
+    @param max_size_mb: maximum size of batch in MB
+    @param index: :class:`sagelib.header_index.HeaderIndex` to look up headers in. defaults to the shared one
+    @return: generator of (shape, [(filename, indexed header), ...]) batches
+    """
+    max_size_bytes = max_size_mb*1024*1024
+    index = index or default_index()
+    current, current_shape, current_size = [], None, 0
+    for filename, header in zip(filename_list, index.scan(filename_list)):
+        shape = header.shape
+        if len(shape) != 2:
+            if current:
+                yield current_shape, current
+                current, current_shape, current_size = [], None, 0
+            yield shape, [(filename, header)]
+            continue
+        size = int(np.prod(shape))*4
+        if current and (shape != current_shape or current_size+size > max_size_bytes):
+            yield current_shape, current
+            current, current_size = [], 0
+        current.append((filename, header))
+        current_shape = shape
+        current_size += size
+    if current:
+        yield current_shape, current
+
+
+class FrameBatch:
+    def __init__(self, data, headers, filenames, stats=None):
+        """A batch of same-shape frames loaded by :class:`FrameSet`: `data` is a contiguous (frames, rows, cols) float32 array (or (1,)+shape, for a file that isn't 2D), with the header and filename of each frame in `headers` and `filenames`. `stats` is the FrameSet's cache of (mean, stdev, median) by filename (see :func:`sagelib.stats.batch_stats`), which is shared by all of its batches"""
+        self.data = data
+        self.headers = headers
+        self.filenames = filenames
+        self.stats = {} if stats is None else stats
+
+    @property
+    def names(self):
+        return [str(f).split(os.sep)[-1].replace(".fits",'').replace(".fit",'') for f in self.filenames]
+
+    def frames(self):
+        """The frames in this batch as :class:`Frame` objects whose pixels are views of `data`. Frames whose statistics are in `stats` start with them, so they aren't recomputed"""
+        frames = [Frame(img=self.data[i], name=name, header=header, savepath=filename) for i, (name, header, filename) in enumerate(zip(self.names, self.headers, self.filenames))]
+        for frame in frames:
+            if frame.savepath in self.stats:
+                frame._mean, frame._stdev, frame._median = self.stats[frame.savepath]
+        return frames
+
+    def __len__(self):
+        return len(self.filenames)
+
+
+_DONE = object()
+
 class FrameSet:
-    def __init__(self,filename_list,max_chunk_size_mb):
+    def __init__(self,filename_list,max_chunk_size_mb,prefetch=True):
+        """Iterate over the frames in the fits files `filename_list` in batches whose pixels take up at most `max_chunk_size_mb` MB. If `prefetch` is True, a background thread reads the next batch while the current one is being used, so reading overlaps with computation. Up to three batches can be in memory at once (the one being used, the next one, and the one being read)
+
+        As a context, gives a generator of :class:`Frame` objects, one per file::
+
+        >>> with FrameSet(filenames, 1000) as frames:
+        >>>     for frame in frames:
+        >>>         print(frame.name, frame.mean)
+
+        :func:`FrameSet.batches` instead gives each batch as a :class:`FrameBatch` with one contiguous 3D array, for vectorized work across frames::
+
+        >>> for batch in FrameSet(filenames, 1000).batches():
+        >>>     means = batch.data.mean(axis=(1,2))
+
+        Statistics computed by :func:`sagelib.stats.batch_stats` on a FrameSet are kept (by filename), and the :class:`Frame` objects it gives afterwards start with them instead of recomputing them
+        """
         self.filename_list = filename_list
         self.max_chunk_size_mb = max_chunk_size_mb
+        self.prefetch = prefetch
         self.frames = []
+        self.stats = {}  # filename -> (mean, stdev, median), shared with every FrameBatch
+        self._stop = threading.Event()
+
+    def batches(self):
+        """Generator of :class:`FrameBatch` objects covering every file, in order"""
+        loads = (self._load(shape, entries, self.stats) for shape, entries in plan_batches(self.filename_list, self.max_chunk_size_mb))
+        if not self.prefetch:
+            yield from loads
+            return
+        q = queue.Queue(maxsize=1)
+        stop = self._stop = threading.Event()
+
+        def put(item):
+            # give up if the consumer has stopped, so this thread never blocks forever on a full queue
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for batch in loads:
+                    if not put(batch):
+                        return
+                put(_DONE)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=worker, name="FrameSet-prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    @staticmethod
+    def _load(shape, entries, stats):
+        # full headers are read along with the pixels, from the same open file
+        data = np.empty((len(entries),)+shape, dtype=np.float32)
+        headers = []
+        for i, (filename, _) in enumerate(entries):
+            header, data[i] = _read_fits(filename)
+            headers.append(header)
+        return FrameBatch(data, headers, [filename for filename, _ in entries], stats)
+
     def __enter__(self):
-        self.chunks = open_frames_in_chunks(self.filename_list, max_size_mb=self.max_chunk_size_mb)
-        self.chunk_generator = (Frame.from_fits(filename) for chunk in self.chunks for filename in chunk)
+        self.chunk_generator = (frame for batch in self.batches() for frame in batch.frames())
         return self.chunk_generator
     
     def __exit__(self, exc_type, exc_value, traceback):
-        # for frame in self.frames:
-        #     frame.img = None
-        #     frame.header = None
-        # self.frames = []
-        # return False
-        pass
+        # stop prefetching if the caller didn't use every batch
+        self._stop.set()
+        self.chunk_generator.close()
+
+def _as_float32(img, native=True):
+    # img as native-endian float32, without a copy if it already is. with native=False (for data that is only written back out, which FITS stores
+    # big-endian anyway), float32 data in either byte order is used as-is
+    img = np.asanyarray(img)
+    if img.dtype.kind == "f" and img.dtype.itemsize == 4 and (img.dtype.isnative or not native):
+        return img
+    return img.astype(np.float32)
+
+def _as_float_operand(img):
+    # floating-point data as-is, anything else (integer data kept by lazy frames) as float32
+    return img if np.asanyarray(img).dtype.kind == "f" else _as_float32(img)
+
 
 class Frame:
-    def __init__(self, img, name, header=None, savepath=None,**kwargs) -> None:
-        self.img = img.astype(np.float32)
+    def __init__(self, img, name, header=None, savepath=None, lazy=False, **kwargs) -> None:
+        """An image (or cube of images) and its header.
+
+        If `lazy` is True, `img` is kept as it was given (for example, a memory-mapped array, or a callable that returns one) and is only converted to float32 the first time :py:attr:`img` is accessed, which should be treated as the 'write' access. Read-only access through :py:attr:`data`, :py:attr:`shape`, :py:attr:`ndim`, the statistics properties, arithmetic, and :func:`write_fits` never converts the stored array."""
+        self._data = None  # pixel data as loaded, not yet converted. only used by lazy frames
+        self._loader = None
+        self._img = None
+        if lazy:
+            if callable(img):
+                self._loader = img
+            else:
+                self._data = img
+        else:
+            self._img = _as_float32(img)
         self.header = header
         self.name = name
+        self.savepath = savepath
         self.date_format_in = FITS_DATE_IN
         self.date_format_out = FITS_DATE_OUT
         for key, value in kwargs.items():
             setattr(self, key, value)
         self._median = self._mean = self._stdev = None
-    
+
     @classmethod
-    def from_fits(cls,path,name=None,**kwargs):
-        f = fits.open(Path(path))
-        img = f[0].data
-        header = f[0].header
-        f.close()
+    def from_fits(cls,path,name=None,lazy=False,**kwargs):
+        """Load a Frame from the primary HDU of a fits file, or from its compressed image extension if it was written tile-compressed (see :class:`sagelib.writer.Compression`).
+
+        If `lazy` is True, only the header is read now. The pixel data is memory-mapped the first time it is needed and is read from disk as it is used, so header-only access never reads pixels. Don't overwrite or delete the file while a lazy Frame that uses it is alive. Scaled (BZERO/BSCALE) data can't be memory-mapped, and is read in full when it is first needed."""
+        path = Path(path)
         name = name or str(path).split(os.sep)[-1].replace(".fits",'').replace(".fit",'')
+        if lazy:
+            header = get_image_header(path)
+            return cls(partial(_read_fits_data,path),name=name,header=header,savepath=path,lazy=True,**kwargs)
+        with fits.open(path, memmap=False) as f:
+            hdu = image_hdu(f)
+            img = hdu.data
+            header = hdu.header
         return cls(img,name=name,header=header,savepath=path,**kwargs)
 
-    def calc_stats(self):
-        self._median = np.median(self.img)
-        self._mean = np.mean(self.img)
-        self._stdev = np.std(self.img)
+    @property
+    def data(self):
+        """The pixel data, without converting it to float32. Don't write to this - use :py:attr:`img` instead"""
+        if self._img is not None:
+            return self._img
+        if self._data is None and self._loader is not None:
+            self._data = self._loader()
+            self._loader = None
+        return self._data
+
+    @property
+    def img(self):
+        """The pixel data as a float32 array that can be modified"""
+        if self._img is None:
+            self._img = _as_float32(self.data)
+            self._data = None
+        return self._img
+
+    @img.setter
+    def img(self, img):
+        self._img = _as_float32(img)
+        self._data = self._loader = None
+        self._median = self._mean = self._stdev = None
+
+    @property
+    def is_loaded(self):
+        """Whether this Frame's pixel data has been read or mapped into memory"""
+        return self._img is not None or self._data is not None
+
+    @property
+    def shape(self):
+        if not self.is_loaded and self.header is not None and "NAXIS" in self.header:
+            return tuple(self.header[f"NAXIS{i}"] for i in range(self.header["NAXIS"],0,-1))
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def calc_stats(self, median=None):
+        """Compute and cache this Frame's mean, standard deviation (in one pass, see :func:`sagelib.stats.mean_std`), and median. `median` is 'exact', or 'histogram' or 'sample' for a faster approximation (see :func:`sagelib.stats.approx_median`). By default it's 'exact', except for lazy frames whose data hasn't been converted: those use 'histogram', which reads the memory-mapped data a chunk at a time instead of copying all of it to partition it, with an error of at most the data's range / (2 * 4096**4)"""
+        if median is None:
+            median = "exact" if self._img is not None else "histogram"
+        stats = frame_stats(self.data, median=median)
+        self._mean, self._stdev, self._median = stats["mean"], stats["std"], stats["median"]
     
     @property
     def median(self):
@@ -114,75 +353,152 @@ class Frame:
         return self._stdev
 
     def show(self):
-        show_img(self.img,title=self.name,titlesize=14)
+        show_img(self.data,title=self.name,titlesize=14)
     
+    def _apply(self, ufunc, other, out=None):
+        """Compute `ufunc(self, other)`. If `out` is given (a Frame or a float32 array the same shape as this Frame), the result is written into it instead of into a newly allocated array. Returns a Frame sharing this Frame's header"""
+        # integer data (as lazy frames keep it) is promoted to float32 before the ufunc, so the arithmetic is done in float32 as it is for loaded frames instead of overflowing
+        target = out.img if isinstance(out, Frame) else out  # first, so an in-place operation on a lazy frame converts it only once
+        data = _as_float_operand(self.data)
+        operand = _as_float_operand(other.data) if isinstance(other, Frame) else other
+        if isinstance(out, Frame):
+            ufunc(data, operand, out=target)
+            out._median = out._mean = out._stdev = None
+            out.header = self.header
+            return out
+        return Frame(img=ufunc(data, operand, out=target), name=self.name, header=self.header)
+
+    def add(self, other, out=None):
+        """self + other, optionally into the preallocated `out` (see :func:`Frame._apply`)"""
+        return self._apply(np.add, other, out)
+
+    def subtract(self, other, out=None):
+        """self - other, optionally into the preallocated `out` (see :func:`Frame._apply`)"""
+        return self._apply(np.subtract, other, out)
+
+    def multiply(self, other, out=None):
+        """self * other, optionally into the preallocated `out` (see :func:`Frame._apply`)"""
+        if isinstance(other,Frame):
+            raise NotImplementedError("Multiplication of two Frames is not yet supported")
+        return self._apply(np.multiply, other, out)
+
+    def divide(self, other, out=None):
+        """self / other, optionally into the preallocated `out` (see :func:`Frame._apply`)"""
+        return self._apply(np.true_divide, other, out)
+
     def __add__(self,other):
-        data = self.img+other.img
-        f = Frame(img=data,name=self.name)
-        f.header = self.header
-        return f
+        return self.add(other)
     
     def __sub__(self,other):
-        data = self.img-other.img
-        f = Frame(img=data,name=self.name)
-        f.header = self.header
-        return f    
+        return self.subtract(other)
+
+    # in-place operators reuse this Frame's array (converting it to float32 first if it's lazy) and keep its header
+    def __iadd__(self,other):
+        return self.add(other, out=self)
+
+    def __isub__(self,other):
+        return self.subtract(other, out=self)
+
+    def __imul__(self,other):
+        return self.multiply(other, out=self)
+
+    def __itruediv__(self,other):
+        return self.divide(other, out=self)
     
     # largely lifted from @Pei Qin
     def slice(self, name_extension=None, tincrement=None):
         """
         Slice this cube into its constituent frames, returning the sliced frames in a list. This cube is unchanged.
         """
-        if self.img.ndim != 3:
+        frames = list(self.iter_slices(name_extension, tincrement))
+        print(f'Successfully sliced {self.name} into {len(frames)} frames.')
+        return frames
+
+    def iter_slices(self, name_extension=None, tincrement=None):
+        """
+        Like :func:`Frame.slice`, but yields the sliced frames one at a time. If this cube hasn't been loaded yet and came from a file, each plane is read from the file only when it's needed, so only one plane is held in memory at a time. See also :func:`Frame.view_cube`, which avoids making a Frame (and header copy) per plane.
+        """
+        if self.ndim != 3:
             raise ValueError("Incorrect number of dimensions to slice - must have exactly 3")
-        frames = []
+        dates = self._slice_dates(range(self.shape[0]), tincrement)
+        if not self.is_loaded and self.savepath is not None:
+            # read plane-by-plane. sections also work for scaled data, which can't be memory-mapped
+            with fits.open(self.savepath) as f:
+                for i in range(self.shape[0]):
+                    yield self._make_slice(i, image_hdu(f).section[i], name_extension, dates[i])
+        else:
+            for i, im in enumerate(self.data):
+                yield self._make_slice(i, im, name_extension, dates[i])
+
+    def slice_at(self, i, name_extension=None, tincrement=None):
+        """
+        Get only the `i`th (zero-indexed) frame of this cube, named and timestamped the same way as by :func:`Frame.slice`. If this cube hasn't been loaded yet and came from a file, only that plane is read.
+        """
+        if self.ndim != 3:
+            raise ValueError("Incorrect number of dimensions to slice - must have exactly 3")
+        if not self.is_loaded and self.savepath is not None:
+            with fits.open(self.savepath) as f:
+                im = image_hdu(f).section[i]
+        else:
+            im = self.data[i]
+        return self._make_slice(i, im, name_extension, self._slice_dates([i], tincrement)[0])
+
+    def view_cube(self, name_extension=None, tincrement=None):
+        """
+        Get a :class:`CubeView` of this cube: its planes as (zero-copy, where possible) arrays, with the names and DATE-OBS values that :func:`Frame.slice` would give them
+        """
+        return CubeView(self, name_extension, tincrement)
+
+    def _slice_dates(self, planes, tincrement):
+        # DATE-OBS of each of `planes`, or Nones if they can't be computed
+        planes = list(planes)
         try:
             start_time = self.header['DATE-OBS']
         except:
             start_time = None
+        if tincrement is None or start_time is None:
+            return [None] * len(planes)
+        return increment_dates(start_time, tincrement * np.asarray(planes), self.date_format_in, self.date_format_out)
+
+    def _slice_name(self, i, name_extension=None):
         if name_extension is None:
             name_extension = '_00'
-        for i, im in enumerate(self.img):
-            newName = self.name + name_extension + str(i+1)
-            if self.header:
-                newheader = self.header.copy()
-                if tincrement is not None and start_time is not None:
-                    newheader['DATE-OBS'] = increment_date(start_time, tincrement * i,self.date_format_in,self.date_format_out)
-            else:
-                newheader = fits.PrimaryHDU(do_not_scale_image_data=True, ignore_blank=True)
-            
-            frames.append(Frame(img=im,name=newName,header=newheader))
-        print(f'Successfully sliced {self.name} into {len(frames)} frames.')
-        return frames
+        return self.name + name_extension + str(i+1)
 
-    def write_fits(self,filename,overwrite=False):
-        fits.writeto(filename, self.img, header=self.header, overwrite=overwrite)
+    def _make_slice(self, i, im, name_extension=None, date=None):
+        if self.header:
+            newheader = self.header.copy()
+            if date is not None:
+                newheader['DATE-OBS'] = date
+        else:
+            newheader = fits.PrimaryHDU(do_not_scale_image_data=True, ignore_blank=True)
+        return Frame(img=im,name=self._slice_name(i, name_extension),header=newheader)
+
+    def write_fits(self,filename,overwrite=False,writer=None,compression=None):
+        """Write this Frame to `filename` as float32, atomically (see :func:`sagelib.writer.write_atomic`), and tile-compressed if `compression` (a :class:`sagelib.writer.Compression`) is given. If `writer` (a :class:`sagelib.writer.AsyncWriter`) is given, the write is queued on it instead and this returns as soon as the pixels have been copied"""
+        if writer is not None:
+            writer.submit(filename, _as_float32(self.data, native=False), self.header, overwrite, compression)
+        else:
+            write_atomic(filename, _as_float32(self.data, native=False), self.header, overwrite, compression)
     
     def __mul__(self,other):
-        if isinstance(other,Frame):
-            raise NotImplementedError("Multiplication of two Frames is not yet supported")
-        else:
-            return Frame(img=self.img*other, name=self.name, header=self.header)
+        return self.multiply(other)
     
     def __rmul__(other,self):
         return self*other
     
     def __truediv__(self,other):
-        if isinstance(other,Frame):
-            return Frame(img = self.img/other.img, name = self.name, header = self.header)
-        return Frame(img = self.img/other, name = self.name, header = self.header)
+        return self.divide(other)
     
     def __div__(self,other):
-        if isinstance(other,Frame):
-            return Frame(img = self.img/other.img, name = self.name, header = self.header)
-        return Frame(img = self.img/other, name = self.name, header = self.header)
+        return self.divide(other)
         
 
 
     def __str__(self):
         attrs = [
             f"Image {self.name}",
-            f"Shape: {self.img.shape}",
+            f"Shape: {self.shape}",
             f"Header: {bool(self.header)}",
             f"Median Pixel: {self.median}",
             f"Mean Pixel: {self.mean}",
@@ -193,3 +509,120 @@ class Frame:
 
     def __repr__(self) -> str:
         return f"Frame {self.name}"
+
+
+
+class CubeView:
+    def __init__(self, cube:Frame, name_extension=None, tincrement=None):
+        """A read-only, plane-by-plane view of a 3D cube :class:`Frame`, for slicing cubes without holding them in memory or making a Frame per plane.
+
+        Indexing or iterating gives each plane as an array. If the cube hasn't been loaded, it is memory-mapped, and planes are zero-copy views of the file (scaled data is scaled one plane at a time). Plane names and DATE-OBS values (computed for every plane at once) match those given by :func:`Frame.slice`::
+
+        >>> cube = Frame.from_fits("cube.fits", lazy=True).view_cube(tincrement=exptime)
+        >>> for i, plane in enumerate(cube):
+        >>>     print(cube.names[i], cube.dates[i], plane.mean())
+        >>> paths = cube.write("sliced/", workers=8)
+
+        :param cube: the cube to view
+        :type cube: Frame
+        :param name_extension: added between the cube's name and the plane number in plane names, defaults to '_00'
+        :type name_extension: str, optional
+        :param tincrement: seconds between planes, used to compute each plane's DATE-OBS from the cube's. if None, planes keep the cube's DATE-OBS, defaults to None
+        :type tincrement: float, optional
+        """
+        if cube.ndim != 3:
+            raise ValueError("Incorrect number of dimensions to slice - must have exactly 3")
+        self.cube = cube
+        self._scale = None
+        if not cube.is_loaded and cube.savepath is not None:
+            raw, bscale, bzero = _memmap_cube(cube.savepath)
+            self._planes = raw
+            if bscale != 1 or bzero != 0:
+                self._scale = (bscale, bzero)
+        else:
+            self._planes = cube.data
+        self.names = [cube._slice_name(i, name_extension) for i in range(len(self))]
+        self.dates = cube._slice_dates(range(len(self)), tincrement)
+
+    def __len__(self):
+        return self._planes.shape[0]
+
+    def __getitem__(self, i):
+        plane = self._planes[i]
+        if self._scale is not None:
+            bscale, bzero = self._scale
+            plane = plane.astype(np.float32)
+            plane *= bscale
+            plane += bzero
+        return plane
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def frame(self, i) -> Frame:
+        """Plane `i` as a Frame, with its own copy of the header, like one of the Frames from :func:`Frame.slice`. Its pixels aren't copied until they're modified"""
+        return Frame(img=self[i], name=self.names[i], header=self.header_for(i), lazy=True)
+
+    def header_for(self, i):
+        """A copy of the cube's header with plane `i`'s DATE-OBS"""
+        header = self.cube.header.copy() if self.cube.header is not None else fits.Header()
+        if self.dates[i] is not None:
+            header['DATE-OBS'] = self.dates[i]
+        return header
+
+    def write(self, directory, workers=4, overwrite=False, planes=None, compression=None):
+        """
+        Write planes (all of them, or the indices in `planes`) to `directory` as float32 fits files named like the plane names (tile-compressed, if `compression` is given), using `workers` threads. Each thread reuses one copy of the header, only changing DATE-OBS, instead of copying it per plane. Returns the written paths, in plane order
+        """
+        planes = list(range(len(self))) if planes is None else list(planes)
+        paths = [os.path.join(directory, self.names[i]+".fits") for i in planes]
+        workers = max(1, min(workers, len(planes)))
+        chunks = [list(zip(planes[w::workers], paths[w::workers])) for w in range(workers)]
+
+        def write_chunk(chunk):
+            header = self.header_for(chunk[0][0]) if chunk else None
+            for i, path in chunk:
+                if self.dates[i] is not None:
+                    header['DATE-OBS'] = self.dates[i]
+                write_atomic(path, _as_float32(self[i], native=False), header, overwrite, compression)
+
+        if workers == 1:
+            for chunk in chunks:
+                write_chunk(chunk)
+        else:
+            with ThreadPoolExecutor(workers) as pool:
+                for _ in pool.map(write_chunk, chunks):  # re-raises errors from writers
+                    pass
+        return paths
+
+if __name__ == "__main__":
+    # benchmark a bias - dark / flat calibration chain, allocating a new Frame per step vs in-place
+    import time, tracemalloc
+    shape = (4096,4096)
+    rng = np.random.default_rng()
+    raw = rng.normal(1000,10,shape).astype(np.float32)
+    bias = Frame(rng.normal(100,1,shape).astype(np.float32),"bias")
+    dark = Frame(rng.normal(10,1,shape).astype(np.float32),"dark")
+    flat = Frame(rng.normal(1,0.01,shape).astype(np.float32),"flat")
+
+    def chain():
+        frame = Frame(raw.copy(),"raw")
+        return ((frame - bias) - dark) / flat
+
+    def chain_inplace():
+        frame = Frame(raw.copy(),"raw")
+        frame -= bias
+        frame -= dark
+        frame /= flat
+        return frame
+
+    for label, func in (("new frame per step", chain), ("in-place", chain_inplace)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(5):
+            func()
+        duration = (time.perf_counter() - start)/5
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label}: {duration*1000:.1f} ms/frame, peak {peak/1024**2:.0f} MB ({peak/raw.nbytes:.1f}x frame size)")
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+
+from sagelib.image_utils import get_image_header
+
+# header keywords kept in the index. enough to plan reduction and match calibration frames (shape, filter, exposure time, date, type, and binning) without opening files
+INDEXED_KEYS = ("NAXIS", "NAXIS1", "NAXIS2", "NAXIS3", "FILTER", "EXPTIME", "DATE-OBS", "IMAGETYP", "OBSTYPE", "XBINNING", "YBINNING", "CCDXBIN", "CCDYBIN")
+
+_COLUMNS = ["path", "size", "mtime_ns"] + [k.replace("-", "_") for k in INDEXED_KEYS]
+
+_create_statement = f'CREATE TABLE IF NOT EXISTS "headers" (\n"path"\tSTRING NOT NULL PRIMARY KEY,\n"size"\tINTEGER NOT NULL,\n"mtime_ns"\tINTEGER NOT NULL,\n' + ",\n".join(f'"{c}"' for c in _COLUMNS[3:]) + "\n)"
+
+
+class IndexedHeader(dict):
+    """The indexed keywords of one file's primary header, plus its `path`, `size`, and `mtime_ns`. Keywords the header didn't have are missing, so this can stand in for a :class:`astropy.io.fits.Header` wherever only those keywords are used (``header["NAXIS"]``, ``header.get("FILTER")``)"""
+
+    @property
+    def shape(self):
+        return tuple(self[f"NAXIS{i}"] for i in range(self.get("NAXIS", 0), 0, -1))
+
+
+def _read_header(path, size, mtime_ns):
+    header = get_image_header(path)
+    record = IndexedHeader(path=path, size=size, mtime_ns=mtime_ns)
+    for key in INDEXED_KEYS:
+        if key in header:
+            value = header[key]
+            record[key] = value if isinstance(value, (str, int, float)) else str(value)
+    return record
+
+
+def _from_row(row):
+    record = IndexedHeader(path=row[0], size=row[1], mtime_ns=row[2])
+    for key, value in zip(INDEXED_KEYS, row[3:]):
+        if value is not None:
+            record[key] = value
+    return record
+
+
+def _to_row(record):
+    return [record["path"], record["size"], record["mtime_ns"]] + [record.get(key) for key in INDEXED_KEYS]
+
+
+class HeaderIndex:
+    def __init__(self, db_path:str|None=None, workers:int=8, persist:bool=True):
+        """A cache of the primary-header keywords in INDEXED_KEYS for fits files, so that work can be planned (which files are cubes, what filters and exposure times there are, what shape each batch is) without opening every file, and, after the first scan, without opening any.
+
+        Each file's entry is keyed by its absolute path and is only trusted while the file's size and modification time are unchanged. New and changed files are read (headers only) by `workers` threads. The index is kept in an sqlite database (by default, header_index.db in the user config folder) shared by every process that uses it::
+
+        >>> index = HeaderIndex()
+        >>> for header in index.scan(paths):
+        >>>     print(header["path"], header.shape, header.get("FILTER"))
+
+        :param db_path: sqlite database to keep the index in, defaults to None (header_index.db in the user config folder)
+        :type db_path: str | None, optional
+        :param workers: number of threads to read headers with, defaults to 8
+        :type workers: int, optional
+        :param persist: if False, nothing is read from or written to the database: headers are only remembered by this object, defaults to True
+        :type persist: bool, optional
+        """
+        if db_path is None and persist:
+            from sagelib import get_user_config_path  # sagelib's __init__ imports Frame, which uses this module
+            db_path = get_user_config_path("header_index.db")
+        self.db_path = db_path
+        self.persist = persist
+        self.workers = workers
+        self._records = {}  # path -> IndexedHeader, for files this object has seen
+        self._lock = threading.Lock()
+        if persist:
+            with self._connect() as con:
+                con.execute(_create_statement)
+
+    @contextmanager
+    def _connect(self):
+        # a new connection per use, so that an index can be used from any thread
+        con = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield con
+            con.commit()
+        finally:
+            con.close()
+
+    def scan(self, paths) -> list[IndexedHeader]:
+        """The indexed header of each fits file in `paths`, in order. Only files that aren't in the index, or whose size or modification time changed, are read"""
+        paths = [os.path.abspath(p) for p in paths]
+        stats = {p: os.stat(p) for p in paths}
+        with self._lock:
+            known = {p: self._records[p] for p in paths if p in self._records}
+        if self.persist:
+            missing = [p for p in paths if p not in known]
+            with self._connect() as con:
+                for start in range(0, len(missing), 500):  # stay under sqlite's limit on query parameters
+                    chunk = missing[start:start+500]
+                    rows = con.execute(f'SELECT * FROM headers WHERE path IN ({",".join("?"*len(chunk))})', chunk).fetchall()
+                    known.update((row[0], _from_row(row)) for row in rows)
+
+        stale = [p for p in dict.fromkeys(paths) if p not in known or known[p]["size"] != stats[p].st_size or known[p]["mtime_ns"] != stats[p].st_mtime_ns]
+        if stale:
+            with ThreadPoolExecutor(max(1, self.workers)) as pool:
+                fresh = list(pool.map(lambda p: _read_header(p, stats[p].st_size, stats[p].st_mtime_ns), stale))
+            known.update((r["path"], r) for r in fresh)
+            if self.persist:
+                with self._connect() as con:
+                    con.executemany(f'INSERT OR REPLACE INTO headers VALUES ({",".join("?"*len(_COLUMNS))})', [_to_row(r) for r in fresh])
+        with self._lock:
+            self._records.update(known)
+        return [known[p] for p in paths]
+
+    def header(self, path) -> IndexedHeader:
+        """The indexed header of one file. See :func:`HeaderIndex.scan`"""
+        return self.scan([path])[0]
+
+    def table(self, paths):
+        """:func:`HeaderIndex.scan` as a pandas DataFrame with one row per file"""
+        import pandas as pd
+        return pd.DataFrame(self.scan(paths), columns=["path", "size", "mtime_ns"] + list(INDEXED_KEYS))
+
+    def prune(self):
+        """Remove entries for files that no longer exist"""
+        with self._lock:
+            self._records = {p: r for p, r in self._records.items() if os.path.exists(p)}
+        if self.persist:
+            with self._connect() as con:
+                gone = [(p,) for (p,) in con.execute("SELECT path FROM headers") if not os.path.exists(p)]
+                con.executemany("DELETE FROM headers WHERE path = ?", gone)
+
+
+_default_index = None
+
+def default_index() -> HeaderIndex:
+    """The process-wide :class:`HeaderIndex` backed by the default database"""
+    global _default_index
+    if _default_index is None:
+        _default_index = HeaderIndex()
+    return _default_index
+
+
+if __name__ == "__main__":
+    # benchmark scanning a directory of fits files: reading every header vs. a cold and a warm index
+    import tempfile, time
+    import numpy as np
+    n_files = 2000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        header = fits.Header({"FILTER": "R", "EXPTIME": 2.0, "DATE-OBS": "2024-01-01T00:00:00.000000+00:00", "IMAGETYP": "Light Frame"})
+        for i in range(n_files):
+            paths.append(os.path.join(tmpdir, f"{i}.fits"))
+            fits.writeto(paths[-1], np.zeros((256, 256), dtype=np.float32), header=header)
+
+        start = time.perf_counter()
+        for p in paths:
+            fits.getheader(p)
+        print(f"fits.getheader: {time.perf_counter()-start:.2f} s")
+
+        db_path = os.path.join(tmpdir, "index.db")
+        start = time.perf_counter()
+        HeaderIndex(db_path).scan(paths)
+        print(f"HeaderIndex (cold): {time.perf_counter()-start:.2f} s")
+        start = time.perf_counter()
+        HeaderIndex(db_path).scan(paths)
+        print(f"HeaderIndex (warm, new process): {time.perf_counter()-start:.2f} s")
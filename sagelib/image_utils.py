@@ -26,6 +26,23 @@ FITS_DATE_IN = "%Y-%m-%dT%H:%M:%S.%f+00:00"
 FITS_DATE_OUT = "%Y-%m-%dT%X.%f"
 
 #@pchoi @Pei Qin
+def image_hdu(hdul):
+    """The HDU of an open fits file that holds its image: the primary HDU, or, for tile-compressed files (whose primary HDU is empty), the first image extension with data"""
+    if hdul[0].header.get("NAXIS", 0) or len(hdul) == 1:
+        return hdul[0]
+    for hdu in hdul[1:]:
+        if isinstance(hdu, (fits.CompImageHDU, fits.ImageHDU)) and hdu.header.get("NAXIS", 0):
+            return hdu
+    return hdul[0]
+
+def get_image_header(path):
+    """The header of the image in a fits file (see :func:`image_hdu`). Only the primary header is read unless it's empty"""
+    header = fits.getheader(path)
+    if header.get("NAXIS", 0):
+        return header
+    with fits.open(path) as f:
+        return image_hdu(f).header
+
 def read_ccddata_ls(ls_toOp, data_dir, return_ls = False):
     if data_dir[-1] != '/':
         data_dir = data_dir + '/'
@@ -16,12 +16,11 @@ def main():
     parent_dir = abspath(join(dirname(__file__), pardir))
     sys.path.append(parent_dir)
 
+    from sagelib.pipeline.pipeline_utils import configure_logger
     try:
-        from pipeline_utils import configure_logger
-        from .. import configure_db, PipelineInputAssociation, PrecursorProductAssociation, ProductProductGroupAssociation, SupersessorAssociation, PipelineRun, Product, TaskRun, Metadata, ProductGroup, ProductMetadataAssociation
+        from .. import configure_db, PipelineInputAssociation, PrecursorProductAssociation, ProductProductGroupAssociation, SupersessorAssociation, PipelineRun, Product, TaskRun, Metadata, ProductGroup, ProductMetadataAssociation, ConfigBlob
     except ImportError:
-        from sagelib.pipeline_utils import configure_logger
-        from sagelib import configure_db, PipelineInputAssociation, PrecursorProductAssociation, ProductProductGroupAssociation, SupersessorAssociation, PipelineRun, Product, TaskRun, Metadata, ProductGroup, ProductMetadataAssociation
+        from sagelib import configure_db, PipelineInputAssociation, PrecursorProductAssociation, ProductProductGroupAssociation, SupersessorAssociation, PipelineRun, Product, TaskRun, Metadata, ProductGroup, ProductMetadataAssociation, ConfigBlob
 
     def create_db(dbpath):
         logger = configure_logger("DB Creation", join(dirname(dbpath),"db_config.log"))
@@ -35,6 +34,7 @@ def main():
         product_group_stmt = CreateTable(ProductGroup.__table__, if_not_exists=True).compile(pipeline_engine)
         precursor_stmt = CreateTable(PrecursorProductAssociation.__table__, if_not_exists=True).compile(pipeline_engine)
         supersessor_stmt = CreateTable(SupersessorAssociation.__table__, if_not_exists=True).compile(pipeline_engine)
+        config_blob_stmt = CreateTable(ConfigBlob.__table__, if_not_exists=True).compile(pipeline_engine)
 
         pipeline_db_session.execute(text(str(pipeline_stmt)))
         logger.info("Configured PipelineRun")
@@ -50,6 +50,8 @@ def main():
         logger.info("Configured Precursor Table")
         pipeline_db_session.execute(text(str(supersessor_stmt)))
         logger.info("Configured Supersession Table")
+        pipeline_db_session.execute(text(str(config_blob_stmt)))
+        logger.info("Configured ConfigBlob Table")
         pipeline_db_session.commit()
 
         pipeline_association_stmt = CreateTable(PipelineInputAssociation, if_not_exists=True).compile(pipeline_engine)
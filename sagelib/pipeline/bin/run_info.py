@@ -1,14 +1,69 @@
 #! python
 
 import sys, os
+import argparse
+import difflib
+from datetime import datetime
 
 import logging
 sys.path.append(os.path.join(os.path.dirname(__file__),os.path.pardir,os.path.pardir))
 
-from sagelib.pipeline import PipelineRun, configure_db
+from sagelib.pipeline import PipelineRun, TaskRun, ConfigBlob, configure_db
+from sagelib.pipeline.pipeline_utils import read_indexed_logs
 from sagelib.utils import now_stamp, tts, stt, dt_to_utc, current_dt_utc
 from sagelib import utils
 
+def format_config(config_str:str) -> str:
+    cfg_str = ""
+    indent_count = -1
+    for char in config_str:
+        if char == "{":
+            indent_count += 1
+            cfg_str += "\n" + "\t" * indent_count
+            continue
+        if char == ",":
+            cfg_str += "\n" + "\t" * indent_count
+            continue
+        if char == "}":
+            indent_count -= 1
+            cfg_str += "\n" + ("\t" * indent_count)
+            # cfg_str += "\t" * indent_count
+            continue
+        if char == "\n":
+            cfg_str+= "\n"+ ("\t" * indent_count)
+            continue
+        cfg_str += char
+    return cfg_str
+
+def config_diff(session, run_id, other_run_id):
+    """Diff the configs of two pipeline runs. Only compares content hashes unless the configs differ, in which case the two config texts are loaded"""
+    hashes = dict(session.query(PipelineRun.ID, PipelineRun.ConfigHash).filter(PipelineRun.ID.in_([run_id, other_run_id])).all())
+    for i in (run_id, other_run_id):
+        if i not in hashes:
+            raise ValueError(f"Couldn't find a pipeline run with ID {i}")
+    if hashes[run_id] == hashes[other_run_id]:
+        return f"Runs #{run_id} and #{other_run_id} used identical configs."
+
+    def config_lines(config_hash):
+        blob = session.get(ConfigBlob, config_hash)
+        # runs recorded before configs were content-addressed store the config itself instead of a hash
+        return format_config(blob.text if blob is not None else config_hash).splitlines()
+
+    diff = difflib.unified_diff(config_lines(hashes[run_id]), config_lines(hashes[other_run_id]), fromfile=f"Run #{run_id}", tofile=f"Run #{other_run_id}", lineterm="")
+    return "\n".join(diff)
+
+def task_logs(session, task_run_id):
+    """Retrieve the log lines emitted by one task run from the structured log index of its pipeline run's log file"""
+    task_run = session.query(TaskRun).filter(TaskRun.ID==task_run_id).first()
+    if not task_run:
+        raise ValueError(f"Couldn't find a task run with ID {task_run_id}")
+    logfile = task_run.Pipeline.LogFilepath
+    records = read_indexed_logs(logfile, task_run_id=task_run_id)
+    lines = [f"Task Run #{task_run_id}: '{task_run.TaskName}' (pipeline run #{task_run.PipelineRunID}), {len(records)} log records from {logfile}"]
+    for timestamp, levelname, _, _, _, message in records:
+        lines.append(f"{datetime.fromtimestamp(timestamp).strftime('%m/%d/%Y %H:%M:%S')} {levelname:<5} | {message}")
+    return "\n".join(lines)
+
 def run_info(session, run_id, verbose=False):
     run = session.query(PipelineRun).filter(PipelineRun.ID==run_id).first()
     if not run:
@@ -108,26 +163,7 @@ def run_info(session, run_id, verbose=False):
     #config
     lines.append(section_sep)
     lines.append("Config")
-    cfg_str = ""
-    indent_count = -1
-    for char in str(run.Config):
-        if char == "{":
-            indent_count += 1
-            cfg_str += "\n" + "\t" * indent_count
-            continue
-        if char == ",":
-            cfg_str += "\n" + "\t" * indent_count
-            continue
-        if char == "}":
-            indent_count -= 1
-            cfg_str += "\n" + ("\t" * indent_count)
-            # cfg_str += "\t" * indent_count
-            continue
-        if char == "\n":
-            cfg_str+= "\n"+ ("\t" * indent_count)
-            continue
-        cfg_str += char
-
+    cfg_str = format_config(run.Config)
     lines.append(section_sep)
 
     lines.append(cfg_str)
@@ -137,14 +173,19 @@ def run_info(session, run_id, verbose=False):
 
 
 def main():
-    if len(sys.argv)==1:
-        print("Usage: run_info [run id] {optional}[pipeline_db_path]")
-        exit(1)
-    run_id = int(sys.argv[1])
-
-    try:
-        database_path = sys.argv[2]
-    except Exception:
+    parser = argparse.ArgumentParser(description="Show summary of a pipeline run")
+    parser.add_argument("run_id", type=int, nargs="?", default=None, help="ID of the pipeline run to inspect")
+    parser.add_argument("pipeline_db_path", nargs="?", default=None, help="optional path to database to use for lookup")
+    parser.add_argument("-d", "--database", type=str, default=None, help="optional path to database to use for lookup (alternative to pipeline_db_path)")
+    parser.add_argument("--diff", type=int, default=None, metavar="OTHER_RUN_ID", help="instead of a summary, show the difference between this run's config and the config of run OTHER_RUN_ID")
+    parser.add_argument("--logs", type=int, default=None, metavar="TASKRUN_ID", help="instead of a summary, show the log lines of the task run with ID TASKRUN_ID. run_id is not needed")
+    args = parser.parse_args()
+    run_id = args.run_id
+    if run_id is None and args.logs is None:
+        parser.error("a run_id is required unless --logs is used")
+
+    database_path = args.database or args.pipeline_db_path
+    if not database_path:
         try:
             cfg_path = os.getenv("PIPELINE_DEFAULTS_PATH")
             cfg = utils._read_config(cfg_path)
@@ -154,7 +195,16 @@ def main():
 
     logging.basicConfig(level=logging.ERROR)
 
-    session, _ = configure_db(database_path)
+    session, engine = configure_db(database_path)
+    ConfigBlob.__table__.create(engine, checkfirst=True)  # missing from databases made before configs were stored in it
+
+    if args.logs is not None:
+        print(task_logs(session, args.logs))
+        return
+
+    if args.diff is not None:
+        print(config_diff(session, run_id, args.diff))
+        return
 
     print(run_info(session, run_id))
 
@@ -7,6 +7,8 @@
     # logging.basicConfig(...)
     # install_mp_handler()  # must happen before making a pool!!!!!
     # pool = Pool(...)
+# for chatty workers, use the batched, bounded variant:
+    # install_mp_handler(handler_cls=BatchedMultiProcessingHandler, maxsize=10000, overflow="drop")
 
 from __future__ import absolute_import, division, unicode_literals
 
@@ -15,24 +17,28 @@ import multiprocessing
 import threading
 
 try:
-    from queue import Empty
+    from queue import Empty, Full
 except ImportError:  # Python 2.
-    from Queue import Empty  # type: ignore[no-redef]
+    from Queue import Empty, Full  # type: ignore[no-redef]
 
 
 __version__ = "0.3.4"
 
 
-def install_mp_handler(logger=None):
+def install_mp_handler(logger=None, handler_cls=None, **handler_kwargs):
     """Wraps the handlers in the given Logger with an MultiProcessingHandler.
 
     :param logger: whose handlers to wrap. By default, the root logger.
+    :param handler_cls: the wrapping handler class. By default, MultiProcessingHandler.
+    :param handler_kwargs: additional keyword arguments for the wrapping handler, ex. `maxsize` for BatchedMultiProcessingHandler.
     """
     if logger is None:
         logger = logging.getLogger()
+    if handler_cls is None:
+        handler_cls = MultiProcessingHandler
 
     for i, orig_handler in enumerate(list(logger.handlers)):
-        handler = MultiProcessingHandler("mp-handler-{0}".format(i), sub_handler=orig_handler)
+        handler = handler_cls("mp-handler-{0}".format(i), sub_handler=orig_handler, **handler_kwargs)
 
         logger.removeHandler(orig_handler)
         logger.addHandler(handler)
@@ -132,4 +138,162 @@ class MultiProcessingHandler(logging.Handler):
             self._receive_thread.join(5.0)  # Waits for receive queue to empty.
 
             self.sub_handler.close()
-            super(MultiProcessingHandler, self).close()
\ No newline at end of file
+            super(MultiProcessingHandler, self).close()
+
+
+class BatchedMultiProcessingHandler(MultiProcessingHandler):
+    """A higher-throughput MultiProcessingHandler.
+
+    Records are sent through a bounded queue and the receiver thread drains them in batches of up to `batch_size`, writing each batch to the sub handler's stream in one write and one flush. When the queue is full, `overflow` decides whether the emitting process blocks ("block", for at most `block_timeout` seconds if it is set) or the record is dropped ("drop"). Records that can't be queued are counted in :py:attr:`dropped` instead of raising. :func:`close` flushes every record queued before it was called before returning.
+
+    Counters are shared between processes, so they include records emitted by forked workers.
+    """
+    _sentinel = None
+
+    def __init__(self, name, sub_handler=None, maxsize=10000, overflow="block", block_timeout=None, batch_size=500):
+        if overflow not in ("block", "drop"):
+            raise ValueError(f"'{overflow}' is not a valid overflow policy. Valid options are: 'block', 'drop'")
+        # don't call MultiProcessingHandler.__init__, which starts a receiver on an unbounded queue
+        logging.Handler.__init__(self)
+
+        if sub_handler is None:
+            sub_handler = logging.StreamHandler()
+        self.sub_handler = sub_handler
+
+        self.setLevel(self.sub_handler.level)
+        self.setFormatter(self.sub_handler.formatter)
+        self.filters = self.sub_handler.filters
+
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+
+        self.queue = multiprocessing.Queue(maxsize)
+        self._queued = multiprocessing.Value("q", 0)
+        self._dropped = multiprocessing.Value("q", 0)
+        self._emitted = multiprocessing.Value("q", 0)
+        self._filtered = multiprocessing.Value("q", 0)
+        self._is_closed = False
+        self._receive_thread = threading.Thread(target=self._receive, name=name)
+        self._receive_thread.daemon = True
+        self._receive_thread.start()
+
+    @property
+    def queued(self):
+        """Number of records successfully put on the queue"""
+        return self._queued.value
+
+    @property
+    def dropped(self):
+        """Number of records dropped because the queue was full (or closed)"""
+        return self._dropped.value
+
+    @property
+    def emitted(self):
+        """Number of records written by the sub handler"""
+        return self._emitted.value
+
+    @property
+    def filtered(self):
+        """Number of queued records that weren't written because the sub handler's level or filters rejected them"""
+        return self._filtered.value
+
+    @property
+    def pending(self):
+        """Number of queued records not yet handled by the sub handler"""
+        return self.queued - self.emitted - self.filtered
+
+    def stats(self):
+        return {"queued": self.queued, "dropped": self.dropped, "emitted": self.emitted, "filtered": self.filtered, "pending": self.pending}
+
+    def _count(self, counter, n=1):
+        with counter.get_lock():
+            counter.value += n
+
+    def _receive(self):
+        done = False
+        while not done:
+            try:
+                # block until there is at least one record, then take whatever else is already waiting
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except (EOFError, OSError):
+                break  # The queue was closed by child?
+
+            if self._sentinel in batch:
+                done = True
+                batch = [r for r in batch if r is not self._sentinel]
+                # anything that was put before the sentinel was seen belongs to this flush too
+                try:
+                    while True:
+                        record = self.queue.get_nowait()
+                        if record is not self._sentinel:
+                            batch.append(record)
+                except (Empty, EOFError, OSError):
+                    pass
+            if batch:
+                self._emit_batch(batch)
+
+        self.queue.close()
+        self.queue.join_thread()
+
+    def _emit_batch(self, batch):
+        # nothing here may raise: if the receiver thread died, producers would block forever once the queue filled up
+        handler = self.sub_handler
+        try:
+            records = [r for r in batch if r.levelno >= handler.level and handler.filter(r)]
+        except Exception:
+            for r in batch:
+                handler.handleError(r)
+            records = []
+        stream = getattr(handler, "stream", None)
+        if isinstance(handler, logging.StreamHandler) and stream is not None:
+            try:
+                text = "".join(handler.format(r) + handler.terminator for r in records)
+                handler.acquire()
+                try:
+                    stream.write(text)
+                    handler.flush()
+                finally:
+                    handler.release()
+            except Exception:
+                for r in records:
+                    handler.handleError(r)
+        else:
+            for r in records:
+                try:
+                    handler.emit(r)
+                except Exception:
+                    handler.handleError(r)
+        self._count(self._emitted, len(records))
+        self._count(self._filtered, len(batch) - len(records))
+
+    def _send(self, s):
+        if self._is_closed:
+            self._count(self._dropped)
+            return
+        try:
+            if self.overflow == "block":
+                self.queue.put(s, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(s)
+        except Full:
+            self._count(self._dropped)
+            return
+        self._count(self._queued)
+
+    def close(self):
+        if not self._is_closed:
+            self._is_closed = True
+            self.queue.put(self._sentinel)
+            self._receive_thread.join()  # Waits until everything queued before close() is written.
+
+            self.sub_handler.close()
+            logging.Handler.close(self)
+
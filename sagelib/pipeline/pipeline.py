@@ -16,9 +16,9 @@ import matplotlib.pyplot as plt
 MODULE_PATH = abspath(dirname(__file__))
 sys.path.append(join(MODULE_PATH,os.path.pardir))
 try:
-    from . import PipelineRun, Product, TaskRun, Metadata, ProductGroup, pipeline_utils, configure_db, product_query
+    from . import PipelineRun, Product, TaskRun, Metadata, ProductGroup, ConfigBlob, pipeline_utils, configure_db, product_query
 except ImportError:
-    from pipeline import PipelineRun, Product, TaskRun, Metadata, ProductGroup, pipeline_utils, configure_db, product_query
+    from pipeline import PipelineRun, Product, TaskRun, Metadata, ProductGroup, ConfigBlob, pipeline_utils, configure_db, product_query
 
 from sagelib.utils import now_stamp, tts, stt, dt_to_utc, current_dt_utc, visualize_graph    
 from sagelib import utils
@@ -47,7 +47,9 @@ class PipelineDB:
         self.connect()
 
     def connect(self):
-        self.session, _ = configure_db(self.dbpath)
+        self.session, engine = configure_db(self.dbpath)
+        # databases made before configs were stored once per content hash don't have a ConfigBlob table: add it, so they keep working without rerunning create_db
+        ConfigBlob.__table__.create(engine, checkfirst=True)
 
     def query(self,*args,**kwargs:Mapping[str,Any]):
         return self.session.query(*args,**kwargs)
@@ -79,10 +81,17 @@ class PipelineDB:
     def commit(self):
         self.session.commit()
 
+    def record_config(self, config_str:str) -> str:
+        """Store the text of a config once per unique content, returning its hash"""
+        config_hash = ConfigBlob.hash_text(config_str)
+        if self.session.get(ConfigBlob, config_hash) is None:
+            self.session.add(ConfigBlob(config_str))
+        return config_hash
+
     def record_pipeline_start(self, pipeline_name:str, pipeline_version:str, start_dt:datetime, config:utils.Config, log_filepath:str|None=None):
         start_str = tts(dt_to_utc(start_dt))
-        config_str = str(config)
-        run = PipelineRun(PipelineName=pipeline_name,PipelineVersion=pipeline_version,StartTimeUTC=start_str,Config=config_str,LogFilepath=log_filepath)
+        config_hash = self.record_config(str(config))
+        run = PipelineRun(PipelineName=pipeline_name,PipelineVersion=pipeline_version,StartTimeUTC=start_str,ConfigHash=config_hash,LogFilepath=log_filepath)
         self.session.add(run)
         self.commit()
         return run
@@ -162,6 +171,7 @@ class Task(ABC):
         """
         self.logfile = logfile
         self.logger = pipeline_utils.configure_logger(self.name, self.logfile)
+        pipeline_utils.set_log_context(self.logger, pipeline_run.ID, task_run.ID)
         self.input_group, self.outdir, self.config = input_group, outdir, config,
         self.pipeline_run, self.db, self.task_run = pipeline_run, db, task_run
         
@@ -175,7 +185,11 @@ class Task(ABC):
             for k,v in filters_from_cfg.items():
                 self.filters[k] = v
             
-        return self.run()
+        try:
+            return self.run()
+        finally:
+            # records this task's logger emits after it finishes don't belong to this task run
+            pipeline_utils.clear_log_context(self.logger)
 
     @abstractmethod
     def run(self) -> int:
@@ -303,7 +317,7 @@ def merge_dicts(d1,d2):
     raise NotImplementedError()
 
 class Pipeline:
-    def __init__(self, pipeline_name: str, tasks:List[Task], outdir:str, config_path:str, version:str, default_cfg_path:str | None = None, default_cfg_env_key="PIPELINE_DEFAULTS_PATH"):
+    def __init__(self, pipeline_name: str, tasks:List[Task], outdir:str, config_path:str, version:str, default_cfg_path:str | None = None, default_cfg_env_key="PIPELINE_DEFAULTS_PATH", compile_config:bool=False):
         self.name = pipeline_name
         # list of *constructed* task objects, not just classes
         self.tasks = tasks
@@ -316,13 +330,14 @@ class Pipeline:
         self.config_path = abspath(config_path)
         self.default_cfg_path = default_cfg_path
         self.default_cfg_env_key = default_cfg_env_key
+        self.compile_config = compile_config
 
         if self.default_cfg_path:
             self.default_cfg_path = abspath(self.default_cfg_path)
-        self.config = utils.Config(self.config_path, self.default_cfg_path, default_env_key=self.default_cfg_env_key)
+        self.config = utils.Config(self.config_path, self.default_cfg_path, default_env_key=self.default_cfg_env_key, compiled=self.compile_config)
         # self.config.choose_profile(profile_name) # this is the scoped config in the file
         self.logfile = join(self.outdir,f"{self.name}.log")
-        self.logger = pipeline_utils.configure_logger(self.name,self.logfile)
+        self.logger = pipeline_utils.configure_logger(self.name,self.logfile,default=True)
         self.dbpath = self.config._get_default("DB_PATH")
         self.db = PipelineDB(self.dbpath, self.logger)
         self.version = version
@@ -452,7 +467,7 @@ class Pipeline:
 
         # reload the config in case anything has changed
         self.logger.info("Reloading config...")
-        self.config = utils.Config(self.config_path, self.default_cfg_path, default_env_key=self.default_cfg_env_key)
+        self.config = utils.Config(self.config_path, self.default_cfg_path, default_env_key=self.default_cfg_env_key, compiled=self.compile_config)
 
         if not isinstance(input, ProductGroup):
             ps = [p for p in input if isinstance(p,Product)]
@@ -480,6 +495,8 @@ class Pipeline:
         self.pipeline_run = self.db.record_pipeline_start(self.name,self.version,pipeline_start,self.config,self.logfile)
         # register the inputs. they'll be added to the db if they dont already exist. 
 
+        pipeline_utils.set_log_context(self.logger, self.pipeline_run.ID)
+
         self.inputs = [self.db.record_input_data(i, self.pipeline_run) for i in self.input_group.Products]
         self.db.session.refresh(self.input_group)
 
@@ -539,6 +556,7 @@ class Pipeline:
                 self.logger.info("No crashes.")
         self.logger.info(f"Succeeded: {self.succeeded}")
         self.db.record_pipeline_end(self.pipeline_run,current_dt_utc(),self.success,self.failed,self.crashed)
+        pipeline_utils.clear_log_context(self.logger)
         self.db.session.expire_all()
         return self.success
 
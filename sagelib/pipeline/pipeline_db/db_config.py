@@ -14,7 +14,7 @@ grandparent_dir = abspath(join(dirname(__file__), pardir))
 sys.path.append(grandparent_dir)
 sys.path.append(dirname(__file__))
 
-from pipeline_utils import configure_logger
+from sagelib.pipeline.pipeline_utils import configure_logger
 import logging
 
 sys.path.remove(grandparent_dir)
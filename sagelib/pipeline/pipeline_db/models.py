@@ -3,13 +3,15 @@ from __future__ import annotations
 # models used by sqlalchemy to understand the database
 from typing import List, Callable, Tuple, Union, Any,Mapping
 import sys
+import zlib
+import hashlib
 from os.path import abspath, join, dirname, pardir
 from datetime import datetime
 from matplotlib.figure import Figure
 from matplotlib.axes import Axes
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Table, null, and_
-from sqlalchemy.orm import relationship, Mapped, mapped_column, scoped_session, aliased
+from sqlalchemy import Column, Integer, String, LargeBinary, ForeignKey, Table, null, and_
+from sqlalchemy.orm import relationship, Mapped, mapped_column, scoped_session, aliased, deferred
 from sqlalchemy.sql.elements import BinaryExpression
 
 sys.path.append(dirname(__file__))
@@ -92,15 +94,24 @@ class PipelineRun(pipeline_base):
     FailedTasks = Column(String, nullable=True)
     CrashedTasks = Column(String, nullable=True)
     PipelineVersion = Column(String, nullable=False)
-    Config = Column(String, nullable=False)
+    # content hash of the run's config, whose text is stored once in ConfigBlob. runs recorded by older versions of sagelib have the full config string here instead
+    ConfigHash = deferred(Column("Config", String, nullable=False))
     # InputFITS = Column(String, nullable=False)
     LogFilepath = Column(String, nullable=True)
     OutputProducts: Mapped[List["Product"]] = relationship("Product")
     Inputs: Mapped[List["Product"]] = relationship("Product", secondary='PipelineInputAssociation', back_populates="UsedByRunsAsInput")
     TaskRuns: Mapped[List["TaskRun"]] = relationship("TaskRun")
+    ConfigRecord = relationship("ConfigBlob", primaryjoin="foreign(PipelineRun.ConfigHash) == ConfigBlob.Hash", viewonly=True)
 
     def __repr__(self):
         return f"'{self.PipelineName}' v{self.PipelineVersion} (run #{self.ID})"
+
+    @property
+    def Config(self) -> str:
+        """The string representation of the config this run was started with. Only loaded (and decompressed) from the database when accessed."""
+        if self.ConfigRecord is not None:
+            return self.ConfigRecord.text
+        return self.ConfigHash
     
     def related_product_query(self, dbsession:scoped_session, use_superseded:bool=False, metadata:None|dict=None, **filters:Mapping[str,Any]):
         """Return a Query for products among this PipelineRun's inputs an outputs. optionally, add keyword arguments to filter Products
@@ -174,6 +185,28 @@ class PipelineRun(pipeline_base):
         return related_products
 
 
+class ConfigBlob(pipeline_base):
+    """Compressed config text, stored once per unique config and referenced by :py:attr:`PipelineRun.ConfigHash` """
+    __tablename__ = 'ConfigBlob'
+
+    Hash = Column(String, primary_key=True)
+    Data = Column(LargeBinary, nullable=False)
+
+    def __init__(self, text:str):
+        super().__init__(Hash=ConfigBlob.hash_text(text), Data=zlib.compress(text.encode()))
+
+    @staticmethod
+    def hash_text(text:str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @property
+    def text(self) -> str:
+        return zlib.decompress(self.Data).decode()
+
+    def __repr__(self):
+        return f"ConfigBlob {self.Hash[:12]}"
+
+
 class Product(pipeline_base):
     """Inputs and outputs of Pipelines
     
@@ -2,51 +2,294 @@ import sys, os
 MODULE_PATH = os.path.abspath(os.path.dirname(__file__))
 def mod(path): return os.path.join(MODULE_PATH,path)
 import json
+from typing import List
 import numpy as np
+import atexit
+import queue
+import time
+import sqlite3
+import multiprocessing
 import logging
-from pathlib import Path
 import logging.config
+import logging.handlers
 from sagelib import logging_config
 
-# try:
-#     from .multiprocess_logging import install_mp_handler
-# except:
-#     from multiprocess_logging import install_mp_handler
-
 BAD_SEX_FLAGS = np.array([8,16,32,64,128])
 
 def ldac_to_table(fits_file,frame=1):
     import astromatic_wrapper as aw
     return aw.utils.ldac.get_table_from_ldac(fits_file, frame=frame)
 
-def configure_logger(name, outfile_path):
-    # first, check if the logger has already been configured
-    if logging.getLogger(name).hasHandlers():
-        return logging.getLogger(name)
+def log_index_path(logfile:str) -> str:
+    """Path of the structured log index kept alongside `logfile`"""
+    return os.path.abspath(logfile) + ".index.sqlite"
+
+
+class _LogIndex:
+    """Append-only SQLite store of structured log records (timestamp, level, PipelineRunID, TaskRunID, logger, message), indexed by run and task run. Only written from the log listener thread."""
+    create_statements = [
+        'CREATE TABLE IF NOT EXISTS "LogRecord" ("ID" INTEGER PRIMARY KEY AUTOINCREMENT, "Timestamp" REAL NOT NULL, "Level" INTEGER NOT NULL, "LevelName" STRING NOT NULL, "PipelineRunID" INTEGER, "TaskRunID" INTEGER, "Logger" STRING, "Message" STRING)',
+        'CREATE INDEX IF NOT EXISTS "LogRecordTaskRunID" ON "LogRecord" ("TaskRunID")',
+        'CREATE INDEX IF NOT EXISTS "LogRecordPipelineRunID" ON "LogRecord" ("PipelineRunID")',
+    ]
+    insert_statement = 'INSERT INTO "LogRecord" ("Timestamp","Level","LevelName","PipelineRunID","TaskRunID","Logger","Message") VALUES (?,?,?,?,?,?,?)'
+
+    def __init__(self, path:str, commit_every:int=256, commit_interval_s:float=0.5):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval_s = commit_interval_s
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        for statement in self.create_statements:
+            self.conn.execute(statement)
+        self.conn.commit()
+        self.pending = []
+        self.last_commit = time.monotonic()
+
+    def add(self, record:logging.LogRecord):
+        self.pending.append((record.created, record.levelno, record.levelname, getattr(record, "PipelineRunID", None), getattr(record, "TaskRunID", None), record.name, record.getMessage()))
+        if len(self.pending) >= self.commit_every or time.monotonic() - self.last_commit > self.commit_interval_s:
+            self.commit()
+
+    def commit(self):
+        if self.pending:
+            self.conn.executemany(self.insert_statement, self.pending)
+            self.conn.commit()
+            self.pending = []
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+class _RunContextFilter(logging.Filter):
+    """Tags records with the IDs of the pipeline run and task run that emitted them"""
+    def __init__(self, pipeline_run_id:int|None, task_run_id:int|None=None):
+        super().__init__()
+        self.pipeline_run_id = pipeline_run_id
+        self.task_run_id = task_run_id
+
+    def filter(self, record:logging.LogRecord):
+        record.PipelineRunID = self.pipeline_run_id
+        record.TaskRunID = self.task_run_id
+        return True
+
+
+def set_log_context(logger:logging.Logger, pipeline_run_id:int|None, task_run_id:int|None=None):
+    """Tag everything `logger` emits with a pipeline run ID (and optionally a task run ID). Tagged records are also written to the structured log index of the logger's log file, see :func:`read_indexed_logs`"""
+    clear_log_context(logger)
+    logger.addFilter(_RunContextFilter(pipeline_run_id, task_run_id))
+
+def clear_log_context(logger:logging.Logger):
+    for f in list(logger.filters):
+        if isinstance(f, _RunContextFilter):
+            logger.removeFilter(f)
+
+def read_indexed_logs(logfile:str, task_run_id:int|None=None, pipeline_run_id:int|None=None) -> List[tuple]:
+    """Read structured log records for a task run and/or pipeline run from the index kept alongside `logfile`
+
+    :return: list of (timestamp, level name, pipeline run ID, task run ID, logger name, message) tuples, in the order they were logged
+    """
+    index_path = log_index_path(logfile)
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"No log index found at {index_path}")
+    conditions, params = [], []
+    if task_run_id is not None:
+        conditions.append('"TaskRunID" = ?')
+        params.append(task_run_id)
+    if pipeline_run_id is not None:
+        conditions.append('"PipelineRunID" = ?')
+        params.append(pipeline_run_id)
+    query = 'SELECT "Timestamp","LevelName","PipelineRunID","TaskRunID","Logger","Message" FROM "LogRecord"'
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += ' ORDER BY "ID"'
+    conn = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
     try:
-        with open(logging_config(), 'r') as log_cfg:
-            logging.config.dictConfig(json.load(log_cfg))
-            logger = logging.getLogger(name)
-            # set outfile of existing filehandler. need to do this instead of making a new handler in order to not wipe the formatter off
-            # NOTE RELIES ON FILE HANDLER BEING THE SECOND HANDLER
-            root_logger = logging.getLogger()
-            file_handler = root_logger.handlers[1]
-            file_handler.setStream(Path(outfile_path).open('a'))
+        return conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+
+class _FileRouter(logging.Handler):
+    """Writes each record to the log file registered for its logger (or the nearest registered ancestor). Runs on the log listener's thread, so file I/O never happens on the thread that emitted the record."""
+    def __init__(self, formatter:logging.Formatter|None=None, level=logging.NOTSET):
+        super().__init__(level)
+        self.setFormatter(formatter)
+        self.routes = {}  # logger name : log file path
+        self.file_handlers = {}  # log file path : FileHandler
+        self.indexes = {}  # log file path : _LogIndex
+        self.default_path = None  # log file for records from loggers that were never configured (libraries, etc), if any
+
+    def add_route(self, name:str, outfile_path:str, default:bool=False):
+        outfile_path = os.path.abspath(outfile_path)
+        with self.lock:
+            if outfile_path not in self.file_handlers:
+                file_handler = logging.FileHandler(outfile_path, mode="a")
+                file_handler.setFormatter(self.formatter)
+                self.file_handlers[outfile_path] = file_handler
+            self.routes[name] = outfile_path
+            if default:
+                self.default_path = outfile_path
+
+    def route(self, name:str) -> str|None:
+        while name:
+            if name in self.routes:
+                return self.routes[name]
+            name = name.rpartition(".")[0]
+        return self.default_path
+
+    def emit(self, record:logging.LogRecord):
+        outfile_path = self.route(record.name)
+        if outfile_path is None:
+            return
+        self.file_handlers[outfile_path].emit(record)
+        if getattr(record, "PipelineRunID", None) is not None:
+            try:
+                index = self.indexes.get(outfile_path)
+                if index is None:
+                    index = self.indexes[outfile_path] = _LogIndex(log_index_path(outfile_path))
+                index.add(record)
+            except Exception:
+                self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            for index in self.indexes.values():
+                index.commit()
+
+    def close(self):
+        with self.lock:
+            for file_handler in self.file_handlers.values():
+                file_handler.close()
+            for index in self.indexes.values():
+                index.close()
+            self.file_handlers = {}
+            self.indexes = {}
+            self.routes = {}
+            self.default_path = None
+        super().close()
+
+
+class _FlushingQueueListener(logging.handlers.QueueListener):
+    """A QueueListener that flushes its handlers whenever no record has arrived for `idle_flush_s` seconds, so records that handlers buffer (like the log index's uncommitted rows) are written while a run is quiet, instead of waiting for the next record or for logging to stop"""
+    idle_flush_s = 0.5
+
+    def dequeue(self, block):
+        while True:
             try:
-                os.remove("should_be_set_by_code.log")  # pardon this
-            except:
-                pass
+                return self.queue.get(block, self.idle_flush_s if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+                for handler in self.handlers:
+                    handler.flush()
+
+
+_log_queue = None
+_log_listener = None
+_file_router = None
+_stop_at_exit = False
+
+def start_logging(multiprocess:bool=True):
+    """Start this process's logging subsystem, if it isn't already running, and return its log queue.
+    
+    The root logger gets a single :class:`logging.handlers.QueueHandler`, so emitting a record only puts it on a queue. One :class:`logging.handlers.QueueListener` thread formats records and writes them to the console and to the log file each logger was registered with by :func:`configure_logger`. Handlers and formatters are read from the package logging config once, here. Whenever the queue is idle, the listener flushes its handlers, so the log index catches up within about half a second. Called automatically by :func:`configure_logger`.
 
+    :param multiprocess: use a :class:`multiprocessing.Queue` so that worker processes can log through this process's listener (by giving their root logger a :class:`logging.handlers.QueueHandler` on the returned queue), defaults to True
+    :type multiprocess: bool, optional
+    :return: the queue that log records are sent through
+    """
+    global _log_queue, _log_listener, _file_router, _stop_at_exit
+    if _log_listener is not None:
+        return _log_queue
+
+    root_logger = logging.getLogger()
+    console_handlers = []
+    try:
+        with open(logging_config(), 'r') as log_cfg:
+            cfg = json.load(log_cfg)
+        # the file handler in the config is only a template for the formatter and level of the routed log files
+        cfg["handlers"]["file"]["delay"] = True
+        logging.config.dictConfig(cfg)
+        file_template = [h for h in root_logger.handlers if h.name == "file"][0]
+        console_handlers = [h for h in root_logger.handlers if h is not file_template]
+        _file_router = _FileRouter(file_template.formatter, file_template.level)
+        file_template.close()
     except Exception as e:
         print(f"Can't load logging config ({e}). Using default config.")
-        logger = logging.getLogger(name)
-        file_handler = logging.FileHandler(outfile_path, mode="a+")
-        logger.addHandler(file_handler)
+        _file_router = _FileRouter()
+
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+
+    _log_queue = multiprocessing.Queue(-1) if multiprocess else queue.SimpleQueue()
+    _log_listener = _FlushingQueueListener(_log_queue, *console_handlers, _file_router, respect_handler_level=True)
+    _log_listener.start()
+    root_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+    if not _stop_at_exit:  # once, however many times logging is restarted
+        atexit.register(stop_logging)
+        _stop_at_exit = True
+    return _log_queue
 
-    # install_mp_handler()
-    return logger
+def stop_logging():
+    """Flush all queued log records, then stop the log listener and close log files. Logging can be restarted with :func:`start_logging`"""
+    global _log_queue, _log_listener, _file_router
+    if _log_listener is None:
+        return
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler) and handler.queue is _log_queue:
+            root_logger.removeHandler(handler)
+    _log_listener.stop()
+    for handler in _log_listener.handlers:
+        handler.close()
+    _log_queue = _log_listener = _file_router = None
+
+def configure_logger(name, outfile_path, default:bool=False):
+    """Get the logger `name`, whose records will be written to `outfile_path` (as well as the console). Cheap to call repeatedly - starts the logging subsystem on first call and otherwise just (re)registers the log file for this logger.
+
+    :param default: also write records from loggers that were never configured (libraries, etc) to `outfile_path`, instead of only to the console. the pipeline sets this for its main log, defaults to False
+    :type default: bool, optional
+    """
+    start_logging()
+    _file_router.add_route(name, outfile_path, default)
+    return logging.getLogger(name)
 
 def check_sextractor_flags(flag, bad_flags = BAD_SEX_FLAGS):
     row = np.zeros_like(bad_flags)
     row.fill(flag)
-    return not np.any(np.bitwise_and(row,bad_flags))
\ No newline at end of file
+    return not np.any(np.bitwise_and(row,bad_flags))
+
+if __name__ == "__main__":
+    # benchmark log throughput under load from several task threads
+    import tempfile, threading, time
+    n_threads, n_records = 8, 20000
+    multiprocess = "--threads-only" not in sys.argv
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start_logging(multiprocess=multiprocess)
+        loggers = [configure_logger(f"bench task {i}", os.path.join(tmpdir,"bench.log")) for i in range(n_threads)]
+        # keep the console quiet, we only care about the file
+        for handler in _log_listener.handlers:
+            if handler is not _file_router:
+                handler.setLevel(logging.CRITICAL)
+
+        def spam(logger):
+            for i in range(n_records):
+                logger.info("frame %d processed", i)
+
+        threads = [threading.Thread(target=spam, args=(logger,)) for logger in loggers]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        emitted = time.perf_counter() - start
+        stop_logging()
+        written = time.perf_counter() - start
+        total = n_threads * n_records
+        print(f"{'multiprocessing' if multiprocess else 'thread'} queue: {total} records from {n_threads} threads")
+        print(f"emit (task hot path): {total/emitted:.0f} records/s")
+        print(f"end-to-end (written to disk): {total/written:.0f} records/s")
@@ -0,0 +1,209 @@
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# number of elements in each piece of an image that statistics are accumulated over. small enough that a piece stays in cache while it's used twice
+STATS_CHUNK_ELEMENTS = 1 << 18
+
+STATS_DTYPE = np.dtype([("name", "U128"), ("mean", "f8"), ("std", "f8"), ("median", "f8"), ("min", "f8"), ("max", "f8"), ("npix", "i8"), ("nnan", "i8")])
+
+
+def _chunks(data, chunk_elements=STATS_CHUNK_ELEMENTS):
+    flat = np.ravel(data)  # a view for contiguous data, including memmaps
+    for start in range(0, flat.size, chunk_elements):
+        yield flat[start:start+chunk_elements]
+
+
+def _moments(data, chunk_elements=STATS_CHUNK_ELEMENTS):
+    # (number of values, mean, std, min, max, number of NaNs) of `data`, ignoring NaNs. see mean_std
+    n, nans, total, total_sq = 0, 0, 0.0, 0.0
+    lo, hi = np.inf, -np.inf
+    shift = None
+    buf = np.empty(min(chunk_elements, max(1, np.size(data))), dtype=np.float64)
+    for chunk in _chunks(data, chunk_elements):
+        chunk_lo = chunk.min()
+        if chunk_lo != chunk_lo:  # min is NaN if any value is: only then are the NaNs filtered out
+            valid = chunk[~np.isnan(chunk)]
+            nans += chunk.size - valid.size
+            if valid.size == 0:
+                continue
+            chunk, chunk_lo = valid, valid.min()
+        if shift is None:
+            shift = float(np.mean(chunk, dtype=np.float64))
+        d = np.subtract(chunk, shift, out=buf[:chunk.size], dtype=np.float64)
+        n += chunk.size
+        total += float(d.sum())
+        total_sq += float(np.dot(d, d))
+        lo, hi = min(lo, float(chunk_lo)), max(hi, float(chunk.max()))
+    if n == 0:
+        return 0, np.nan, np.nan, np.nan, np.nan, nans
+    mean = total / n
+    return n, shift + mean, float(np.sqrt(max(total_sq / n - mean*mean, 0.0))), lo, hi, nans
+
+
+def mean_std(data, chunk_elements=STATS_CHUNK_ELEMENTS):
+    """
+    Mean and (population) standard deviation of `data`, ignoring NaNs (like ``np.nanmean`` and ``np.nanstd``), in one pass over memory, without any full-size temporaries. Each cache-sized chunk is shifted by an estimate of the mean (the first chunk's) into a reused float64 buffer, then its sum and sum of squares are accumulated. The shift keeps the sum of squares from cancelling catastrophically, so the result is as accurate as the two-pass method. Only chunks that have NaNs are copied to remove them
+
+    :return: (mean, std, min, max)
+    :rtype: tuple[float, float, float, float]
+    """
+    return _moments(data, chunk_elements)[1:5]
+
+
+def _histogram(flat, lo, hi, bins, buf, in_range=False):
+    # counts of the values of `flat` in `bins` equal bins over [lo, hi], a chunk at a time. the last bin includes hi, like np.histogram, but much
+    # faster. if `in_range`, all finite values are known to be in [lo, hi] and only non-finite ones (NaNs) are dropped
+    counts = np.zeros(bins, dtype=np.int64)
+    scale = bins / (hi - lo)
+    for chunk in _chunks(flat, buf.size):
+        f = np.subtract(chunk, lo, out=buf[:chunk.size], dtype=np.float64)
+        f *= scale
+        if not in_range:
+            f = f[(f >= 0) & (f <= bins)]  # also drops NaNs
+        elif np.isnan(f.min()):
+            f = f[~np.isnan(f)]
+        idx = f.astype(np.intp)
+        np.minimum(idx, bins - 1, out=idx)
+        counts += np.bincount(idx, minlength=bins)
+    return counts
+
+
+def approx_median(data, max_error=None, method="histogram", bins=4096, max_passes=4, sample_size=1_000_000, lo=None, hi=None):
+    """
+    Approximate median of `data`, ignoring NaNs, without the full-size copy and partition that `np.median` makes.
+
+    With `method='histogram'`, the data is histogrammed (a chunk at a time) between its min and max, then repeatedly re-histogrammed inside the bin that holds the median, up to `max_passes` times or until the bin is narrower than `2*max_error`. The result is the middle of the final bin, so its distance from the (lower, for even sizes) median is at most half that bin's width, which is returned. One pass with the default 4096 bins is usually good enough for image backgrounds.
+
+    With `method='sample'`, the exact median of an evenly-strided subsample of about `sample_size` pixels is returned. This is faster, but its error isn't bounded (it's returned as NaN)
+
+    :param max_error: stop refining once the error is at most this large, defaults to None (use all `max_passes`)
+    :type max_error: float | None, optional
+    :param lo: the min of `data`, if it's already known (for example, from :func:`mean_std`), defaults to None
+    :param hi: the max of `data`, if it's already known, defaults to None
+    :return: (median, max absolute error)
+    :rtype: tuple[float, float]
+    """
+    flat = np.ravel(data)
+    if flat.size == 0:
+        return np.nan, np.nan
+    if method == "sample":
+        step = max(1, flat.size // sample_size)
+        return float(np.nanmedian(flat[::step])), np.nan
+    if method != "histogram":
+        raise ValueError(f"Unknown median method '{method}' - must be 'histogram' or 'sample'")
+    if lo is None or hi is None:
+        lo, hi = float(np.nanmin(flat)), float(np.nanmax(flat))
+    if not (np.isfinite(lo) and np.isfinite(hi)):  # all NaN, or infinite values, which can't be histogrammed
+        return np.nan, np.nan
+    k = None  # index of the (lower) median in sorted order, of the values that aren't NaN (counted by the first pass)
+    below = 0  # number of values less than lo
+    buf = np.empty(min(STATS_CHUNK_ELEMENTS, flat.size), dtype=np.float64)
+    for n_pass in range(max_passes):
+        if hi <= lo or (max_error is not None and (hi - lo) / 2 <= max_error):
+            break
+        counts = _histogram(flat, lo, hi, bins, buf, in_range=n_pass == 0)
+        if k is None:
+            k = (int(counts.sum()) - 1) // 2
+        cumulative = below + np.cumsum(counts)
+        i = min(int(np.searchsorted(cumulative, k + 1)), bins - 1)
+        if i > 0:
+            below = int(cumulative[i-1])
+        width = (hi - lo) / bins
+        lo, hi = lo + i*width, lo + (i+1)*width
+    return (lo + hi) / 2, (hi - lo) / 2
+
+
+def sigma_clipped_stats(data, sigma=3.0, maxiters=5, median="exact", max_error=None):
+    """
+    Mean, median, and standard deviation of `data` after iteratively rejecting values more than `sigma` standard deviations from the median. NaNs are ignored. `median` is 'exact', or 'histogram' or 'sample' for a faster approximation with `max_error` (see :func:`approx_median`)
+
+    :return: (mean, median, std)
+    :rtype: tuple[float, float, float]
+    """
+    values = np.ravel(data)
+    nans = np.isnan(values)
+    if nans.any():
+        values = values[~nans]
+    stats = frame_stats(values, median, max_error)
+    for _ in range(maxiters):
+        kept = values[np.abs(values - stats["median"]) <= sigma*stats["std"]]
+        if kept.size == values.size:
+            break
+        values = kept
+        stats = frame_stats(values, median, max_error)
+    return stats["mean"], stats["median"], stats["std"]
+
+
+def frame_stats(data, median="exact", max_error=None):
+    """
+    Mean, std, median, min, and max of one image as a dict, ignoring NaNs (whose number is 'nnan'). `median` is 'exact', 'histogram', or 'sample' (see :func:`approx_median`), or None to skip it. Images with NaNs, or infinite values, always get the exact median (``np.nanmedian``)
+    """
+    _, mean, std, lo, hi, nans = _moments(data)
+    if median is None:
+        med = np.nan
+    elif nans or not (np.isfinite(lo) and np.isfinite(hi)):  # the histogram needs a finite range
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN images
+            med = float(np.nanmedian(data))
+    elif median == "exact":
+        med = float(np.median(data))
+    else:
+        med, _ = approx_median(data, max_error=max_error, method=median, lo=lo, hi=hi)
+    return {"mean": mean, "std": std, "median": med, "min": lo, "max": hi, "npix": int(np.size(data)), "nnan": nans}
+
+
+def batch_stats(frames, workers=4, median="exact", max_error=None):
+    """
+    Per-frame statistics for many frames at once, computed by `workers` threads (numpy releases the GIL while it reduces arrays), as a structured array with the fields of STATS_DTYPE (one row per frame, in order).
+
+    `frames` can be a :class:`sagelib.FrameSet`, whose batches are read in the background while the previous batch's statistics are computed, or any iterable of :class:`sagelib.Frame` objects. Either way, each frame keeps its results, so its `mean`, `stdev`, and `median` properties don't recompute them: Frames that are passed in store them directly, and a FrameSet stores them by filename and gives them to the Frames it yields later (from iterating over it or from :func:`sagelib.frame.FrameBatch.frames`).
+
+    >>> stats = batch_stats(FrameSet(filenames, 1000), workers=8, median="histogram")
+    >>> stats["mean"].mean()
+
+    :param median: 'exact', 'histogram', or 'sample' (see :func:`approx_median`), or None to skip medians, defaults to 'exact'
+    :type median: str | None, optional
+    """
+    from sagelib.frame import FrameSet
+
+    rows = []
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        compute = lambda data: frame_stats(data, median, max_error)
+        if isinstance(frames, FrameSet):
+            for batch in frames.batches():
+                for filename, name, result in zip(batch.filenames, batch.names, pool.map(compute, batch.data)):
+                    batch.stats[filename] = (result["mean"], result["std"], result["median"] if median is not None else None)
+                    rows.append((name, result))
+        else:
+            frames = list(frames)
+            for frame, result in zip(frames, pool.map(lambda f: compute(f.data), frames)):
+                frame._mean, frame._stdev = result["mean"], result["std"]
+                if median is not None:
+                    frame._median = result["median"]
+                rows.append((frame.name, result))
+    out = np.empty(len(rows), dtype=STATS_DTYPE)
+    for i, (name, result) in enumerate(rows):
+        out[i] = (name, result["mean"], result["std"], result["median"], result["min"], result["max"], result["npix"], result["nnan"])
+    return out
+
+
+if __name__ == "__main__":
+    import time
+    rng = np.random.default_rng()
+    img = rng.normal(1000, 20, (4096, 4096)).astype(np.float32)
+
+    def timed(label, func):
+        start = time.perf_counter()
+        result = func()
+        print(f"{label}: {(time.perf_counter()-start)*1000:.0f} ms -> {result}")
+
+    timed("np.mean + np.std", lambda: (float(np.mean(img, dtype=np.float64)), float(np.std(img, dtype=np.float64))))
+    timed("mean_std", lambda: mean_std(img)[:2])
+    timed("np.median", lambda: float(np.median(img)))
+    timed("approx_median (histogram, 1 pass)", lambda: approx_median(img, max_passes=1))
+    timed("approx_median (histogram, 0.01 error)", lambda: approx_median(img, max_error=0.01))
+    timed("approx_median (sample)", lambda: approx_median(img, method="sample"))
+    timed("sigma_clipped_stats", lambda: sigma_clipped_stats(img))
+    timed("sigma_clipped_stats (histogram medians)", lambda: sigma_clipped_stats(img, median="histogram", max_error=0.01))
@@ -0,0 +1,38 @@
+import numpy as np
+
+from sagelib.calib.alignment import AffineTransform, ReferenceFeatures, find_transform
+
+
+def _star_field(points, flux, size, rng):
+    # gaussian stars at `points` on a noisy background
+    img = rng.normal(1000, 10, (size, size)).astype(np.float32)
+    y, x = np.mgrid[-6:7, -6:7]
+    for (px, py), f in zip(points, flux):
+        ix, iy = int(round(px)), int(round(py))
+        if 6 <= ix < size-6 and 6 <= iy < size-6:
+            img[iy-6:iy+7, ix-6:ix+7] += f/(2*np.pi*2.5**2)*np.exp(-((x+ix-px)**2 + (y+iy-py)**2)/(2*2.5**2))
+    return img
+
+
+def test_find_transform_recovers_shift_and_rotation():
+    rng = np.random.default_rng(3)
+    size = 512
+    xy = rng.uniform(20, size-20, (80, 2))
+    flux = rng.lognormal(8, 0.7, len(xy))
+    ref = ReferenceFeatures(_star_field(xy, flux, size, rng))
+
+    angle, shift = np.radians(2.0), (17.3, -11.8)
+    rot = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    truth = AffineTransform(np.column_stack([rot, shift]))  # reference -> frame
+    transform, matched = find_transform(ref, _star_field(truth(xy), flux, size, rng))
+
+    assert len(matched) >= 20
+    assert abs(transform.rotation + 2.0) < 0.05 and abs(transform.scale - 1) < 2e-3
+    # the found (frame -> reference) transform undoes the known one to within half a pixel, everywhere on the frame
+    assert np.max(np.linalg.norm(transform(truth(xy)) - xy, axis=1)) < 0.5
+    assert np.allclose(transform.params, truth.inverse().params, atol=[[2e-3, 2e-3, 0.5]]*2)
+
+
+if __name__ == "__main__":
+    test_find_transform_recovers_shift_and_rotation()
+    print("alignment tests passed")
@@ -0,0 +1,44 @@
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from sagelib.discovery import ListingCache, find_files
+
+
+def _make_tree(root):
+    for sub in ("", "a", "a/b", ".hidden_dir"):
+        os.makedirs(os.path.join(root, sub), exist_ok=True)
+        for name in ("x.fits", "y.txt", ".z.fits"):
+            open(os.path.join(root, sub, name), "w").close()
+    os.symlink("..", os.path.join(root, "a", "loop"))  # a symlink loop
+    os.symlink(os.path.join(root, "a", "b"), os.path.join(root, "b_link"))  # a symlinked directory
+    os.symlink(os.path.join(root, "x.fits"), os.path.join(root, "a", "x_link.fits"))  # a symlinked file
+
+
+def _glob(root, pattern, recursive, regex):
+    # what reduce, align, and findAllIn did before find_files: pathlib's glob, then re.match on the whole path or fnmatch on the name
+    paths = [str(p) for p in Path(root).glob("**/*" if recursive else "*") if not p.is_dir()]
+    if regex:
+        return sorted(p for p in paths if re.match(pattern, p))
+    return sorted(str(p) for p in Path(root).glob(("**/" if recursive else "") + pattern) if not p.is_dir())
+
+
+def test_find_files_matches_pathlib_glob():
+    with tempfile.TemporaryDirectory() as root:
+        _make_tree(root)
+        cache = ListingCache(os.path.join(root, "listings.db"))
+        for recursive in (False, True):
+            for pattern, regex in (("*.fits", False), ("*", False), (r".*\.fits$", True)):
+                expected = [p for p in _glob(root, pattern, recursive, regex) if not p.endswith("listings.db")]
+                for c in (None, cache, cache):  # uncached, then filling and reading the cache
+                    found = [p for p in find_files(root, pattern, recursive=recursive, regex=regex, cache=c) if not p.endswith("listings.db")]
+                    assert found == expected, (pattern, recursive, found, expected)
+        # the loop isn't followed: every file is found once
+        found = find_files(root, "x.fits", recursive=True)
+        assert len(found) == len(set(os.path.realpath(p) for p in found)) == 4
+
+
+if __name__ == "__main__":
+    test_find_files_matches_pathlib_glob()
+    print("discovery tests passed")
@@ -0,0 +1,90 @@
+import os
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+from sagelib import Frame
+from sagelib.frame import FrameSet
+
+
+def _lazy_frame(directory, name, img):
+    path = os.path.join(directory, name + ".fits")
+    fits.PrimaryHDU(img).writeto(path, overwrite=True)
+    return Frame.from_fits(path, lazy=True)
+
+
+def test_lazy_integer_arithmetic():
+    # lazy frames keep integer data as it is on disk, but arithmetic on them must be done in float32 (as it is for loaded frames), not wrap around
+    with tempfile.TemporaryDirectory() as d:
+        i16 = _lazy_frame(d, "i16", np.full((16, 16), 100, dtype=np.int16))
+        u16 = _lazy_frame(d, "u16", np.full((16, 16), 60000, dtype=np.uint16))
+        assert i16.data.dtype.kind == "i" and u16.data.dtype.kind == "u"
+
+        assert np.all(i16.multiply(400).data == 40000)
+        assert np.all(u16.multiply(2).data == 120000)
+        assert np.all((u16 + u16).data == 120000)
+        assert np.all((u16 - i16).data == 59900)
+
+        out = np.empty((16, 16), dtype=np.float32)
+        u16.add(u16, out=out)
+        assert np.all(out == 120000)
+
+        inplace = _lazy_frame(d, "u16_inplace", np.full((16, 16), 60000, dtype=np.uint16))
+        inplace += u16
+        assert inplace.data.dtype == np.float32 and np.all(inplace.data == 120000)
+
+
+def test_lazy_stats_dont_convert():
+    with tempfile.TemporaryDirectory() as d:
+        img = np.random.default_rng(0).normal(1000, 50, (301, 257)).astype(np.int16)
+        frame = _lazy_frame(d, "stats", img)
+        assert abs(frame.median - np.median(img)) <= 1e-6*(img.max() - img.min())
+        assert np.isclose(frame.mean, img.mean()) and np.isclose(frame.stdev, img.std())
+        assert frame._img is None  # still the memory-mapped data, not a float32 copy
+
+
+def test_lazy_median_with_nans():
+    # the histogram median lazy frames use must skip NaNs, in frames of more than one chunk
+    with tempfile.TemporaryDirectory() as d:
+        img = np.random.default_rng(1).normal(500, 20, (1024, 1024)).astype(np.float32)
+        img[100:110, 200:210] = np.nan
+        frame = _lazy_frame(d, "nans", img)
+        assert abs(frame.median - np.nanmedian(img)) <= 1e-6*(np.nanmax(img) - np.nanmin(img))
+        assert frame._img is None
+
+
+def test_float32_byte_order():
+    # FITS float32 data is big-endian on disk: loaded frames get native float32, lazy frames keep the memmap until their img is used
+    with tempfile.TemporaryDirectory() as d:
+        img = np.arange(64, dtype=np.float32).reshape(8, 8)
+        lazy = _lazy_frame(d, "f32", img)
+        assert not lazy.data.dtype.isnative and lazy._img is None
+        eager = Frame.from_fits(os.path.join(d, "f32.fits"))
+        assert eager.img.dtype == np.float32 and eager.img.dtype.isnative
+        assert lazy.img.dtype == np.float32 and lazy.img.dtype.isnative
+        assert np.array_equal(eager.img, img) and np.array_equal(lazy.img, img)
+
+
+def test_frameset_mixed_shapes():
+    # same-shape 2D files are batched together; cubes and other shapes are loaded on their own, in order
+    with tempfile.TemporaryDirectory() as d:
+        shapes = [(8, 8), (8, 8), (3, 8, 8), (8, 8), (4, 4)]
+        paths = []
+        for i, shape in enumerate(shapes):
+            paths.append(os.path.join(d, f"{i}.fits"))
+            fits.PrimaryHDU(np.full(shape, i, dtype=np.float32)).writeto(paths[-1])
+        assert [len(batch) for batch in FrameSet(paths, 1).batches()] == [2, 1, 1, 1]
+        with FrameSet(paths, 1) as frames:
+            frames = list(frames)
+        assert [f.img.shape for f in frames] == shapes
+        assert all(np.all(f.img == i) for i, f in enumerate(frames))
+
+
+if __name__ == "__main__":
+    test_lazy_integer_arithmetic()
+    test_lazy_stats_dont_convert()
+    test_lazy_median_with_nans()
+    test_float32_byte_order()
+    test_frameset_mixed_shapes()
+    print("Frame tests passed")
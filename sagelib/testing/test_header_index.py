@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+from sagelib.header_index import HeaderIndex
+
+
+def _write(path, shape, **keywords):
+    fits.PrimaryHDU(np.zeros(shape, dtype=np.float32), fits.Header(keywords)).writeto(path, overwrite=True)
+
+
+def test_scan_reads_only_new_and_changed_files():
+    with tempfile.TemporaryDirectory() as d:
+        paths = [os.path.join(d, f"{i}.fits") for i in range(3)]
+        _write(paths[0], (10, 20), FILTER="R", EXPTIME=30.0)
+        _write(paths[1], (4, 10, 20), IMAGETYP="Light Frame")
+        _write(paths[2], (10, 20), **{"DATE-OBS": "2024-01-01T00:00:00"})
+        db = os.path.join(d, "index.db")
+
+        headers = HeaderIndex(db).scan(paths)
+        assert [h.shape for h in headers] == [(10, 20), (4, 10, 20), (10, 20)]
+        assert headers[0]["FILTER"] == "R" and headers[0]["EXPTIME"] == 30.0 and "FILTER" not in headers[1]
+        assert headers[2]["DATE-OBS"] == "2024-01-01T00:00:00"
+
+        # a new index on the same database doesn't open unchanged files, but re-reads changed ones
+        _write(paths[0], (12, 20), FILTER="V", EXPTIME=30.0)
+        os.utime(paths[0], ns=(0, os.stat(paths[0]).st_mtime_ns + 10**9))  # in case the rewrite landed in the same mtime tick
+        with open(paths[1], "r+b") as f:  # garble the cube's header in place, without changing its size or mtime
+            stat = os.stat(paths[1])
+            f.write(b"X"*80)
+        os.utime(paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        headers = HeaderIndex(db).scan(paths)
+        assert headers[0].shape == (12, 20) and headers[0]["FILTER"] == "V"
+        assert headers[1].shape == (4, 10, 20) and headers[1]["IMAGETYP"] == "Light Frame"
+
+        os.remove(paths[2])
+        index = HeaderIndex(db)
+        index.prune()
+        with index._connect() as con:
+            assert sorted(p for (p,) in con.execute("SELECT path FROM headers")) == paths[:2]
+
+
+if __name__ == "__main__":
+    test_scan_reads_only_new_and_changed_files()
+    print("header index tests passed")
@@ -0,0 +1,38 @@
+import numpy as np
+from scipy import ndimage
+
+from sagelib.calib.alignment import AffineTransform
+from sagelib.calib.resample import Resampler
+
+
+def _affine_transform(frame, transform, order):
+    # what the resampler has to match: ndimage's resampling of the frame through the inverse (reference -> image) transform, in (row, col) order
+    inverse = transform.inverse().params
+    return ndimage.affine_transform(frame, inverse[::-1, 1::-1], inverse[::-1, 2], order=order, cval=np.nan)
+
+
+def test_cached_bilinear_map_matches_affine_transform():
+    rng = np.random.default_rng(0)
+    frames = rng.normal(1000, 30, (6, 300, 200)).astype(np.float32)
+    pattern = [AffineTransform([[np.cos(a), -np.sin(a), dx], [np.sin(a), np.cos(a), dy]])
+               for a, dx, dy in ((0.01, 3.3, -7.6), (-0.004, -12.25, 4.5))]
+    transforms = [pattern[i % 2] for i in range(len(frames))]
+    expected = np.array([_affine_transform(f, t, 1) for f, t in zip(frames, transforms)])
+
+    resampler = Resampler(frames.shape[1:], order=1, tile_rows=64, workers=2)
+    for _ in range(2):  # building the maps, then reusing them
+        resampled = resampler.resample_batch(frames, transforms)
+        assert len(resampler._cache) == 2
+        both = np.isfinite(resampled) & np.isfinite(expected)
+        assert both.mean() > 0.9
+        assert np.abs(resampled - expected)[both].max() < 1e-3
+        # pixels that ndimage puts outside the frame are NaN here too
+        assert np.array_equal(np.isnan(resampled), np.isnan(expected))
+
+    uncached = Resampler(frames.shape[1:], order=1, tile_rows=64, cache_mb=0).resample_batch(frames, transforms)
+    assert np.allclose(uncached, expected, atol=1e-3, equal_nan=True)
+
+
+if __name__ == "__main__":
+    test_cached_bilinear_map_matches_affine_transform()
+    print("resample tests passed")
@@ -0,0 +1,50 @@
+import numpy as np
+
+from sagelib.stats import STATS_CHUNK_ELEMENTS, approx_median, batch_stats, frame_stats, mean_std
+
+
+def _image_with_nans(seed=0):
+    # several chunks' worth of pixels, with NaNs in some chunks but not others
+    img = np.random.default_rng(seed).normal(1000, 30, (1024, 1024)).astype(np.float32)
+    assert img.size > 2*STATS_CHUNK_ELEMENTS
+    img[100:110, 200:210] = np.nan
+    img[900, :] = np.nan
+    return img
+
+
+def test_histogram_median_matches_nanmedian():
+    img = _image_with_nans()
+    med, err = approx_median(img)
+    assert abs(med - np.nanmedian(img)) <= err + 1e-9
+    med, err = approx_median(img, max_error=0.01, max_passes=8)
+    assert err <= 0.01 and abs(med - np.nanmedian(img)) <= err + 1e-9
+
+
+def test_frame_stats_ignores_nans():
+    img = _image_with_nans(1)
+    for method in ("exact", "histogram", "sample"):
+        stats = frame_stats(img, median=method)
+        assert np.isclose(stats["mean"], np.nanmean(img, dtype=np.float64))
+        assert np.isclose(stats["std"], np.nanstd(img, dtype=np.float64))
+        assert stats["median"] == np.nanmedian(img)
+        assert stats["min"] == np.nanmin(img) and stats["max"] == np.nanmax(img)
+        assert stats["nnan"] == np.isnan(img).sum() and stats["npix"] == img.size
+
+    mean, std, lo, hi = mean_std(np.full((8, 8), np.nan))
+    assert np.isnan([mean, std, lo, hi]).all()
+
+
+def test_batch_stats_caches_on_frames():
+    from sagelib import Frame
+    frames = [Frame(_image_with_nans(seed), name=str(seed)) for seed in range(3)]
+    stats = batch_stats(frames, workers=2, median="histogram")
+    for frame, row in zip(frames, stats):
+        assert frame._mean == row["mean"] and frame._median == row["median"]
+        assert np.isclose(row["mean"], np.nanmean(frame.img, dtype=np.float64))
+
+
+if __name__ == "__main__":
+    test_histogram_median_matches_nanmedian()
+    test_frame_stats_ignores_nans()
+    test_batch_stats_caches_on_frames()
+    print("stats tests passed")
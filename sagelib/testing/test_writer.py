@@ -0,0 +1,68 @@
+import os
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+from sagelib import Frame
+from sagelib.writer import AsyncWriter, Compression, write_atomic
+
+
+def test_write_atomic_round_trip():
+    with tempfile.TemporaryDirectory() as d:
+        img = np.random.default_rng(0).normal(1000, 10, (64, 48)).astype(np.float32)
+        path = os.path.join(d, "out.fits")
+        write_atomic(path, img, fits.Header({"OBJECT": "test"}))
+        assert np.array_equal(fits.getdata(path), img) and fits.getheader(path)["OBJECT"] == "test"
+
+        # an existing file is only replaced with overwrite, and no temporary files are left behind either way
+        try:
+            write_atomic(path, img + 1)
+            assert False, "overwrote without overwrite=True"
+        except OSError:
+            pass
+        assert np.array_equal(fits.getdata(path), img)
+        write_atomic(path, img + 1, overwrite=True)
+        assert np.array_equal(fits.getdata(path), img + 1)
+        assert os.listdir(d) == ["out.fits"]
+
+        # compressed files are read back by Frame.from_fits, to within the quantization
+        write_atomic(os.path.join(d, "rice.fits"), img, compression=Compression("RICE_1"))
+        assert np.abs(Frame.from_fits(os.path.join(d, "rice.fits")).img - img).max() < 1  # noise is 10, quantized to ~1/16 of that
+        write_atomic(os.path.join(d, "gzip.fits"), img, compression=Compression("GZIP_2", quantize_level=0))
+        assert np.array_equal(Frame.from_fits(os.path.join(d, "gzip.fits")).img, img)
+
+
+def test_async_writer_round_trip_and_errors():
+    with tempfile.TemporaryDirectory() as d:
+        buf = np.empty((32, 32), dtype=np.float32)
+        with AsyncWriter(threads=2, max_queued=2) as writer:
+            for i in range(10):
+                buf.fill(i)  # the buffer is reused as soon as submit returns
+                writer.submit(os.path.join(d, f"{i}.fits"), buf)
+        assert writer.n_written == 10
+        for i in range(10):
+            assert np.all(fits.getdata(os.path.join(d, f"{i}.fits")) == i)
+
+        # failed writes don't stop the others, and are raised together by join
+        writer = AsyncWriter(threads=2)
+        writer.submit(os.path.join(d, "0.fits"), buf)  # exists, and overwrite is False
+        writer.submit(os.path.join(d, "missing", "x.fits"), buf)
+        writer.submit(os.path.join(d, "new.fits"), buf)
+        try:
+            writer.join()
+            assert False, "write errors weren't raised"
+        except OSError as e:
+            assert "2 of 3" in str(e) and "0.fits" in str(e) and "x.fits" in str(e)
+        assert np.all(fits.getdata(os.path.join(d, "new.fits")) == 9)
+        try:
+            writer.submit(os.path.join(d, "late.fits"), buf)
+            assert False, "submitted after join"
+        except RuntimeError:
+            pass
+
+
+if __name__ == "__main__":
+    test_write_atomic_round_trip()
+    test_async_writer_round_trip_and_errors()
+    print("writer tests passed")
@@ -6,12 +6,13 @@ from pytz import UTC
 from typing import List, Any
 import networkx as nx
 import glob
+from sagelib.discovery import find_files
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 from matplotlib.axes import Axes
 
 class Config:
-    def __init__(self,filepath:str,default_path:str|None=None,default_env_key:str="CONFIG_DEFAULTS"):
+    def __init__(self,filepath:str,default_path:str|None=None,default_env_key:str="CONFIG_DEFAULTS",compiled:bool=False):
         """Create a config object from a toml file. Optionally, add a fallback default toml config, read from `default_path`. If `default_path` is `None`, will also check the CONFIG_DEFAULTS environment varaible for a defaults filepath. 
 
         Profiles (toml tables) can be selected with :func:`Config.choose_profile` and deselected with :func:`Config.clear_profile`. Keys in a profile will take precedence over keys in the rest of the file and in the defaults file.
@@ -52,6 +53,12 @@ class Config:
         Or can write to the file the config was loaded from, overwriting previous contents (does not modify defaults file)::
 
         >>> cfg.save()
+
+        If `compiled` is True, reads are served from a plain-dict snapshot of the profile, main config, and defaults that is built once per profile the first time a key is read, instead of walking the tomlkit containers on every lookup. This is much faster for code that reads config keys in tight loops. The snapshot is rebuilt after :func:`Config.set`, item assignment, or :func:`Config.load_defaults`. Values are returned as plain python objects (not tomlkit items), so nested tables should be modified with :func:`Config.set` rather than in place::
+
+        >>> cfg = Config("config.toml",default_path="defaults.toml",compiled=True)
+        >>> cfg["table"]  # plain dict
+        >>> cfg.set("table", {**cfg["table"], "colnames": ["ra","dec"]})
          
         :param filepath: toml file to load config from
         :type filepath: str
@@ -59,8 +66,12 @@ class Config:
         :type default_path: str | None, optional
         :param default_env_key: will load defaults from here if this is set and default_path is not provided, defaults to `"CONFIG_DEFAULTS"`
         :type default_env_key: str, optional
+        :param compiled: serve reads from a compiled, plain-dict snapshot instead of the tomlkit document, defaults to False
+        :type compiled: bool, optional
         """
         self._cfg = _read_config(filepath)
+        self._compiled = compiled
+        self._snapshots = {}
         self.selected_profile = None
         self._defaults = None
         self._filepath = filepath 
@@ -87,6 +98,24 @@ class Config:
     def load_defaults(self, filepath:str):
         self._defaults = _read_config(filepath)
         self._default_path = filepath
+        self.invalidate()
+
+    def invalidate(self):
+        """Discard compiled snapshots so that they are rebuilt on the next read. Called automatically when the config is modified through this object"""
+        self._snapshots = {}
+
+    def _snapshot(self) -> dict:
+        # one flat dict per profile, with precedence profile > main config > defaults
+        snapshot = self._snapshots.get(self.selected_profile_name)
+        if snapshot is None:
+            snapshot = {}
+            if self.has_defaults:
+                snapshot.update(self._defaults.unwrap())
+            snapshot.update(self._cfg.unwrap())
+            if self.selected_profile:
+                snapshot.update(self.selected_profile.unwrap())
+            self._snapshots[self.selected_profile_name] = snapshot
+        return snapshot
 
     def write(self,fpath):
         """Writes the whole config loaded from file (not just the profile, and not including the defaults) into the given file"""
@@ -124,11 +153,19 @@ class Config:
             return
         else:
             self._cfg[key] = value
+            self.invalidate()
 
     def __call__(self, index:str) -> Any:
         return self.__getitem__(index)
 
     def __getitem__(self,index:str) -> Any:
+        if self._compiled:
+            try:
+                return self._snapshot()[index]
+            except KeyError:
+                if self.has_defaults:
+                    raise
+                return None
         if self.selected_profile:
             try:
                 return self.selected_profile[index]
@@ -141,6 +178,7 @@ class Config:
                 return self._get_default(index)
         
     def __setitem__(self,index:str,new_val:Any) -> Any:
+        self.invalidate()
         if self.selected_profile:
                 self.selected_profile[index] = new_val
                 return
@@ -293,16 +331,38 @@ def now_stamp(fname:bool=False) -> str:
     return tts(current_dt_utc(),fname=fname)
 
 #@pchoi @Pei Qin
-def findAllIn(data_dir, file_matching, contain_dir=False, save_ls=True, save_name=None):
+def findAllIn(data_dir, file_matching, contain_dir=False, save_ls=False, save_name=None, cache=None):
+    """Files in `data_dir` matching the wildcard pattern `file_matching` (like glob.glob, sorted), found with :func:`sagelib.discovery.find_files`. If `save_ls`, the list is also written to `save_name` in `data_dir`. `cache` is passed to find_files to reuse a cached listing of `data_dir`"""
     if data_dir[-1] != '/':
         data_dir = data_dir + '/'
     if save_name == None:
         save_name = 'all_' + file_matching + '.txt'
-    list_files = glob.glob(data_dir + file_matching)
+    list_files = find_files(data_dir, file_matching, include_hidden=False, cache=cache)
     if not contain_dir:
         list_files[:] = (os.path.basename(i) for i in list_files)
     if save_ls:
         with open(data_dir + save_name, "w") as output:
             for i in list_files:
                 output.write(str(i) + '\n')
-    return list_files
\ No newline at end of file
+    return list_files
+
+
+if __name__ == "__main__":
+    # benchmark config lookups per second, tomlkit vs compiled
+    import tempfile, time
+    n_lookups = 200000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg_path, defaults_path = os.path.join(tmpdir,"config.toml"), os.path.join(tmpdir,"defaults.toml")
+        with open(cfg_path,"w") as f:
+            f.write(tomlkit.dumps({"KEY":1,"TABLE":{"a":1,"b":[1,2,3]},"Profile1":{"KEY":2}}))
+        with open(defaults_path,"w") as f:
+            f.write(tomlkit.dumps({f"DEFAULT_{i}":i for i in range(50)}))
+        for compiled in (False, True):
+            cfg = Config(cfg_path,default_path=defaults_path,compiled=compiled)
+            cfg.choose_profile("Profile1")
+            keys = ["KEY","TABLE","DEFAULT_25"]
+            start = time.perf_counter()
+            for i in range(n_lookups):
+                cfg[keys[i%3]]
+            duration = time.perf_counter() - start
+            print(f"{'compiled' if compiled else 'tomlkit'}: {n_lookups/duration:.0f} lookups/s")
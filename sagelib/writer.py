@@ -0,0 +1,224 @@
+import os
+import queue
+import threading
+import uuid
+from dataclasses import dataclass
+
+import numpy as np
+from astropy.io import fits
+
+_STOP = object()
+
+COMPRESSION_TYPES = ("RICE_1", "GZIP_1", "GZIP_2")
+
+
+@dataclass(frozen=True)
+class Compression:
+    """How to tile-compress images (as a CompImageHDU extension after an empty primary HDU). Files written this way are read transparently by :func:`sagelib.Frame.from_fits`.
+
+    Float data is quantized before it's compressed: `quantize_level` is the number of quantization levels per standard deviation of the image's background noise (so 16 keeps the noise to ~1/16 of its own size, far below what it affects). Quantization is dithered with a seed from each image's checksum, so output is reproducible. A `quantize_level` of 0 stores floats losslessly, which only GZIP can do. Integer data is always lossless.
+
+    :param type: 'RICE_1' (fastest and smallest for quantized images), 'GZIP_1', or 'GZIP_2' (best for lossless floats), defaults to 'RICE_1'
+    :param quantize_level: quantization levels per noise standard deviation, or 0 for none, defaults to 16
+    :param tile_shape: shape of the tiles that are compressed separately, defaults to None (blocks of 16 rows, which compress much faster than astropy's default of single rows and still allow reading a few rows at a time)
+    """
+    type: str = "RICE_1"
+    quantize_level: float = 16.0
+    tile_shape: tuple|None = None
+
+    def __post_init__(self):
+        if self.type not in COMPRESSION_TYPES:
+            raise ValueError(f"Unknown compression type '{self.type}' - must be one of {COMPRESSION_TYPES}")
+        if self.quantize_level == 0 and not self.type.startswith("GZIP"):
+            raise ValueError("Lossless (quantize_level=0) compression of float data requires GZIP_1 or GZIP_2")
+
+    @classmethod
+    def from_name(cls, name:str|None, quantize_level:float=16.0):
+        """A Compression from a short name ('rice', 'gzip', or 'gzip2', case-insensitive), or None if `name` is None or 'none'"""
+        if name is None or name.lower() == "none":
+            return None
+        types = {"rice": "RICE_1", "gzip": "GZIP_1", "gzip2": "GZIP_2"}
+        if name.lower() not in types:
+            raise ValueError(f"Unknown compression '{name}' - must be one of {list(types)} or 'none'")
+        return cls(types[name.lower()], quantize_level)
+
+    def hdu(self, data, header=None):
+        header = fits.Header() if header is None else header.copy()
+        for key in ("SIMPLE", "EXTEND", "XTENSION", "PCOUNT", "GCOUNT", "BZERO", "BSCALE", "BLANK"):
+            header.remove(key, ignore_missing=True)
+        tile_shape = self.tile_shape
+        if tile_shape is None and np.ndim(data) >= 2:
+            tile_shape = (1,)*(np.ndim(data)-2) + (min(16, data.shape[-2]), data.shape[-1])
+        return fits.CompImageHDU(data, header, compression_type=self.type, tile_shape=tile_shape,
+                                 quantize_level=self.quantize_level, dither_seed=fits.hdu.compressed.DITHER_SEED_CHECKSUM)
+
+
+def write_atomic(path, data, header=None, overwrite=False, compression:Compression|None=None):
+    """
+    Write `data` and `header` to the fits file `path` through a temporary file in the same directory that is renamed into place, so `path` never holds a partly-written file (even if the process dies mid-write). If not `overwrite`, an existing `path` is never replaced
+
+    :param compression: tile-compress the image this way, defaults to None (uncompressed)
+    :type compression: Compression | None, optional
+    """
+    path = os.fspath(path)
+    directory, name = os.path.split(os.path.abspath(path))
+    if not overwrite and os.path.exists(path):
+        raise OSError(f"File {path} already exists. If you mean to replace it then use the argument \"overwrite=True\".")
+    tmp = os.path.join(directory, f".{name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        if compression is None:
+            fits.PrimaryHDU(data=data, header=header).writeto(tmp)
+        else:
+            fits.HDUList([fits.PrimaryHDU(), compression.hdu(data, header)]).writeto(tmp)
+        if overwrite:
+            os.replace(tmp, path)
+        else:
+            try:
+                os.link(tmp, path)  # fails, instead of replacing, if something else wrote `path` in the meantime
+            except FileExistsError:
+                raise OSError(f"File {path} already exists. If you mean to replace it then use the argument \"overwrite=True\".")
+            except OSError:  # filesystems without hard links
+                os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class AsyncWriter:
+    def __init__(self, threads:int=2, max_queued:int=4):
+        """Write fits files in the background (write-behind), so that computing the next frame overlaps with writing the last one.
+
+        :func:`AsyncWriter.submit` copies a frame's pixels and header and queues them for one of `threads` writer threads. At most `max_queued` frames wait in the queue: once it's full, submit blocks until a writer frees a slot, which bounds the memory held by queued frames. Files are written atomically (see :func:`write_atomic`). Errors don't interrupt the caller - they are collected and raised together by :func:`AsyncWriter.join`, which waits for every queued write to finish::
+
+        >>> with AsyncWriter(threads=2) as writer:
+        >>>     for frame in frames:
+        >>>         frame.write_fits(os.path.join(outdir, frame.name+".fits"), writer=writer)
+
+        :param threads: number of writer threads, defaults to 2
+        :type threads: int, optional
+        :param max_queued: maximum number of frames waiting to be written, defaults to 4
+        :type max_queued: int, optional
+        """
+        self._queue = queue.Queue(maxsize=max(1, max_queued))
+        self._errors = []
+        self._errors_lock = threading.Lock()
+        self.n_written = 0
+        self._threads = [threading.Thread(target=self._run, name=f"AsyncWriter-{i}", daemon=True) for i in range(max(1, threads))]
+        for t in self._threads:
+            t.start()
+        self._closed = False
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                path, data, header, overwrite, compression = item
+                try:
+                    write_atomic(path, data, header, overwrite, compression)
+                    with self._errors_lock:
+                        self.n_written += 1
+                except Exception as e:
+                    with self._errors_lock:
+                        self._errors.append((path, e))
+            finally:
+                self._queue.task_done()
+
+    def submit(self, path, data, header=None, overwrite=False, compression:Compression|None=None, copy=True):
+        """Queue `data` and `header` to be written to `path` (compressed with `compression`, if given), blocking while the queue is full. Unless `copy` is False, they are copied first, so the caller can reuse its buffers as soon as this returns. Compression happens on the writer threads, so with several threads, frames are compressed in parallel"""
+        if self._closed:
+            raise RuntimeError("Can't submit to an AsyncWriter that has been joined")
+        if copy:
+            data = np.array(data, copy=True)
+            header = header.copy() if header is not None else None
+        self._queue.put((os.fspath(path), data, header, overwrite, compression))
+
+    def join(self):
+        """Wait for every queued write to finish and stop the writer threads. Raises an OSError describing every write that failed, if any did"""
+        if not self._closed:
+            self._closed = True
+            for _ in self._threads:
+                self._queue.put(_STOP)
+            for t in self._threads:
+                t.join()
+        if self._errors:
+            lines = "\n".join(f"    {path}: {e}" for path, e in self._errors)
+            raise OSError(f"{len(self._errors)} of {len(self._errors)+self.n_written} files couldn't be written:\n{lines}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.join()
+        else:
+            # don't hide the original error behind write errors
+            try:
+                self.join()
+            except OSError as e:
+                print(f"Warning: {e}")
+
+
+def _synthetic_frame(size, rng):
+    # a sky-like frame: smooth background, a few hundred stars, and read/shot noise
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32)
+    img = 1000 + 50*np.sin(x/size*np.pi) + 30*(y/size)
+    for sx, sy, flux in zip(rng.uniform(0, size, 300), rng.uniform(0, size, 300), rng.lognormal(8, 1, 300)):
+        x0, x1, y0, y1 = int(max(sx-8, 0)), int(min(sx+9, size)), int(max(sy-8, 0)), int(min(sy+9, size))
+        img[y0:y1, x0:x1] += flux/(2*np.pi*4) * np.exp(-((x[y0:y1, x0:x1]-sx)**2 + (y[y0:y1, x0:x1]-sy)**2)/(2*4))
+    return (img + rng.normal(0, 12, img.shape)).astype(np.float32)
+
+
+if __name__ == "__main__":
+    # benchmark output: synchronous vs. write-behind writing, then compressed size, write/read throughput, and error of each compression mode
+    # on the given fits files (our typical frames) or on synthetic ones
+    import argparse, tempfile, time
+    parser = argparse.ArgumentParser()
+    parser.add_argument("frames", nargs="*", help="fits files to benchmark compression on. defaults to synthetic 2048x2048 frames")
+    parser.add_argument("--threads", type=int, default=2)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng()
+    if args.frames:
+        from sagelib import Frame
+        frames = [Frame.from_fits(p).img for p in args.frames]
+    else:
+        frames = [_synthetic_frame(2048, rng) for _ in range(8)]
+    nbytes = sum(f.nbytes for f in frames)
+    work = np.empty_like(frames[0])
+
+    def compute(i):
+        np.multiply(frames[i % len(frames)], 1.0001**i, out=work)
+        np.sqrt(work, out=work)
+        return work
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        n_frames = 40
+        start = time.perf_counter()
+        for i in range(n_frames):
+            write_atomic(os.path.join(tmpdir, f"sync_{i}.fits"), compute(i))
+        print(f"synchronous: {n_frames/(time.perf_counter()-start):.1f} frames/s")
+
+        start = time.perf_counter()
+        with AsyncWriter(threads=args.threads, max_queued=2*args.threads) as writer:
+            for i in range(n_frames):
+                writer.submit(os.path.join(tmpdir, f"async_{i}.fits"), compute(i))
+        print(f"AsyncWriter ({args.threads} threads): {n_frames/(time.perf_counter()-start):.1f} frames/s")
+
+        print(f"\n{len(frames)} frames, {nbytes/1024**2:.0f} MB as float32")
+        print(f"{'mode':<22}{'size':>8}{'write MB/s':>12}{'read MB/s':>11}{'max err/std':>13}")
+        for compression in (None, Compression("RICE_1", 16), Compression("RICE_1", 4), Compression("GZIP_2", 16), Compression("GZIP_2", 0)):
+            label = "uncompressed" if compression is None else f"{compression.type} q={compression.quantize_level:g}"
+            paths = [os.path.join(tmpdir, f"c{i}.fits") for i in range(len(frames))]
+            start = time.perf_counter()
+            with AsyncWriter(threads=args.threads, max_queued=2*args.threads) as writer:
+                for path, frame in zip(paths, frames):
+                    writer.submit(path, frame, overwrite=True, compression=compression, copy=False)
+            write_s = time.perf_counter() - start
+            size = sum(os.path.getsize(p) for p in paths)
+            start = time.perf_counter()
+            read = [fits.getdata(p) for p in paths]
+            read_s = time.perf_counter() - start
+            err = max(float(np.max(np.abs(r - f)) / np.std(f)) for r, f in zip(read, frames))
+            print(f"{label:<22}{size/nbytes:>7.1%}{nbytes/1024**2/write_s:>12.0f}{nbytes/1024**2/read_s:>11.0f}{err:>13.3f}")
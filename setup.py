@@ -29,6 +29,7 @@ setup(
             'csv_to_latex = sagelib.bin.csv_to_latex:main',
             'align = sagelib.calib.bin.align:main',
             'reduce = sagelib.calib.bin.reduce:main',
+            'make_masters = sagelib.calib.bin.make_masters:main',
             'scale_ref_img = sagelib.calib.bin.scale_ref_img:main',
             'run_info = sagelib.pipeline.bin.run_info:main',
             'product_info = sagelib.pipeline.bin.product_info:main',
@@ -36,7 +37,7 @@ setup(
         ]
     },
     extras_require = {
-        "calib": ['alipy','ccdproc'],
+        "calib": ['ccdproc'],
         "pipeline": ['sqlalchemy','networkx','tqdm']
     }
 )